@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offer分析的合成数据生成和性能基准：
+- generate_workload按上传格式生成'1-all data'和'blacklist'两张表，广告主和Affiliate取自类型映射，流量分布有倾斜，
+  默认混入少量空值、ID大小写和空白变体、数字与文本混合的App ID、带时分秒的Time
+- run_benchmark在10k/100k/1M行等规模上记录读取、各编号阶段、各条规则、收入排序和Excel导出的耗时，
+  与保存的基线比较，超过容差的阶段视为性能回退
+
+命令行入口见offer_analysis_cli的generate和bench子命令
+"""
+
+import contextlib
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+from datetime import datetime
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+import offer_analysis_core as core
+from offer_analysis_core import (
+    ADVERTISER_TYPE_MAP,
+    AFFILIATE_TYPE_MAP,
+    AnalysisAggregates,
+    PipelineMetrics,
+    build_analysis_excel_bytes,
+    build_rollups,
+    process_offer_data_web,
+    write_excel_sheets,
+)
+
+BENCH_SIZES = (10_000, 100_000, 1_000_000)
+BENCH_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'offer_analysis_bench_baseline.json')
+REGRESSION_TOLERANCE = 0.25     # 比基线慢25%以上视为回退
+REGRESSION_MIN_SECONDS = 0.05   # 与基线相差不到该秒数的阶段不判定回退，避免计时噪声
+
+WORKLOAD_GEOS = ['US', 'BR', 'IN', 'ID', 'MX', 'DE', 'JP', 'KR', 'TH', 'VN', 'PH', 'TR']
+WORKLOAD_END_DATE = '2026-01-31'
+WORKLOAD_DIRTY_RATE = 0.01      # 默认每类脏数据约占1%的行
+WORKLOAD_BLANK_COLUMNS = ('App ID', 'GEO', 'Affiliate')
+WORKLOAD_VARIANT_COLUMNS = ('Advertiser', 'Affiliate', 'App ID')
+WORKLOAD_IOS_APP_ID_RANGE = (100_000_000, 2_000_000_000)
+
+
+# ==================== 合成数据 ====================
+def _zipf_weights(count, skew, rng):
+    """count个对象的Zipf权重（第k名正比于1/k^skew），名次随机打乱，不与名称顺序相关"""
+    weights = 1.0 / np.arange(1, count + 1) ** skew
+    rng.shuffle(weights)
+    return weights / weights.sum()
+
+
+def _entity_names(known_names, count, label, first_id):
+    """优先使用已知名称，数量不够时按[编号]名称的格式补充"""
+    names = list(known_names)[:count]
+    names += [f'[{first_id + i}]{label}_{i}' for i in range(count - len(names))]
+    return np.array(names, dtype=object)
+
+
+def _id_variants(values, rng):
+    """ID的大小写和空白变体：全大写、全小写、前后加空格各占三分之一"""
+    values = values.astype(str)
+    kind = rng.integers(0, 3, size=len(values))
+    return np.where(kind == 0, np.char.upper(values),
+                    np.where(kind == 1, np.char.lower(values), np.char.add(np.char.add(' ', values), ' '))).astype(object)
+
+
+def add_dirty_values(data, rate, rng):
+    """
+    按比例在数据表中混入线上上传常见的脏数据，每类各约rate的行：
+    - App ID、GEO、Affiliate为空
+    - 广告主、Affiliate、App ID的大小写和前后空白变体
+    - App ID为数字的iOS ID，与文本的Android包名混在同一列中
+    - Time带有一天之内的时分秒
+    """
+    data = data.copy()
+    for col in WORKLOAD_BLANK_COLUMNS:
+        data.loc[rng.random(len(data)) < rate, col] = np.nan
+    for col in WORKLOAD_VARIANT_COLUMNS:
+        mask = (rng.random(len(data)) < rate) & data[col].notna().to_numpy()
+        data.loc[mask, col] = _id_variants(data.loc[mask, col].to_numpy(), rng)
+    mask = (rng.random(len(data)) < rate) & data['App ID'].notna().to_numpy()
+    app_ids = data['App ID'].to_numpy(dtype=object, copy=True)
+    app_ids[mask] = rng.integers(*WORKLOAD_IOS_APP_ID_RANGE, size=int(mask.sum())).tolist()
+    data['App ID'] = app_ids
+    mask = rng.random(len(data)) < rate
+    data.loc[mask, 'Time'] += pd.to_timedelta(rng.integers(1, 86400, size=int(mask.sum())), unit='s')
+    return data
+
+
+def generate_workload(rows=10_000, offers=None, advertisers=None, affiliates=None, days=30, seed=0, skew=1.1,
+                      end_date=WORKLOAD_END_DATE, dirty_rate=WORKLOAD_DIRTY_RATE):
+    """
+    生成与上传格式一致的数据表和黑名单表，返回(data_df, blacklist_df)：
+    - 广告主、Affiliate优先取ADVERTISER_TYPE_MAP/AFFILIATE_TYPE_MAP中的名称，数量超出时补充生成的名称
+    - Offer、广告主和Affiliate的行数按Zipf分布倾斜，少数头部Offer和下游占大部分行和流水
+    - 每个Offer有自己的投放起止日期、状态、caps和App ID（多个Offer共用App ID），部分Offer在最近几天停投，
+      使规则1-6都有命中
+    - dirty_rate>0时混入空值、ID大小写和空白变体、带时分秒的Time，见add_dirty_values；为0时生成干净数据
+    相同参数和seed生成的数据完全相同
+    """
+    rng = np.random.default_rng(seed)
+    offers = offers or max(10, rows // (days * 6))
+    advertisers = advertisers or len(ADVERTISER_TYPE_MAP)
+    affiliates = affiliates or len(AFFILIATE_TYPE_MAP)
+
+    advertiser_names = _entity_names(ADVERTISER_TYPE_MAP, advertisers, 'advertiser', 120000)
+    affiliate_names = _entity_names(AFFILIATE_TYPE_MAP, affiliates, 'affiliate', 1000)
+
+    # Offer属性
+    offer_ids = np.arange(100000, 100000 + offers)
+    offer_advertiser = rng.choice(advertisers, size=offers, p=_zipf_weights(advertisers, skew, rng))
+    offer_app = rng.integers(0, max(1, offers // 3), size=offers)
+    offer_geo = rng.choice(len(WORKLOAD_GEOS), size=offers, p=_zipf_weights(len(WORKLOAD_GEOS), skew, rng))
+    offer_status = np.where(rng.random(offers) < 0.8, 'ACTIVE', 'PAUSE')
+    offer_caps = rng.integers(5, 200, size=offers)
+    offer_start = rng.integers(0, days // 2 + 1, size=offers)
+    offer_end = np.where(rng.random(offers) < 0.85, days - 1, rng.integers(offer_start, days))
+    offer_payout = rng.lognormal(0.0, 0.6, size=offers)
+    offer_cr = rng.uniform(0.005, 0.05, size=offers)
+
+    # 每行随机抽取Offer、投放期内的日期和Affiliate
+    row_offer = rng.choice(offers, size=rows, p=_zipf_weights(offers, skew, rng))
+    span = offer_end[row_offer] - offer_start[row_offer] + 1
+    row_day = offer_start[row_offer] + (rng.random(rows) * span).astype(np.int64)
+    row_affiliate = rng.choice(affiliates, size=rows, p=_zipf_weights(affiliates, skew, rng))
+
+    clicks = rng.lognormal(4.0, 1.2, size=rows).astype(np.int64)
+    conversions = rng.binomial(clicks, offer_cr[row_offer])
+    revenue = (conversions * offer_payout[row_offer]).round(2)
+    profit = (revenue * rng.uniform(0.05, 0.3, size=rows)).round(2)
+
+    end = pd.Timestamp(end_date).normalize()
+    data = pd.DataFrame({
+        'Time': end - pd.to_timedelta(days - 1 - row_day, unit='D'),
+        'Offer ID': offer_ids[row_offer],
+        'Advertiser': advertiser_names[offer_advertiser[row_offer]],
+        'Affiliate': affiliate_names[row_affiliate],
+        'App ID': np.char.add('com.app', offer_app[row_offer].astype(str)).astype(object),
+        'GEO': np.array(WORKLOAD_GEOS, dtype=object)[offer_geo[row_offer]],
+        'Total Clicks': clicks,
+        'Total Conversions': conversions,
+        'Total Revenue': revenue,
+        'Total Profit': profit,
+        'Total Caps': offer_caps[row_offer],
+        'Status': offer_status[row_offer].astype(object),
+    })
+    if dirty_rate > 0:
+        # 单独的随机数流，干净部分和黑名单与不混入脏数据时相同
+        data = add_dirty_values(data, dirty_rate, np.random.default_rng([seed, 1]))
+    data = data.sort_values(['Time', 'Offer ID'], kind='stable', ignore_index=True)
+
+    # 黑名单：广告主通配、Affiliate通配和广告主+Affiliate组合各几条
+    blacklist_advertisers = rng.choice(advertiser_names, size=min(2, advertisers), replace=False)
+    blacklist_affiliates = rng.choice(affiliate_names, size=min(2, affiliates), replace=False)
+    pair_advertisers = rng.choice(advertiser_names, size=3)
+    pair_affiliates = rng.choice(affiliate_names, size=3)
+    blacklist = pd.DataFrame({
+        'Advertiser': [*blacklist_advertisers, *([np.nan] * len(blacklist_affiliates)), *pair_advertisers],
+        'Affiliate': [*([np.nan] * len(blacklist_advertisers)), *blacklist_affiliates, *pair_affiliates],
+    })
+    return data, blacklist
+
+
+def write_workload_excel(output, rows=10_000, **workload_options):
+    """生成合成数据并写成上传格式的Excel，output为路径或二进制文件对象"""
+    data, blacklist = generate_workload(rows, **workload_options)
+    write_excel_sheets({'1-all data': data, 'blacklist': blacklist}, output)
+    return data, blacklist
+
+
+# ==================== 性能基准 ====================
+@contextlib.contextmanager
+def isolated_local_state():
+    """基准运行期间把解析缓存、聚合存储、指标日志和待办事项存储指向临时目录：每次都从解析Excel开始，也不写入本机的数据"""
+    names = ('UPLOAD_CACHE_DIR', 'AGGREGATE_STORE_PATH', 'METRICS_LOG_PATH', 'TODO_STORE_PATH')
+    saved = {name: getattr(core, name) for name in names}
+    with tempfile.TemporaryDirectory(prefix='offer_bench_') as tmp_dir:
+        core.UPLOAD_CACHE_DIR = os.path.join(tmp_dir, 'cache')
+        core.AGGREGATE_STORE_PATH = os.path.join(tmp_dir, 'aggregates.sqlite3')
+        core.METRICS_LOG_PATH = os.path.join(tmp_dir, 'metrics.jsonl')
+        core.TODO_STORE_PATH = os.path.join(tmp_dir, 'todos.sqlite3')
+        try:
+            yield tmp_dir
+        finally:
+            for name, value in saved.items():
+                setattr(core, name, value)
+
+
+def bench_one(rows, seed=0, workers=0, streaming=False, verbose=False):
+    """
+    在一份rows行的合成数据上完整运行一次分析并导出Excel，返回各阶段墙钟耗时（秒）：
+    编号阶段和规则取自PipelineMetrics（“1. 读取数据并构建聚合立方体”即读取耗时），另加“多维汇总”和“Excel导出”
+    """
+    file_bytes = BytesIO()
+    write_workload_excel(file_bytes, rows, seed=seed)
+    file_bytes = file_bytes.getvalue()
+
+    metrics = PipelineMetrics()
+    log = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with isolated_local_state(), log:
+        aggregates = AnalysisAggregates()
+        result = process_offer_data_web(
+            BytesIO(file_bytes), streaming=streaming, workers=workers, progress=lambda percent, message: None,
+            metrics=metrics, aggregates=aggregates
+        )
+        if result is None:
+            raise RuntimeError(f"{rows}行合成数据分析失败")
+        final_offer_analysis, enhanced_todo_df, _ = result
+        started = time.perf_counter()
+        rollups = build_rollups(aggregates.cube, aggregates.offer_attrs)
+        rollup_seconds = time.perf_counter() - started
+        build_analysis_excel_bytes(final_offer_analysis, enhanced_todo_df, rollups)
+        export_seconds = time.perf_counter() - started - rollup_seconds
+
+    timings = {record['stage']: record['wall_seconds'] for record in metrics.records}
+    timings['多维汇总'] = round(rollup_seconds, 4)
+    timings['Excel导出'] = round(export_seconds, 4)
+    return {
+        'rows': rows,
+        'offers': len(final_offer_analysis),
+        'todo_rows': len(enhanced_todo_df),
+        'process_max_rss_mb': metrics.process_max_rss_mb(),
+        'timings': timings,
+    }
+
+
+def run_benchmark(sizes=BENCH_SIZES, seed=0, workers=0, streaming=False, verbose=False, report=None):
+    """依次运行各规模的基准，report(规模结果)在每个规模结束后调用；返回{行数字符串: 规模结果}"""
+    results = {}
+    for rows in sizes:
+        results[str(rows)] = bench_one(rows, seed=seed, workers=workers, streaming=streaming, verbose=verbose)
+        if report is not None:
+            report(results[str(rows)])
+    return results
+
+
+def benchmark_meta(seed=0, workers=0, streaming=False):
+    """基线附带的运行环境，不同机器之间的基线不宜直接比较"""
+    return {
+        'recorded_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'seed': seed,
+        'workers': workers,
+        'streaming': streaming,
+    }
+
+
+def load_baseline(path=None):
+    path = path or BENCH_BASELINE_PATH
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(results, meta, path=None):
+    """把本次结果写为基线；已有基线中本次没有运行的规模保留不变"""
+    path = path or BENCH_BASELINE_PATH
+    baseline = load_baseline(path) or {'sizes': {}}
+    baseline['meta'] = meta
+    baseline['sizes'].update(results)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(baseline, f, ensure_ascii=False, indent=1)
+    return path
+
+
+def find_regressions(results, baseline, tolerance=REGRESSION_TOLERANCE, min_seconds=REGRESSION_MIN_SECONDS):
+    """
+    与基线逐个规模、逐个阶段比较，返回回退的阶段列表：
+    耗时超过基线的(1+tolerance)倍且多出min_seconds以上才算回退；基线中没有的规模或阶段跳过
+    """
+    regressions = []
+    for size, result in results.items():
+        baseline_timings = baseline.get('sizes', {}).get(size, {}).get('timings', {})
+        for stage, seconds in result['timings'].items():
+            baseline_seconds = baseline_timings.get(stage)
+            if baseline_seconds is None:
+                continue
+            if seconds > baseline_seconds * (1 + tolerance) and seconds - baseline_seconds > min_seconds:
+                regressions.append({
+                    'rows': int(size), 'stage': stage, 'seconds': seconds, 'baseline_seconds': baseline_seconds,
+                    'ratio': round(seconds / baseline_seconds, 2) if baseline_seconds > 0 else None,
+                })
+    return regressions
+
+
+def format_result(result, baseline=None):
+    """单个规模结果的文本表格，有基线时附带基线耗时"""
+    baseline_timings = (baseline or {}).get('sizes', {}).get(str(result['rows']), {}).get('timings', {})
+    lines = [
+        f"== {result['rows']}行：Offer {result['offers']}个，待办事项{result['todo_rows']}条，"
+        f"进程内存最高水位{result['process_max_rss_mb']:.1f}MB =="
+    ]
+    for stage, seconds in result['timings'].items():
+        line = f"  {stage:<28}{seconds:>10.3f}s"
+        if stage in baseline_timings:
+            line += f"  （基线{baseline_timings[stage]:.3f}s）"
+        lines.append(line)
+    return '\n'.join(lines)
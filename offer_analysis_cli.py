@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offer数据分析命令行入口，不需要Streamlit运行环境，供定时任务和批处理使用：
+
+    python offer_analysis_cli.py run input.xlsx -o out.xlsx
+    python offer_analysis_cli.py run input.xlsx --incremental --store-source network-a
+    python offer_analysis_cli.py backfill input.xlsx -o history.xlsx
+    python offer_analysis_cli.py todos --advertiser "[110001]APPNEXT" --min-age 3
+    python offer_analysis_cli.py generate --rows 100000 -o synthetic.xlsx
+    python offer_analysis_cli.py bench --sizes 10000,100000 --check
+    python offer_analysis_cli.py equivalence recorded.xlsx --generated 5000,20000
+"""
+
+import argparse
+import sys
+
+
+def print_progress(percent, message):
+    """命令行进度回调：进度输出到stderr，不与分析日志混在一起"""
+    print(f"[{percent:3d}%] {message}", file=sys.stderr, flush=True)
+
+
+def open_todo_store(args):
+    from offer_analysis_core import TodoStore
+
+    return TodoStore(args.todo_store)
+
+
+def print_todo_delta(store, date):
+    counts = store.delta(date)['change'].value_counts()
+    previous = store.previous_date(date)
+    summary = '，'.join(f"{change}{int(counts.get(change, 0))}条" for change in ('新增', '持续', '已解决'))
+    print(f"📋 {date}待办事项" + (f"（对比{previous}）" if previous else '') + f"：{summary}", file=sys.stderr)
+
+
+def run_context(args):
+    """按模块配置和--trend-window创建运行上下文"""
+    from offer_analysis_core import RunContext
+
+    try:
+        return RunContext.from_module_config().with_trend_window(args.trend_window)
+    except ValueError as e:
+        raise SystemExit(f"❌ {e}")
+
+
+def run_analysis(args):
+    # 分析核心只在执行子命令时导入，--help等不需要加载pandas
+    from offer_analysis_core import (
+        AnalysisAggregates, OfferTrace, PipelineMetrics, analysis_output_filename, build_rollups, parse_offer_ids,
+        process_offer_data_web, write_analysis_excel
+    )
+
+    metrics = PipelineMetrics()
+    metrics.meta['file_name'] = args.input
+    trace_offer_ids = parse_offer_ids(args.trace)
+    trace = OfferTrace(trace_offer_ids) if trace_offer_ids else None
+    aggregates = None if args.no_rollups else AnalysisAggregates()
+    result = process_offer_data_web(
+        args.input,
+        low_memory=args.low_memory,
+        streaming=args.streaming,
+        incremental=args.incremental,
+        store_source=args.store_source,
+        context=run_context(args),
+        progress=print_progress,
+        workers=args.workers,
+        metrics=metrics,
+        trace=trace,
+        aggregates=aggregates,
+    )
+    if args.metrics_json:
+        with open(args.metrics_json, 'w', encoding='utf-8') as f:
+            f.write(metrics.to_json())
+    if trace is not None:
+        print(trace.to_text(), file=sys.stderr)
+        if args.trace_json:
+            with open(args.trace_json, 'w', encoding='utf-8') as f:
+                f.write(trace.to_json())
+    if result is None:
+        print("❌ 分析失败：读取数据失败", file=sys.stderr)
+        return 1
+
+    final_offer_analysis, enhanced_todo_df, latest_date = result
+    output = args.output or analysis_output_filename(latest_date)
+    rollups = build_rollups(aggregates.cube, aggregates.offer_attrs) if aggregates is not None else None
+    write_analysis_excel(final_offer_analysis, enhanced_todo_df, output, rollups)
+    print(f"✅ Offer分析记录{len(final_offer_analysis)}条，待办事项{len(enhanced_todo_df)}条，已写入{output}",
+          file=sys.stderr)
+    if args.record_todos:
+        store = open_todo_store(args)
+        store.record_result(enhanced_todo_df, latest_date)
+        print_todo_delta(store, latest_date.isoformat())
+    return 0
+
+
+def run_backfill(args):
+    from offer_analysis_core import (
+        PipelineMetrics, backfill_offer_data, todo_history_filename, todo_counts_by_rule, write_todo_history_excel
+    )
+
+    metrics = PipelineMetrics()
+    metrics.meta['file_name'] = args.input
+    history = backfill_offer_data(
+        args.input, context=run_context(args), streaming=args.streaming, incremental=args.incremental,
+        store_source=args.store_source, metrics=metrics
+    )
+    if args.metrics_json:
+        with open(args.metrics_json, 'w', encoding='utf-8') as f:
+            f.write(metrics.to_json())
+    if history is None:
+        print("❌ 回填失败：读取数据失败", file=sys.stderr)
+        return 1
+
+    output = args.output or todo_history_filename(history)
+    write_todo_history_excel(history, output)
+    if args.record_todos:
+        store = open_todo_store(args)
+        print(f"📋 {store.upsert(history)}条待办事项已写入待办事项存储{store.path}", file=sys.stderr)
+    for date, day_history in history.groupby('日期'):
+        counts = '，'.join(f"规则{rule_id} {count}" for rule_id, count in todo_counts_by_rule(day_history).items())
+        print(f"{date.strftime('%Y/%m/%d')}：{counts}", file=sys.stderr)
+    print(f"✅ {metrics.meta['backfill_days']}天的待办事项共{len(history)}条，已写入{output}", file=sys.stderr)
+    return 0
+
+
+def query_todos(args):
+    from offer_analysis_core import TODO_STORE_LABELS, write_excel_sheets
+
+    store = open_todo_store(args)
+    dates = store.dates()
+    if not dates:
+        print(f"⚠️ 待办事项存储{store.path}中还没有记录", file=sys.stderr)
+        return 1
+    date = args.date or dates[-1]
+    filters = {
+        'advertiser': args.advertiser, 'affiliate': args.affiliate, 'status': args.status,
+        'min_age_days': args.min_age, 'start_date': args.since
+    }
+    if any(value is not None for value in filters.values()):
+        todos = store.query(end_date=date, **filters)
+        print(f"🔎 共{len(todos)}条待办事项记录", file=sys.stderr)
+    else:
+        todos = store.delta(date)
+        print_todo_delta(store, date)
+    if args.output:
+        write_excel_sheets({'待办事项': todos.rename(columns=TODO_STORE_LABELS)}, args.output)
+        print(f"✅ 已写入{args.output}", file=sys.stderr)
+    return 0
+
+
+def generate_workload_file(args):
+    from offer_analysis_bench import write_workload_excel
+
+    data, _ = write_workload_excel(
+        args.output, args.rows, offers=args.offers, advertisers=args.advertisers, affiliates=args.affiliates,
+        days=args.days, seed=args.seed, skew=args.skew, dirty_rate=args.dirty_rate
+    )
+    print(f"✅ 已生成{len(data)}行合成数据（Offer {data['Offer ID'].nunique()}个），写入{args.output}", file=sys.stderr)
+    return 0
+
+
+def run_bench(args):
+    from offer_analysis_bench import (
+        benchmark_meta, find_regressions, format_result, load_baseline, run_benchmark, save_baseline
+    )
+
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    baseline = load_baseline(args.baseline)
+    results = run_benchmark(
+        sizes, seed=args.seed, workers=args.workers, streaming=args.streaming, verbose=args.verbose,
+        report=lambda result: print(format_result(result, baseline), file=sys.stderr, flush=True)
+    )
+    if args.save_baseline:
+        path = save_baseline(results, benchmark_meta(args.seed, args.workers, args.streaming), args.baseline)
+        print(f"✅ 基线已写入{path}", file=sys.stderr)
+        return 0
+    if baseline is None:
+        if args.check:
+            print("❌ 没有基线，--check无法比较；先用--save-baseline保存基线", file=sys.stderr)
+            return 1
+        print("⚠️ 没有基线，本次只记录耗时；使用--save-baseline保存基线", file=sys.stderr)
+        return 0
+    missing_sizes = [size for size in results if size not in baseline.get('sizes', {})]
+    if missing_sizes and args.check:
+        print(f"❌ 基线中没有{'、'.join(missing_sizes)}行的记录，--check无法比较", file=sys.stderr)
+        return 1
+
+    regressions = find_regressions(results, baseline, tolerance=args.tolerance)
+    for regression in regressions:
+        print(f"❌ {regression['rows']}行 {regression['stage']}：{regression['seconds']:.3f}s，"
+              f"基线{regression['baseline_seconds']:.3f}s", file=sys.stderr)
+    if regressions:
+        return 1
+    print("✅ 没有超过基线容差的阶段", file=sys.stderr)
+    return 0
+
+
+def run_equivalence(args):
+    from offer_analysis_equivalence import check_equivalence, format_report, generated_input
+
+    engines = tuple(name.strip() for name in args.engines.split(',') if name.strip())
+    sources = [(path, lambda path=path: open(path, 'rb').read()) for path in args.inputs]
+    sources += [
+        (f"合成数据{rows}行(seed={args.seed})", lambda rows=rows: generated_input(rows, args.seed))
+        for rows in (int(size) for size in args.generated.split(',') if size.strip())
+    ]
+
+    failed = False
+    for source, load in sources:
+        report = check_equivalence(load(), engines, reference=not args.no_reference, verbose=args.verbose)
+        print(format_report(source, report, args.max_diffs), file=sys.stderr, flush=True)
+        failed |= any(report.values())
+    return 1 if failed else 0
+
+
+TREND_WINDOW_HELP = (
+    '规则1/2/4/5的比较口径：day为最新vs次新一天（默认），ma3/ma7为3/7日移动平均，wow为与7天前同一星期几比较'
+)
+INCREMENTAL_HELP = '按天同步持久化聚合存储（OFFER_AGGREGATE_STORE或本机数据目录），只聚合新增或内容变化的日期'
+STORE_SOURCE_HELP = '与--incremental一起使用：聚合存储中的数据来源名称，不同的导出来源各用一个，默认default'
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='offer-analysis', description='Offer数据分析')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='分析上传格式的Excel文件并导出报告')
+    run_parser.add_argument('input', help="包含'1-all data'和'blacklist'工作表的Excel文件")
+    run_parser.add_argument('-o', '--output', help='输出Excel路径，默认offer_analysis_<最新日期>.xlsx')
+    run_parser.add_argument('--streaming', action='store_true', help='分块流式读取数据表')
+    run_parser.add_argument('--incremental', action='store_true', help=INCREMENTAL_HELP)
+    run_parser.add_argument('--store-source', help=STORE_SOURCE_HELP)
+    run_parser.add_argument('--low-memory', action='store_true', help='记录分析过程的峰值内存')
+    run_parser.add_argument('--workers', type=int, default=0, help='规则计算按广告主分片使用的进程数，0为串行')
+    run_parser.add_argument('--trend-window', default='day', help=TREND_WINDOW_HELP)
+    run_parser.add_argument('--no-rollups', action='store_true',
+                            help='不导出Advertiser、Affiliate、GEO等多维汇总表，只导出分析结果和待办事项两张表')
+    run_parser.add_argument('--metrics-json', help='把各阶段和各规则的性能记录写入该JSON文件')
+    run_parser.add_argument('--trace', help='追踪这些Offer ID（逗号分隔）在各条规则中的判断过程，输出到stderr')
+    run_parser.add_argument('--trace-json', help='与--trace一起使用，把追踪记录写入该JSON文件')
+    run_parser.add_argument('--record-todos', action='store_true', help='把待办事项写入待办事项存储并输出与前一次记录的对比')
+    run_parser.add_argument('--todo-store', help='待办事项存储的SQLite路径，默认为OFFER_TODO_STORE或本机数据目录')
+    run_parser.set_defaults(handler=run_analysis)
+
+    backfill_parser = subparsers.add_parser('backfill', help='回填窗口内每一天的待办事项，导出带日期列的待办事项历史')
+    backfill_parser.add_argument('input', help="包含'1-all data'和'blacklist'工作表的Excel文件")
+    backfill_parser.add_argument('-o', '--output', help='输出Excel路径，默认offer_todo_history_<最新日期>.xlsx')
+    backfill_parser.add_argument('--streaming', action='store_true', help='分块流式读取数据表')
+    backfill_parser.add_argument('--incremental', action='store_true', help=INCREMENTAL_HELP)
+    backfill_parser.add_argument('--store-source', help=STORE_SOURCE_HELP)
+    backfill_parser.add_argument('--trend-window', default='day', help=TREND_WINDOW_HELP)
+    backfill_parser.add_argument('--metrics-json', help='把回填各步骤的性能记录写入该JSON文件')
+    backfill_parser.add_argument('--record-todos', action='store_true', help='把每一天的待办事项写入待办事项存储')
+    backfill_parser.add_argument('--todo-store', help='待办事项存储的SQLite路径，默认为OFFER_TODO_STORE或本机数据目录')
+    backfill_parser.set_defaults(handler=run_backfill)
+
+    todos_parser = subparsers.add_parser(
+        'todos', help='查看待办事项存储：默认输出最新日期的新增/持续/已解决，带筛选条件时查询历史记录'
+    )
+    todos_parser.add_argument('--date', help='对比或查询截止的日期（YYYY-MM-DD），默认最新记录的日期')
+    todos_parser.add_argument('--advertiser', help='只查询该广告主')
+    todos_parser.add_argument('--affiliate', help='只查询该Affiliate')
+    todos_parser.add_argument('--status', help='只查询该处理进度')
+    todos_parser.add_argument('--min-age', type=int, help='只查询持续天数不少于该值的待办事项')
+    todos_parser.add_argument('--since', help='只查询该日期（YYYY-MM-DD）之后的记录')
+    todos_parser.add_argument('-o', '--output', help='把结果写入该Excel文件')
+    todos_parser.add_argument('--todo-store', help='待办事项存储的SQLite路径，默认为OFFER_TODO_STORE或本机数据目录')
+    todos_parser.set_defaults(handler=query_todos)
+
+    generate_parser = subparsers.add_parser('generate', help='生成上传格式的合成数据Excel')
+    generate_parser.add_argument('-o', '--output', required=True, help='输出Excel路径')
+    generate_parser.add_argument('--rows', type=int, default=10000, help='数据表行数')
+    generate_parser.add_argument('--offers', type=int, help='Offer数量，默认按行数和天数推算')
+    generate_parser.add_argument('--advertisers', type=int, help='广告主数量，默认为广告主类型映射中的数量')
+    generate_parser.add_argument('--affiliates', type=int, help='Affiliate数量，默认为Affiliate类型映射中的数量')
+    generate_parser.add_argument('--days', type=int, default=30, help='天数')
+    generate_parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    generate_parser.add_argument('--skew', type=float, default=1.1, help='Zipf倾斜指数，越大头部越集中')
+    generate_parser.add_argument('--dirty-rate', type=float, default=0.01,
+                                 help='空值、ID大小写和空白变体、带时分秒的Time各约占的行比例，0为干净数据')
+    generate_parser.set_defaults(handler=generate_workload_file)
+
+    bench_parser = subparsers.add_parser('bench', help='在合成数据上运行性能基准并与基线比较')
+    bench_parser.add_argument('--sizes', default='10000,100000,1000000', help='逗号分隔的数据表行数')
+    bench_parser.add_argument('--seed', type=int, default=0, help='合成数据的随机种子')
+    bench_parser.add_argument('--workers', type=int, default=0, help='规则计算按广告主分片使用的进程数，0为串行')
+    bench_parser.add_argument('--streaming', action='store_true', help='分块流式读取数据表')
+    bench_parser.add_argument('--baseline', help='基线JSON路径，默认为offer_analysis_bench_baseline.json')
+    bench_parser.add_argument('--save-baseline', action='store_true', help='把本次结果保存为基线')
+    bench_parser.add_argument('--tolerance', type=float, default=0.25, help='比基线慢超过该比例视为回退')
+    bench_parser.add_argument('--check', action='store_true',
+                              help='用于CI：没有基线或基线缺少本次的规模时也以非0状态退出，而不只是提示')
+    bench_parser.add_argument('--verbose', action='store_true', help='输出分析过程日志')
+    bench_parser.set_defaults(handler=run_bench)
+
+    equivalence_parser = subparsers.add_parser('equivalence', help='逐单元格对比参考实现和优化实现的分析结果')
+    equivalence_parser.add_argument('inputs', nargs='*', help='录制的上传格式Excel文件')
+    equivalence_parser.add_argument('--generated', default='5000,20000', help='逗号分隔的合成数据行数，空字符串不生成')
+    equivalence_parser.add_argument('--seed', type=int, default=0, help='合成数据的随机种子')
+    equivalence_parser.add_argument('--engines', default='serial,parallel,streaming,incremental',
+                                    help='参与对比的优化运行方式，逗号分隔')
+    equivalence_parser.add_argument('--no-reference', action='store_true', help='只在优化运行方式之间对比，不运行参考实现')
+    equivalence_parser.add_argument('--max-diffs', type=int, default=20, help='每组对比最多列出的差异数')
+    equivalence_parser.add_argument('--verbose', action='store_true', help='输出分析过程日志')
+    equivalence_parser.set_defaults(handler=run_equivalence)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,3697 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offer数据分析核心：读取、聚合、待办事项规则和Excel导出，不依赖Streamlit，
+网页版（offer_analysis_web）、命令行（offer_analysis_cli）和定时任务共用
+"""
+
+import pandas as pd
+import numpy as np
+import re
+import os
+import hashlib
+import json
+import shutil
+import tracemalloc
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, fields, replace
+from datetime import datetime, timedelta
+from types import MappingProxyType
+from typing import Mapping
+from io import BytesIO
+from numpy.lib.stride_tricks import sliding_window_view
+
+#上下游基础信息
+ADVERTISER_TYPE_MAP = {
+    '[110001]APPNEXT': 'xdj流量/inapp流量',
+    '[110006]APPNEXT-ONLINE': 'xdj流量/inapp流量',
+    '[110035]Jolibox_Appnext_Online': 'xdj流量/inapp流量',
+    '[110047]Jolibox_Appnext_Online_New': 'xdj流量/inapp流量',
+    '[110021]flymobi': 'xdj流量',
+    '[110045]dolphine': 'xdj流量',
+    '[110029]mobpower_xdj': 'xdj流量',
+    '[110028]mobpower': 'xdj流量/inapp流量',
+    '[110048]alto': 'xdj流量',
+    '[110022]imxbidding_xdj': 'xdj流量',
+    '[110016]Imxbidding': 'xdj流量/inapp流量',
+    '[110031]mobvista': 'xdj流量',
+    '[110010]Leapmob': 'xdj流量',
+    '[110036]Viking': 'xdj流量',
+    '[110020]cchange': 'xdj流量',
+    '[110023]bidmatrix': 'xdj流量',
+    '[110012]Smartconnect': 'xdj流量/inapp流量',
+    '[110050]Joymobi_new': 'xdj流量/inapp流量',
+    '[110039]Seanear': 'xdj流量',
+    '[110025]melodong': 'xdj流量',
+    '[110008]Shareit': 'xdj流量',
+    '[110037]Shareit_xdj': 'xdj流量',
+    '[110019]Bytemobi': 'xdj流量/inapp流量',   
+    '[110017]Gridads': 'xdj流量',    
+    '[110034]Joymobi': 'xdj流量',
+    '[110051]Elementallink': 'xdj流量',
+    '[110040]Ricefruit': 'xdj流量',
+    '[110049]AutumnAds': 'xdj流量',
+    '[110011]Versemedia': 'xdj流量',
+    '[110054]acshare': 'xdj流量',
+    '[110059]Flowbox': 'xdj流量'
+}
+
+AFFILIATE_TYPE_MAP = {
+    '[101]Melodong': 'inapp流量',
+    '[106]wldon': 'inapp流量',
+    '[131]wldon_new': 'inapp流量',
+    '[124]wldon_xdj': 'xdj流量',
+    '[115]synjoy': 'inapp流量',
+    '[158]synjoy_xdj': 'xdj流量',
+    '[104]versemedia': 'inapp流量',
+    '[122]melodong_xdj': 'xdj流量',
+    '[111]flowbox_xdj': 'xdj流量',
+    '[114]imxbidding': 'inapp流量',
+    '[157]imxbidding_xdj': 'xdj流量',
+    '[117]ioger_own': 'inapp流量',
+    '[139]Versemedia_xdj': 'xdj流量',
+    '[143]Alto_xdj': 'xdj流量',
+    '[137]Seanear_xdj': 'xdj流量',
+    '[107]zhizhen': 'inapp流量',
+    '[120]magicbeans': 'inapp流量',
+    '[142]magicbeans_xdj': 'xdj流量',
+    '[113]ioger': 'inapp流量',
+    '[123]bytemobi': 'inapp流量',
+    '[134]ioger_xdj': 'xdj流量',
+    '[126]seanear': 'inapp流量',
+    '[141]Joymobi_xdj': 'xdj流量',
+    '[136]Bytemobi_xdj': 'xdj流量',    
+    '[132]Viking_xdj': 'xdj流量',
+    '[155]acshare_xdj':'xdj流量',
+    '[144]bidderdesk_xdj_2':'xdj流量',
+    '[135]bidderdesk_xdj_1':'xdj流量'
+    
+}
+
+#黑名单机制
+BLACKLIST_CONFIG = {
+    'advertiser_blacklist': ['[110008]Shareit','[110037]Shareit_xdj','[110040]Ricefruit','[110047]Jolibox_Appnext_Online_New','[110049]AutumnAds','[110028]mobpower','[110016]Imxbidding'],
+    'affiliate_blacklist': ['[108]Baidu (Hong Kong) Limited', '[128]shareit','[113]ioger','[144]bidderdesk_xdj_2'
+    '[135]bidderdesk_xdj_1']}
+
+
+
+# 阈值配置
+OFFER_DIFF_THRESHOLD = 10    
+AFFILIATE_DIFF_THRESHOLD = 5 
+RULE4_REVENUE_DIFF_ABS = 5    # 差值绝对值≤5
+RULE4_REVENUE_DIFF_UP = 5     # 流水增长≥5
+RULE5_REVENUE_DIFF_THRESHOLD = -5  
+QUALIFY_DAILY_REVENUE = 10    # 任意一天流水≥10的Offer才参与分析
+RULE6_MIN_REVENUE_30D = 5     # 规则6胜出Offer的30天流水下限
+ROLLING_WINDOWS = (3, 7)      # 移动平均窗口（天），Offer和Offer×Affiliate都计算
+TREND_WINDOW = 'day'          # 规则1/2/4/5的比较口径：day（最新vs次新一天）、ma3/ma7（移动平均）、wow（周同比）
+
+
+def _normalize_blacklist_values(values):
+    """黑名单匹配的统一口径：空值视为''，其余转为字符串并去除首尾空格"""
+    values = pd.Series(values)
+    return values.where(values.notna(), '').astype(str).str.strip()
+
+
+class CompiledBlacklist:
+    """
+    编译后的黑名单，所有查询都是哈希查找：
+    - advertiser_wildcard：Affiliate为空的记录，匹配该广告主的所有Affiliate
+    - affiliate_wildcard：Advertiser为空的记录，匹配该Affiliate的所有广告主
+    - pairs：两者都不为空的记录，必须同时匹配
+    """
+
+    def __init__(self, records=()):
+        self.records = tuple(
+            {'advertiser': record['advertiser'], 'affiliate': record['affiliate']}
+            for record in records
+            if record['advertiser'] or record['affiliate']
+        )
+        self.advertiser_wildcard = frozenset(r['advertiser'] for r in self.records if not r['affiliate'])
+        self.affiliate_wildcard = frozenset(r['affiliate'] for r in self.records if not r['advertiser'])
+        self.pairs = frozenset(
+            (r['advertiser'], r['affiliate']) for r in self.records if r['advertiser'] and r['affiliate']
+        )
+
+    @classmethod
+    def from_frame(cls, blacklist_df):
+        advertisers = _normalize_blacklist_values(blacklist_df['Advertiser']).tolist()
+        affiliates = _normalize_blacklist_values(blacklist_df['Affiliate']).tolist()
+        return cls({'advertiser': adv, 'affiliate': aff} for adv, aff in zip(advertisers, affiliates))
+
+    @classmethod
+    def from_config(cls, config):
+        records = [{'advertiser': adv, 'affiliate': ''} for adv in config.get('advertiser_blacklist', [])]
+        records += [{'advertiser': '', 'affiliate': aff} for aff in config.get('affiliate_blacklist', [])]
+        return cls(records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __repr__(self):
+        return f"CompiledBlacklist({list(self.records)})"
+
+    def contains(self, advertiser, affiliate):
+        """单个广告主和Affiliate组合是否在黑名单中"""
+        advertiser_clean = str(advertiser).strip() if pd.notna(advertiser) else ''
+        affiliate_clean = str(affiliate).strip() if pd.notna(affiliate) else ''
+        return (
+            advertiser_clean in self.advertiser_wildcard or
+            affiliate_clean in self.affiliate_wildcard or
+            (advertiser_clean, affiliate_clean) in self.pairs
+        )
+
+    def mask(self, advertisers, affiliates):
+        """向量化匹配，返回布尔数组；advertisers/affiliates可以是Series或单个值（广播到整列）"""
+        if isinstance(advertisers, pd.Series):
+            length = len(advertisers)
+        elif isinstance(affiliates, pd.Series):
+            length = len(affiliates)
+        else:
+            return np.array([self.contains(advertisers, affiliates)])
+
+        def expand(values):
+            if isinstance(values, pd.Series):
+                return _normalize_blacklist_values(values.to_numpy())
+            return _normalize_blacklist_values([values] * length)
+
+        advertiser_clean = expand(advertisers)
+        affiliate_clean = expand(affiliates)
+        hit = advertiser_clean.isin(self.advertiser_wildcard) | affiliate_clean.isin(self.affiliate_wildcard)
+        if self.pairs and length > 0:
+            hit |= pd.MultiIndex.from_arrays([advertiser_clean, affiliate_clean]).isin(list(self.pairs))
+        return hit.to_numpy(dtype=bool)
+
+    def exact_advertiser_mask(self, advertisers):
+        """广告主按原值精确匹配广告主通配记录（不去空白），与原规则1-3的isin口径一致"""
+        return pd.Series(advertisers).isin(self.advertiser_wildcard).to_numpy(dtype=bool)
+
+
+# 规则1-3使用的固定黑名单，按exact_advertiser_mask精确匹配广告主
+CONFIG_BLACKLIST = CompiledBlacklist.from_config(BLACKLIST_CONFIG)
+
+
+@dataclass(frozen=True)
+class RunContext:
+    """
+    一次分析运行的不可变上下文，黑名单、类型映射和阈值都从这里读取：
+    分析过程不修改任何模块级变量，多个会话可以在各自的线程中同时分析
+    """
+    blacklist: CompiledBlacklist                # 从Excel黑名单表读取，规则4-6使用
+    config_blacklist: CompiledBlacklist         # 固定广告主黑名单，规则1-3使用
+    advertiser_type_map: Mapping[str, str]
+    affiliate_type_map: Mapping[str, str]
+    rule6_type_compatibility: Mapping[str, tuple]
+    offer_diff_threshold: float
+    affiliate_diff_threshold: float
+    rule4_revenue_diff_abs: float
+    rule4_revenue_diff_up: float
+    rule5_revenue_diff_threshold: float
+    qualify_daily_revenue: float
+    rule6_min_revenue_30d: float
+    rolling_windows: tuple = ROLLING_WINDOWS
+    trend_window: str = TREND_WINDOW
+
+    @classmethod
+    def from_module_config(cls, blacklist=None):
+        """按模块配置创建上下文；映射表复制为只读视图，运行中修改模块配置不影响已创建的上下文"""
+        return cls(
+            blacklist=blacklist if blacklist is not None else CompiledBlacklist(),
+            config_blacklist=CONFIG_BLACKLIST,
+            advertiser_type_map=MappingProxyType(dict(ADVERTISER_TYPE_MAP)),
+            affiliate_type_map=MappingProxyType(dict(AFFILIATE_TYPE_MAP)),
+            rule6_type_compatibility=MappingProxyType(dict(RULE6_TYPE_COMPATIBILITY)),
+            offer_diff_threshold=OFFER_DIFF_THRESHOLD,
+            affiliate_diff_threshold=AFFILIATE_DIFF_THRESHOLD,
+            rule4_revenue_diff_abs=RULE4_REVENUE_DIFF_ABS,
+            rule4_revenue_diff_up=RULE4_REVENUE_DIFF_UP,
+            rule5_revenue_diff_threshold=RULE5_REVENUE_DIFF_THRESHOLD,
+            qualify_daily_revenue=QUALIFY_DAILY_REVENUE,
+            rule6_min_revenue_30d=RULE6_MIN_REVENUE_30D,
+            rolling_windows=tuple(ROLLING_WINDOWS),
+            trend_window=TREND_WINDOW,
+        )
+
+    def with_blacklist(self, blacklist):
+        """返回替换了Excel黑名单的新上下文"""
+        return replace(self, blacklist=blacklist)
+
+    def with_thresholds(self, **thresholds):
+        """返回替换了部分阈值的新上下文，只接受THRESHOLD_FIELDS中的阈值"""
+        unknown = set(thresholds) - set(THRESHOLD_FIELDS)
+        if unknown:
+            raise ValueError(f"未知的阈值：{'、'.join(sorted(unknown))}")
+        return replace(self, **thresholds)
+
+    def thresholds(self):
+        return {name: getattr(self, name) for name in THRESHOLD_FIELDS}
+
+    def trend_window_options(self):
+        """可选的比较口径：day、每个移动平均窗口ma<N>、wow"""
+        return ['day'] + [f'ma{window}' for window in self.rolling_windows] + ['wow']
+
+    def with_trend_window(self, trend_window):
+        """返回替换了规则1/2/4/5比较口径的新上下文，口径不在trend_window_options中时抛出ValueError"""
+        if trend_window not in self.trend_window_options():
+            raise ValueError(f"未知的比较口径：{trend_window}，可选{'、'.join(self.trend_window_options())}")
+        return replace(self, trend_window=trend_window)
+
+    def config_digest(self):
+        """
+        除Excel黑名单外所有配置（阈值、类型映射、固定黑名单）的哈希：
+        Excel黑名单来自上传文件本身，已经包含在上传内容的哈希中
+        """
+        config = {}
+        for field in fields(self):
+            value = getattr(self, field.name)
+            if field.name == 'blacklist':
+                continue
+            if isinstance(value, CompiledBlacklist):
+                value = list(value.records)
+            elif isinstance(value, Mapping):
+                value = {key: list(item) if isinstance(item, tuple) else item for key, item in value.items()}
+            config[field.name] = value
+        payload = json.dumps(config, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def __reduce__(self):
+        # 只读映射视图不能pickle，传给工作进程时转为dict，重建时再包装
+        values = {}
+        for field in fields(self):
+            value = getattr(self, field.name)
+            values[field.name] = dict(value) if isinstance(value, MappingProxyType) else value
+        return (_restore_run_context, (values,))
+
+
+# 可以在运行时调整的阈值（界面的阈值调整、what-if重算）
+THRESHOLD_FIELDS = (
+    'qualify_daily_revenue', 'offer_diff_threshold', 'affiliate_diff_threshold',
+    'rule4_revenue_diff_abs', 'rule4_revenue_diff_up', 'rule5_revenue_diff_threshold', 'rule6_min_revenue_30d',
+)
+
+
+def _restore_run_context(values):
+    return RunContext(**{
+        name: MappingProxyType(value) if isinstance(value, dict) else value
+        for name, value in values.items()
+    })
+
+
+def load_blacklist_from_excel(blacklist_df):
+    """从Excel黑名单表加载黑名单配置，编译为CompiledBlacklist"""
+    try:
+        if 'Advertiser' not in blacklist_df.columns or 'Affiliate' not in blacklist_df.columns:
+            print("❌ 黑名单表格必须包含'Advertiser'和'Affiliate'两列")
+            return CompiledBlacklist()
+
+        return CompiledBlacklist.from_frame(blacklist_df)
+    except Exception as e:
+        print(f"⚠️ 处理黑名单数据失败: {str(e)}")
+        return CompiledBlacklist()
+
+def is_in_blacklist(context, advertiser, affiliate):
+    """检查广告主和Affiliate组合是否在本次运行的黑名单中"""
+    return context.blacklist.contains(advertiser, affiliate)
+
+
+
+def parse_affiliate_rate_text(text):
+    affiliate_list = []
+    if pd.isna(text) or text == '':
+        return affiliate_list
+    lines = text.split('\n')
+    for line in lines:
+        line = line.strip()
+        if '流水' in line:
+            affiliate_part = line.split('流水')[0].strip()
+            if affiliate_part:
+                affiliate_list.append(affiliate_part)
+    return affiliate_list
+
+
+def get_affiliate_type(affiliate_name, affiliate_type_map=AFFILIATE_TYPE_MAP):
+    if pd.isna(affiliate_name):
+        return ""
+    clean_aff = affiliate_name.strip().lower().replace(' ', '')
+    for aff_key, aff_type in affiliate_type_map.items():
+        clean_key = aff_key.strip().lower().replace(' ', '')
+        if clean_key in clean_aff or clean_aff in clean_key:
+            return aff_type
+    return ""
+
+def clean_aff_name(name):
+    """Affiliate名称清洗：去除首尾空格并转小写，用于匹配"""
+    if pd.isna(name):
+        return ""
+    return name.strip().lower()
+
+
+def build_affiliate_diff_index(qualified_cube, latest_day, second_latest_day):
+    """
+    每次分析只计算一次的Affiliate日环比索引：
+    - 键为(Offer ID, 清洗后的Affiliate)，值为最新一天流水、次新一天流水及差值
+    - 有数据但最新两天无流水的组合差值为0；完全没有数据的组合不在索引中
+    """
+    is_latest = qualified_cube['day'] == latest_day
+    is_second = qualified_cube['day'] == second_latest_day
+    revenue = qualified_cube['Total Revenue']
+
+    diff_index = pd.DataFrame({
+        'Offer ID': qualified_cube['Offer ID'],
+        'Affiliate_clean': qualified_cube['Affiliate'].fillna('').str.strip().str.lower(),
+        'latest_revenue': revenue.where(is_latest, 0),
+        'second_latest_revenue': revenue.where(is_second, 0)
+    }).groupby(['Offer ID', 'Affiliate_clean']).sum()
+    diff_index['revenue_diff'] = diff_index['latest_revenue'] - diff_index['second_latest_revenue']
+
+    return diff_index
+
+
+def get_affiliate_revenue_diff(diff_lookup, offer_id, affiliate):
+    """从预计算索引查询Affiliate最新两天流水差值（日期在build_affiliate_diff_index时已确定），无数据返回NaN"""
+    entry = diff_lookup.get((offer_id, clean_aff_name(affiliate)))
+    if entry is None:
+        return np.nan
+    return entry['revenue_diff']
+
+# ==================== 滚动窗口 ====================
+# 规则1/2（Offer）和规则4/5（Offer×Affiliate）默认比较最新两天的流水，单日波动就会触发；
+# 比较口径不是day时，先按自然日汇总为逐日流水矩阵（行为Offer或组合，列为连续的自然日，无数据的日期为0），
+# 在矩阵上用滑动窗口一次算出所有行在所需日期的口径值：
+# - ma<N>：截至最新日期与截至次新日期各自N个自然日的平均流水，数据开始不足N天的按已有天数平均
+# - wow：最新日期与7天前同一星期几的流水，7天前早于数据开始时为NaN（规则不触发）
+WEEK_DAYS = 7
+TREND_WINDOW_LABELS = {'day': '最新vs次新一天', 'wow': '周同比（7天前同一星期几）'}
+
+
+def trend_window_label(trend_window):
+    if trend_window.startswith('ma'):
+        return f"{trend_window[2:]}日移动平均"
+    return TREND_WINDOW_LABELS.get(trend_window, trend_window)
+
+
+def trend_columns(trend_window):
+    """口径的当前值、比较值和差值列名"""
+    return f'revenue_{trend_window}_latest', f'revenue_{trend_window}_second', f'revenue_{trend_window}_diff'
+
+
+def encode_groups(keys):
+    """
+    把若干等长、没有空值的键数组编码为分组号，返回(每行的分组号, 各键在每个分组上的取值)：
+    分组按键的字典序编号，与groupby(sort=True)的顺序一致，之后可以用bincount按分组累加
+    """
+    codes = np.zeros(len(keys[0]), dtype=np.int64)
+    levels = []
+    for key in keys:
+        key_codes, key_levels = pd.factorize(key, sort=True)
+        codes = codes * len(key_levels) + key_codes
+        levels.append(key_levels)
+    group_codes, groups = pd.factorize(codes, sort=True)
+    if len(groups) == 0:
+        return group_codes, [level[:0] for level in levels]
+    positions = np.unravel_index(groups, [len(level) for level in levels])
+    return group_codes, [level.take(position) for level, position in zip(levels, positions)]
+
+
+def daily_revenue_matrix(qualified_cube, keys):
+    """
+    按keys汇总的逐日流水矩阵，返回(行索引, rows×days矩阵, 第一天)：
+    行按keys排序，列为第一天到最后一天的连续自然日，没有数据的日期为0；
+    键和日期编码为整数后用bincount一次累加，不经过groupby和unstack
+    """
+    row_codes, row_keys = encode_groups([qualified_cube[key] for key in keys])
+    if len(keys) == 1:
+        index = pd.Index(row_keys[0], name=keys[0])
+    else:
+        index = pd.MultiIndex.from_arrays(row_keys, names=keys)
+    if len(index) == 0:
+        return index, np.zeros((0, 0)), 0
+
+    day = qualified_cube['day'].to_numpy(dtype=np.int64)
+    first_day = int(day.min())
+    day_count = int(day.max()) - first_day + 1
+    matrix = np.bincount(
+        row_codes * day_count + (day - first_day), weights=qualified_cube['Total Revenue'].to_numpy(dtype=float),
+        minlength=len(index) * day_count
+    ).reshape(len(index), day_count)
+    return index, matrix, first_day
+
+
+def window_mean(matrix, positions, span):
+    """
+    截至各列位置（含）span个自然日的平均流水，返回rows×len(positions)：
+    窗口超出数据开始的部分不计入天数，位置本身在数据开始之前的为NaN
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    padded = np.pad(matrix, ((0, 0), (span - 1, 0)))
+    values = sliding_window_view(padded, span, axis=1)[:, np.clip(positions, 0, None)].sum(axis=-1)
+    values = values / np.clip(positions + 1, 1, span)
+    values[:, positions < 0] = np.nan
+    return values
+
+
+def trend_comparison(matrix, first_day, days, previous_days, trend_window):
+    """每行在各日期按口径的(当前值, 比较值)，day/ma<N>与前一日期比较，wow与7天前比较"""
+    days = np.asarray(days, dtype=np.int64) - first_day
+    previous = np.asarray(previous_days, dtype=np.int64) - first_day
+    if trend_window == 'wow':
+        return window_mean(matrix, days, 1), window_mean(matrix, days - WEEK_DAYS, 1)
+    span = int(trend_window[2:]) if trend_window.startswith('ma') else 1
+    return window_mean(matrix, days, span), window_mean(matrix, previous, span)
+
+
+def build_trend_table(qualified_cube, keys, latest_day, second_latest_day, trend_windows):
+    """单次分析用：keys组合在最新日期的各口径流水，列名见trend_columns"""
+    index, matrix, first_day = daily_revenue_matrix(qualified_cube, keys)
+    columns = {}
+    for trend_window in trend_windows:
+        latest, second = trend_comparison(matrix, first_day, [latest_day], [second_latest_day], trend_window)
+        latest_col, second_col, diff_col = trend_columns(trend_window)
+        columns[latest_col] = latest[:, 0]
+        columns[second_col] = second[:, 0]
+        columns[diff_col] = latest[:, 0] - second[:, 0]
+    return pd.DataFrame(columns, index=index)
+
+
+def offer_comparison_columns(context, latest_col, second_col):
+    """规则1/2比较的两列：day口径为最新两天的流水列，其他口径为趋势列"""
+    if context.trend_window == 'day':
+        return latest_col, second_col
+    return trend_columns(context.trend_window)[:2]
+
+
+def affiliate_comparison_column(context):
+    """规则4/5使用的日环比索引差值列"""
+    return 'revenue_diff' if context.trend_window == 'day' else trend_columns(context.trend_window)[2]
+
+
+# ==================== 规范化数据表 ====================
+PIPELINE_COLUMNS = [
+    'Time', 'Offer ID', 'Advertiser', 'Affiliate', 'App ID', 'GEO',
+    'Total Clicks', 'Total Conversions', 'Total Revenue', 'Total Profit', 'Total Caps', 'Status'
+]
+CATEGORICAL_COLUMNS = ['Advertiser', 'Affiliate', 'App ID', 'GEO', 'Status']
+COUNT_COLUMNS = ['Total Clicks', 'Total Conversions']
+
+
+def _to_category(series):
+    """文本列转为category（字典编码）；取值类型混杂无法编码时保持原样"""
+    try:
+        return series.astype('category')
+    except TypeError:
+        return series
+
+
+def _decode_categories(df):
+    """把category列还原为普通列，供文本拼接、导出等后续步骤使用"""
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(df[col].cat.categories.dtype)
+    return df
+
+
+def to_day_number(times):
+    """日期时间转为整数天（距1970-01-01的天数）"""
+    return np.asarray(times, dtype='datetime64[ns]').astype('datetime64[D]').astype(np.int64).astype(np.int32)
+
+
+def day_to_date(day):
+    """整数天转回datetime.date"""
+    return (np.datetime64(0, 'D') + np.timedelta64(int(day), 'D')).astype(object)
+
+
+def build_canonical_frame(df):
+    """
+    加载后一次性构建分析用的规范化数据表：
+    - 只保留分析用到的列，Time转为日期时间并去掉无效行，Offer ID/Total Caps转为数值
+    - 文本列转为category，整数计数列向下转换类型；金额列保持float64，汇总结果与原始数据一致
+    - 增加整数day列，按天比较不再生成datetime.date对象数组
+    """
+    time = pd.to_datetime(df['Time'], errors='coerce')
+    valid = time.notna().to_numpy()
+    keep_all = bool(valid.all())
+
+    def take(series):
+        return series if keep_all else series[valid]
+
+    columns = {'Time': take(time)}
+    for col in PIPELINE_COLUMNS[1:]:
+        series = take(df[col])
+        if col in ('Offer ID', 'Total Caps'):
+            series = pd.to_numeric(series, errors='coerce')
+        elif col in CATEGORICAL_COLUMNS:
+            series = _to_category(series)
+        elif col in COUNT_COLUMNS and pd.api.types.is_integer_dtype(series.dtype):
+            series = pd.to_numeric(series, downcast='integer')
+        columns[col] = series
+
+    canonical = pd.DataFrame(columns).reset_index(drop=True)
+    canonical['day'] = to_day_number(canonical['Time'])
+    return canonical
+
+
+def frame_memory_mb(df):
+    """DataFrame占用内存（MB）"""
+    return df.memory_usage(deep=True).sum() / 1024 / 1024
+
+
+# ==================== 聚合立方体 ====================
+CUBE_KEYS = ['Time', 'Offer ID', 'Affiliate', 'Advertiser']
+CUBE_METRICS = ['Total Clicks', 'Total Conversions', 'Total Revenue', 'Total Profit']
+
+
+def build_offer_cube(df):
+    """
+    一次groupby把规范化数据压缩成(Time, Offer ID, Affiliate)粒度的聚合立方体，后续各阶段都从立方体派生：
+    - Time保留原始时间（Offer达标按原始Time汇总），另加整数day列用于按天比较
+    - Advertiser随Offer ID固定，放进分组键不增加行数，供收入排序按(Offer ID, Advertiser)汇总
+    - 保留Affiliate为空的行，Offer维度的汇总与原始数据一致；计数列汇总为int64避免溢出
+    同时返回每个Offer的属性（原始数据中第一条记录的取值）
+    """
+    return aggregate_offer_cube(df), build_offer_attrs(df)
+
+
+def aggregate_offer_cube(df):
+    """build_offer_cube的立方体部分，df只需包含CUBE_KEYS和CUBE_METRICS列"""
+    cube = df.groupby(CUBE_KEYS, dropna=False, sort=True, observed=True)[CUBE_METRICS].sum().reset_index()
+    cube = _decode_categories(cube)
+    for col in COUNT_COLUMNS:
+        if pd.api.types.is_integer_dtype(cube[col].dtype):
+            cube[col] = cube[col].astype(np.int64)
+    cube['day'] = to_day_number(cube['Time'])
+    return cube
+
+
+def build_offer_attrs(df):
+    """build_offer_cube的Offer属性部分"""
+    # Advertiser/Total Caps/Status取第一个非空值，App ID/GEO取第一行的值（与原汇总口径一致）
+    offer_attrs = df.groupby('Offer ID', observed=True).agg({
+        'Advertiser': 'first',
+        'Total Caps': 'first',
+        'Status': 'first'
+    }).reset_index()
+    first_rows = df.dropna(subset=['Offer ID']).drop_duplicates(subset=['Offer ID'])[['Offer ID', 'App ID', 'GEO']]
+    offer_attrs = offer_attrs.merge(first_rows, on='Offer ID', how='left')
+    return _decode_categories(offer_attrs[['Offer ID', 'Advertiser', 'App ID', 'GEO', 'Total Caps', 'Status']])
+
+
+def merge_offer_cubes(cube_parts):
+    """合并多个部分立方体（分块读取时逐块折叠），相同键的指标相加"""
+    cube = pd.concat(cube_parts, ignore_index=True)
+    cube = cube.groupby(CUBE_KEYS, dropna=False, sort=True)[CUBE_METRICS].sum().reset_index()
+    cube['day'] = to_day_number(cube['Time'])
+    return cube
+
+
+def merge_offer_attrs(attrs_parts):
+    """
+    按先后顺序合并多个部分Offer属性表，保持“第一条记录”的取值口径：
+    Advertiser/Total Caps/Status取最早的非空值，App ID/GEO取最早出现的一行
+    """
+    attrs = pd.concat(attrs_parts, ignore_index=True)
+    first_non_null = attrs.groupby('Offer ID')[['Advertiser', 'Total Caps', 'Status']].first().reset_index()
+    first_rows = attrs.drop_duplicates(subset=['Offer ID'])[['Offer ID', 'App ID', 'GEO']]
+    merged = first_non_null.merge(first_rows, on='Offer ID', how='left')
+    return merged[['Offer ID', 'Advertiser', 'App ID', 'GEO', 'Total Caps', 'Status']]
+
+# ==================== 新增：收入排序计算逻辑 ====================
+def calculate_revenue_ranking(qualified_df, max_date=None):
+    """
+    计算收入排序：
+    - 如果是本月1号，计算所有日期的Total Revenue
+    - 否则，只计算本月所有日期的Total Revenue
+    - 按Advertiser维度汇总并降序排序
+    max_date为判断基准日期，默认取数据中的最大日期（按广告主分片计算时传入全量数据的最大日期）
+    """
+    # 确保Time列是datetime类型（只转换Time列，不复制整张表）
+    time = pd.to_datetime(qualified_df['Time'], errors='coerce')
+    
+    # 获取数据中的最大日期（判断是否为当月1号的基准）
+    if max_date is None:
+        max_date = time.max()
+    is_first_day = (max_date.day == 1)
+    
+    # 筛选时间范围
+    if is_first_day:
+        # 本月1号：计算所有日期数据
+        filtered_df = qualified_df
+    else:
+        # 非本月1号：只计算本月数据
+        filtered_df = qualified_df[
+            (time.dt.year == max_date.year) & 
+            (time.dt.month == max_date.month)
+        ]
+    
+    #计算每个(Time, Offer ID, Advertiser)的总收入
+    time_offer_advertiser_revenue = filtered_df.groupby(['Offer ID', 'Advertiser'])['Total Revenue'].sum().reset_index()
+    time_offer_advertiser_revenue.rename(columns={'Total Revenue': 'Time_Offer_Advertiser_Revenue'}, inplace=True)
+
+    time_offer_advertiser_revenue = time_offer_advertiser_revenue.sort_values(
+    by=['Advertiser', 'Time_Offer_Advertiser_Revenue'],  # 优先按广告主排序，同广告主内按收入排序
+    ascending=[True, False],  # Advertiser升序（字母/数字顺序），Revenue降序
+    ignore_index=True)
+    
+    time_offer_advertiser_revenue['Advertiser_Rank'] = time_offer_advertiser_revenue.groupby('Advertiser')['Time_Offer_Advertiser_Revenue'].rank(
+    method='min', ascending=False).astype(int)
+
+   
+    
+    return time_offer_advertiser_revenue
+
+# ==================== 待办事项规则引擎 ====================
+# 每条规则是共享数据上的一个布尔掩码（Affiliate级规则是Offer与Affiliate组合表上的掩码），
+# 规则优先级：规则1-3触发的Offer不再参与规则4-6，规则4/5触发的组合不再参与规则6
+TODO_OFFER_COLUMNS = [
+    'Offer ID', 'Advertiser', 'App ID', 'GEO', 'Total caps', 'Status', '预算空间'
+]
+TODO_TEXT_COLUMNS = [
+    'affilate_revenue_rate_all', 'latest_affilate_revenue_rate_all', 'influence_affiliate'
+]
+
+
+def _is_status(base, status):
+    return base['Status'].str.upper() == status
+
+
+OFFER_RULES = [
+    {
+        'rule_id': 3,
+        'name': 'ACTIVE+预算空间<0',
+        'todo': '请询问广告主是否有预算增加空间',
+        'mask': lambda base, latest_col, second_col: _is_status(base, 'ACTIVE') & (base['预算空间'] < 0)
+    },
+    {
+        'rule_id': 1,
+        'name': '最新无流水+次新有流水',
+        'todo': '请确认该预算暂停原因，比如是否质量不行、CPA预算波动比较大、预算换到新id',
+        'mask': lambda base, latest_col, second_col: (base[latest_col] == 0) & (base[second_col] > 10)
+    },
+    {
+        'rule_id': 2,
+        'name': 'Pause+收入波动显著',
+        'todo': '关注今日是否有流水，如果无流水或者比昨日流水少10美金以上，和广告主确认暂停原因，如是否预算不够，否则保持观察',
+        'mask': lambda base, latest_col, second_col: (
+            _is_status(base, 'PAUSE') &
+            (base[latest_col] >= 10) &
+            (abs(base[latest_col] - base[second_col]) >= 10)
+        )
+    },
+]
+
+AFFILIATE_RULES = [
+    {
+        'rule_id': 4,
+        'name': 'ACTIVE+预算>0+流水差值≤5或增长≥5',
+        'todo': '优先push该下游消耗预算，原因该下游历史或者最新一天有产生过流水且该预算仍有空间',
+        'mask': lambda diff, context: diff.notna() & (
+            (abs(diff) <= context.rule4_revenue_diff_abs) | (diff >= context.rule4_revenue_diff_up)
+        )
+    },
+    {
+        'rule_id': 5,
+        'name': 'ACTIVE+预算>0+收入减少>5',
+        'todo': '和下游沟通减少原因',
+        'mask': lambda diff, context: diff.notna() & (diff < context.rule5_revenue_diff_threshold)
+    },
+]
+
+
+def _offer_rule_rows(rows, rule, affiliate, revenue_columns):
+    """按待办事项格式组装规则命中的行"""
+    todo_rows = rows[TODO_OFFER_COLUMNS + revenue_columns + TODO_TEXT_COLUMNS].assign(
+        Affiliate=affiliate, **{'待办事项': rule['todo']}, rule_id=rule['rule_id']
+    )
+    return todo_rows[TODO_OFFER_COLUMNS + ['Affiliate', '待办事项'] + revenue_columns + TODO_TEXT_COLUMNS + ['rule_id']]
+
+
+PAIR_ORDER_COLUMNS = ['text_source', 'offer_pos', 'line_no']
+
+
+def build_offer_affiliate_pairs(offers):
+    """
+    从历史和最新一天的Affiliate流水占比文本中展开(Offer ID, Affiliate)组合，
+    与parse_affiliate_rate_text的解析口径一致，同一Offer下重复的Affiliate只保留一次；
+    PAIR_ORDER_COLUMNS记录组合的展开顺序（先历史文本后最新文本，Offer按offer_pos排列），
+    按广告主分片计算的结果按这些列排序后与整体计算的顺序一致
+    """
+    lines = pd.concat([
+        pd.DataFrame({
+            'Offer ID': offers['Offer ID'],
+            'offer_pos': offers['offer_pos'],
+            'text_source': text_source,
+            'text': offers[text_col]
+        })
+        for text_source, text_col in enumerate(['affilate_revenue_rate_all', 'latest_affilate_revenue_rate_all'])
+    ], ignore_index=True)
+    lines = lines[lines['text'].notna() & (lines['text'] != '')]
+    lines = lines.assign(line=lines['text'].str.split('\n')).explode('line')
+    lines = lines.assign(line_no=lines.groupby(level=0).cumcount())
+    lines = lines[lines['line'].str.contains('流水', regex=False, na=False)]
+
+    pairs = pd.DataFrame({
+        'Offer ID': lines['Offer ID'],
+        'Affiliate': lines['line'].str.split('流水').str[0].str.strip(),
+        **{col: lines[col] for col in PAIR_ORDER_COLUMNS}
+    })
+    pairs = pairs[pairs['Affiliate'] != ''].drop_duplicates(subset=['Offer ID', 'Affiliate'])
+    return pairs.reset_index(drop=True)
+
+
+def evaluate_todo_rules(todo_base_data, affiliate_diff_index, latest_date_str, second_latest_date_str, context,
+                        workers=0, metrics=None, trace=None):
+    """
+    规则引擎：依次计算规则3、1、2（Offer级）、规则4、5（Affiliate级）和规则6，
+    一次性拼接为待办事项表，rule_id列标记每行由哪条规则产生；黑名单、阈值和比较口径取自运行上下文
+    （口径不是day时todo_base_data和affiliate_diff_index须已包含该口径的趋势列，见build_trend_table）
+    workers>1时规则4-6中按广告主独立的部分分片到多个进程计算，结果与串行计算一致
+    metrics不为空时记录每条规则的耗时和行数
+    trace为OfferTrace时在规则计算结束后记录追踪Offer的判断过程
+    """
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    latest_col = f'{latest_date_str}_total_revenue'
+    second_col = f'{second_latest_date_str}_total_revenue'
+    revenue_columns = [latest_col, second_col]
+    compare_latest_col, compare_second_col = offer_comparison_columns(context, latest_col, second_col)
+    advertiser_blacklisted = context.config_blacklist.exact_advertiser_mask(todo_base_data['Advertiser'])
+
+    rule_frames = []
+    triggered_123 = pd.Series(False, index=todo_base_data.index)
+    for rule in OFFER_RULES:
+        print(f"  处理规则{rule['rule_id']}：{rule['name']}...")
+        with metrics.measure(f"规则{rule['rule_id']}", rows_in=len(todo_base_data)) as record:
+            hit = rule['mask'](todo_base_data, compare_latest_col, compare_second_col) & ~advertiser_blacklisted
+            rule_frames.append(_offer_rule_rows(todo_base_data[hit], rule, '', revenue_columns))
+            triggered_123 |= hit
+            record['rows_out'] = int(hit.sum())
+        print(f"  规则{rule['rule_id']}触发数量：{int(hit.sum())}")
+
+    # 规则4-6共用的候选Offer：ACTIVE+预算>0，未触发规则1-3，广告主不在黑名单
+    eligible_offers = todo_base_data[
+        _is_status(todo_base_data, 'ACTIVE') &
+        (todo_base_data['预算空间'] > 0) &
+        ~triggered_123 &
+        ~context.blacklist.mask(todo_base_data['Advertiser'], '')
+    ]
+    eligible_offers = eligible_offers.assign(offer_pos=np.arange(len(eligible_offers)))
+    print(f"  规则4-6候选Offer数量：{len(eligible_offers)}")
+
+    with metrics.measure('规则4-6候选（按广告主分片）', rows_in=len(eligible_offers)) as record:
+        affiliate_diffs = affiliate_diff_index[affiliate_comparison_column(context)].rename('revenue_diff')
+        shard_results = evaluate_advertiser_shards(eligible_offers, affiliate_diffs.reset_index(), context, workers)
+        record['rows_out'] = len(shard_results)
+
+    # 规则4/5：合并各分片命中的组合，按展开顺序排列后关联候选Offer
+    triggered_45_pairs = []
+    for rule in AFFILIATE_RULES:
+        print(f"  处理规则{rule['rule_id']}：{rule['name']}...")
+        with metrics.measure(f"规则{rule['rule_id']}", rows_in=len(eligible_offers)) as record:
+            hit_pairs = pd.concat(
+                [result['affiliate_hits'][rule['rule_id']] for result in shard_results], ignore_index=True
+            ).sort_values(PAIR_ORDER_COLUMNS, ignore_index=True)
+            hit_rows = hit_pairs[['Offer ID', 'Affiliate']].merge(eligible_offers, on='Offer ID', how='left')
+            rule_frames.append(_offer_rule_rows(hit_rows, rule, hit_rows['Affiliate'].values, revenue_columns))
+            triggered_45_pairs.append(hit_pairs[['Offer ID', 'Affiliate']])
+            record['rows_out'] = len(hit_pairs)
+        print(f"  规则{rule['rule_id']}最终触发数量：{len(hit_pairs)}")
+
+    triggered_45_pairs = pd.concat(triggered_45_pairs, ignore_index=True)
+    with metrics.measure('规则6', rows_in=len(eligible_offers)) as record:
+        rule_frames.append(evaluate_rule6(
+            eligible_offers, shard_results, todo_base_data, triggered_45_pairs, latest_date_str, second_latest_date_str,
+            context.rule6_min_revenue_30d
+        ))
+        record['rows_out'] = len(rule_frames[-1])
+
+    if trace is not None:
+        with metrics.measure('Offer追踪', rows_in=len(trace.offer_ids)):
+            trace_todo_rules(
+                trace, todo_base_data, eligible_offers, affiliate_diff_index, shard_results, triggered_45_pairs,
+                revenue_columns, context
+            )
+
+    return pd.concat(rule_frames, ignore_index=True)
+
+
+# 规则6类型匹配：广告主类型 -> 可匹配的Affiliate类型
+RULE6_TYPE_COMPATIBILITY = {
+    'xdj流量': ('xdj流量', 'inapp流量/xdj流量'),
+    'xdj流量/inapp流量': ('inapp流量', 'inapp流量/xdj流量'),
+}
+
+
+def get_advertiser_type(advertiser, advertiser_type_map=ADVERTISER_TYPE_MAP):
+    """广告主类型：广告主类型映射中第一个被广告主名称包含的键对应的类型"""
+    if pd.isna(advertiser):
+        return ''
+    for adv_key, adv_type in advertiser_type_map.items():
+        if adv_key in advertiser:
+            return adv_type
+    return ''
+
+
+def build_compatible_affiliate_table(affiliate_type_map=AFFILIATE_TYPE_MAP,
+                                     type_compatibility=RULE6_TYPE_COMPATIBILITY):
+    """(广告主类型, Affiliate)兼容表，Affiliate按Affiliate类型映射中的顺序排列"""
+    rows = [
+        {'advertiser_type': adv_type, 'Affiliate': aff}
+        for adv_type, aff_types in type_compatibility.items()
+        for aff, aff_type in affiliate_type_map.items()
+        if aff_type in aff_types
+    ]
+    return pd.DataFrame(rows, columns=['advertiser_type', 'Affiliate'])
+
+
+RULE6_TODO = '历史可能未推下游，尝试push（按组合筛选最高流水）'
+RULE6_COMBO_KEYS = ['GEO', 'App ID', 'Affiliate']
+RULE6_WINNER_COLUMNS = RULE6_COMBO_KEYS + [
+    'Offer ID', 'Advertiser', 'total_revenue_30d', 'offer_pos', 'aff_pos', 'first_offer_pos', 'first_aff_pos'
+]
+
+
+def rule6_candidate_pairs(offers, context):
+    """
+    规则6的候选(Offer, Affiliate)：候选Offer按广告主类型与兼容Affiliate表连接，
+    只带键和30天流水，展示用的文本列留到选出胜出Offer后再关联；未去掉黑名单组合
+    """
+    candidates = pd.DataFrame({
+        'Offer ID': offers['Offer ID'],
+        'offer_pos': offers['offer_pos'],
+        'Advertiser': offers['Advertiser'],
+        'GEO': offers['GEO'].fillna(''),
+        'App ID': offers['App ID'].fillna(''),
+        'total_revenue_30d': offers['total_revenue']
+    })
+    advertiser_types = {
+        adv: get_advertiser_type(adv, context.advertiser_type_map) for adv in candidates['Advertiser'].unique()
+    }
+    candidates['advertiser_type'] = candidates['Advertiser'].map(advertiser_types)
+
+    compatible_affiliates = build_compatible_affiliate_table(
+        context.affiliate_type_map, context.rule6_type_compatibility
+    )
+    compatible_affiliates['aff_pos'] = np.arange(len(compatible_affiliates))
+    return candidates.merge(compatible_affiliates, on='advertiser_type', how='inner')
+
+
+def rule6_shard_winners(offers, context):
+    """
+    规则6在一个分片内的部分：候选组合去掉黑名单后，
+    每个(geo, app id, affiliate)组合保留30天流水最高的Offer（并列取靠前的Offer），
+    并记录组合在本分片中首次出现的位置，用于合并时还原整体顺序
+    """
+    candidates = rule6_candidate_pairs(offers, context)
+    candidates = candidates[~context.blacklist.mask(candidates['Advertiser'], candidates['Affiliate'])]
+    candidates = candidates.sort_values(['offer_pos', 'aff_pos'], ignore_index=True)
+    if len(candidates) == 0:
+        return pd.DataFrame(columns=RULE6_WINNER_COLUMNS), 0
+
+    grouped = candidates.groupby(RULE6_COMBO_KEYS, sort=False)
+    winners = candidates.loc[grouped['total_revenue_30d'].idxmax()]
+    first_seen = grouped[['offer_pos', 'aff_pos']].first().rename(
+        columns={'offer_pos': 'first_offer_pos', 'aff_pos': 'first_aff_pos'}
+    ).reset_index()
+    winners = winners.merge(first_seen, on=RULE6_COMBO_KEYS, how='left')
+    return winners[RULE6_WINNER_COLUMNS], len(candidates)
+
+
+def combine_rule6_winners(shard_results):
+    """
+    合并各分片每个(geo, app id, affiliate)组合的胜出Offer，再按组合取30天流水最高的Offer（并列取靠前的Offer），
+    组合按在全部候选中首次出现的顺序排列，与整体计算一致
+    """
+    shard_winners = pd.concat([result['rule6_winners'] for result in shard_results], ignore_index=True)
+    if len(shard_winners) == 0:
+        return pd.DataFrame(columns=RULE6_WINNER_COLUMNS)
+
+    # 各分片的Offer互不重叠，按候选顺序排列后取每个组合的最高流水，并列时靠前的Offer胜出
+    shard_winners = shard_winners.sort_values(['offer_pos', 'aff_pos'], ignore_index=True)
+    best_offers_by_combo = shard_winners.loc[
+        shard_winners.groupby(RULE6_COMBO_KEYS, sort=False)['total_revenue_30d'].idxmax()
+    ]
+    combo_order = shard_winners.sort_values(['first_offer_pos', 'first_aff_pos']).drop_duplicates(
+        subset=RULE6_COMBO_KEYS
+    )[RULE6_COMBO_KEYS]
+    return combo_order.merge(best_offers_by_combo, on=RULE6_COMBO_KEYS, how='left')
+
+
+def rule6_triggered_combos(triggered_45_pairs, todo_base_data):
+    """规则4/5触发的组合换算成(geo, app id, affiliate)，同组合的其他Offer也不再推荐"""
+    triggered_combos = triggered_45_pairs[['Offer ID', 'Affiliate']].merge(
+        todo_base_data[['Offer ID', 'GEO', 'App ID']], on='Offer ID', how='inner'
+    )
+    return triggered_combos.assign(
+        GEO=triggered_combos['GEO'].fillna(''), **{'App ID': triggered_combos['App ID'].fillna('')}
+    )[RULE6_COMBO_KEYS]
+
+
+def evaluate_rule6(rule6_offers, shard_results, todo_base_data, triggered_45_pairs, latest_date_str,
+                   second_latest_date_str, min_revenue_30d=RULE6_MIN_REVENUE_30D):
+    """
+    规则6：ACTIVE+预算充足+类型匹配（候选Offer与规则4/5相同，无视流水）
+    - 每个(geo, app id, affiliate)组合取30天流水最高的Offer，见combine_rule6_winners
+    - 反连接去掉规则4/5已触发的(geo, app id, affiliate)组合（整组去掉，不影响其他组合的胜出Offer）
+    - 去掉胜出Offer的30天流水低于min_revenue_30d的组合
+    """
+    print("\n=== 规则6优化：按组合筛选高流水Offer ===")
+    latest_col = f'{latest_date_str}_total_revenue'
+    second_col = f'{second_latest_date_str}_total_revenue'
+    rule6_columns = [
+        'Offer ID', 'Advertiser', 'Affiliate', 'GEO', 'App ID', '待办事项', 'influence_affiliate',
+        'total_revenue_30d', latest_col, second_col,
+        'affilate_revenue_rate_all', 'latest_affilate_revenue_rate_all', 'rule_id'
+    ]
+
+    best_offers_by_combo = combine_rule6_winners(shard_results)
+    candidate_count = sum(result['rule6_candidates'] for result in shard_results)
+
+    triggered_combos = rule6_triggered_combos(triggered_45_pairs, todo_base_data)
+    if len(best_offers_by_combo) > 0 and len(triggered_combos) > 0:
+        already_triggered = pd.MultiIndex.from_frame(best_offers_by_combo[RULE6_COMBO_KEYS]).isin(
+            pd.MultiIndex.from_frame(triggered_combos)
+        )
+        best_offers_by_combo = best_offers_by_combo[~already_triggered]
+
+    if len(best_offers_by_combo) == 0:
+        print("  规则6触发数量：0")
+        return pd.DataFrame(columns=rule6_columns)
+
+    # 过滤30天流水过低的组合
+    best_offers_by_combo = best_offers_by_combo[best_offers_by_combo['total_revenue_30d'] >= min_revenue_30d]
+    print("\n📊 规则6组合筛选结果：")
+    print(f"   - 原始候选数：{candidate_count}")
+    print(f"   - 去重后数量：{len(best_offers_by_combo)}")
+
+    rule6_rows = best_offers_by_combo.merge(
+        rule6_offers[['Offer ID', latest_col, second_col] + TODO_TEXT_COLUMNS],
+        on='Offer ID',
+        how='left'
+    ).assign(**{'待办事项': RULE6_TODO}, rule_id=6)[rule6_columns]
+    print(f"  规则6触发数量：{len(rule6_rows)}")
+
+    return rule6_rows
+
+
+# ==================== 按广告主分片并行计算 ====================
+# 规则4/5、规则6的候选与组合内最高流水、收入排序都只依赖单个广告主的数据：按广告主把数据分成若干片，
+# 每片写成Arrow IPC文件（优先放在/dev/shm），工作进程内存映射读取，避免pickle整张表；
+# 各片结果带有原始顺序列，合并后按这些列排序，与串行计算的结果和顺序一致
+SHARD_OFFER_COLUMNS = [
+    'Offer ID', 'offer_pos', 'Advertiser', 'GEO', 'App ID', 'total_revenue',
+    'affilate_revenue_rate_all', 'latest_affilate_revenue_rate_all'
+]
+SHARD_RANKING_COLUMNS = ['Time', 'Offer ID', 'Advertiser', 'Total Revenue']
+SHARD_TMP_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+_SHARD_POOLS = {}
+_SHARD_POOLS_LOCK = threading.Lock()
+
+
+def evaluate_advertiser_shard(offers, affiliate_diffs, context):
+    """
+    一个分片内的规则4/5和规则6候选：
+    - affiliate_hits：规则4、5各自命中的(Offer ID, Affiliate)组合及差值，带展开顺序列
+    - rule6_winners/rule6_candidates：规则6各组合在本分片内的胜出Offer和候选数
+    offers为候选Offer（含offer_pos），affiliate_diffs为日环比索引的平铺表
+    """
+    pairs = build_offer_affiliate_pairs(offers)
+    pairs = pairs.merge(offers[['Offer ID', 'Advertiser']], on='Offer ID', how='left')
+    pairs = pairs[~context.blacklist.mask(pairs['Advertiser'], pairs['Affiliate'])]
+    pairs = pairs.assign(Affiliate_clean=pairs['Affiliate'].str.strip().str.lower())
+    pairs = pairs.merge(affiliate_diffs, on=['Offer ID', 'Affiliate_clean'], how='left')
+
+    affiliate_hits = {
+        rule['rule_id']: pairs.loc[
+            rule['mask'](pairs['revenue_diff'], context),
+            ['Offer ID', 'Affiliate', 'revenue_diff'] + PAIR_ORDER_COLUMNS
+        ]
+        for rule in AFFILIATE_RULES
+    }
+    rule6_winners, rule6_candidates = rule6_shard_winners(offers, context)
+    return {'affiliate_hits': affiliate_hits, 'rule6_winners': rule6_winners, 'rule6_candidates': rule6_candidates}
+
+
+def partition_by_advertiser(advertisers, shard_count):
+    """
+    按广告主把行分成至多shard_count片（同一广告主只在一片中），按行数贪心均衡；
+    返回每片的布尔掩码列表，分片结果只取决于数据本身
+    """
+    keys = advertisers.fillna('').astype(str)
+    sizes = keys.value_counts()
+    order = sorted(sizes.items(), key=lambda item: (-item[1], item[0]))
+
+    bucket_rows = [0] * max(1, min(shard_count, len(order)))
+    bucket_keys = [[] for _ in bucket_rows]
+    for key, size in order:
+        target = bucket_rows.index(min(bucket_rows))
+        bucket_keys[target].append(key)
+        bucket_rows[target] += size
+    return [keys.isin(bucket).to_numpy() for bucket in bucket_keys if bucket]
+
+
+ARROW_MIXED_COLUMNS_KEY = b'offer_analysis.mixed_columns'
+
+
+def _mixed_object_columns(df):
+    """
+    混有文本和数值的对象列：如GEO、App ID为空的单元格在fillna(0)后变成整数0，
+    或App ID同时有数字的iOS ID和文本的Android包名，Arrow/Parquet无法按单一类型写入
+    """
+    return [
+        col for col in df.columns
+        if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True).startswith('mixed')
+    ]
+
+
+def frame_to_arrow(df):
+    """
+    DataFrame转为Arrow表；混合类型的对象列不转成文本，按原值pickle后放在表的元数据中，
+    arrow_to_frame读取时原样还原（包括空白GEO/App ID的0和数字App ID）
+    """
+    import pickle
+    import pyarrow as pa
+
+    mixed = _mixed_object_columns(df)
+    table = pa.Table.from_pandas(df.drop(columns=mixed), preserve_index=False)
+    if mixed:
+        payload = pickle.dumps({'columns': list(df.columns), 'values': {col: df[col].tolist() for col in mixed}})
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), ARROW_MIXED_COLUMNS_KEY: payload})
+    return table
+
+
+def arrow_to_frame(table):
+    """frame_to_arrow的逆过程"""
+    import pickle
+
+    df = table.to_pandas()
+    payload = (table.schema.metadata or {}).get(ARROW_MIXED_COLUMNS_KEY)
+    if payload is None:
+        return df
+    mixed = pickle.loads(payload)
+    for col, values in mixed['values'].items():
+        df[col] = pd.Series(values, index=df.index, dtype=object)
+    return df[mixed['columns']]
+
+
+def _write_arrow(df, path):
+    """把一张表写成Arrow IPC文件，分片计算看到的取值与串行计算完全一致，见frame_to_arrow"""
+    import pyarrow as pa
+
+    table = frame_to_arrow(df)
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def _read_arrow(path):
+    import pyarrow as pa
+
+    with pa.memory_map(path) as source:
+        return arrow_to_frame(pa.ipc.open_file(source).read_all())
+
+
+def _get_shard_pool(workers):
+    """按进程数复用的进程池；使用spawn启动，避免在多线程的Streamlit进程中fork"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    with _SHARD_POOLS_LOCK:
+        pool = _SHARD_POOLS.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _SHARD_POOLS[workers] = pool
+        return pool
+
+
+def _run_shard_task(task, paths, shared_args):
+    """工作进程入口：内存映射读取本片的各张表后执行任务"""
+    frames = {name: _read_arrow(path) for name, path in paths.items()}
+    return task(frames, *shared_args)
+
+
+def run_sharded(task, shards, shared_args, workers):
+    """
+    把每片的表写成Arrow文件后提交到进程池，task(frames, *shared_args)在工作进程中执行；
+    返回结果与shards顺序一致
+    """
+    import tempfile
+
+    with tempfile.TemporaryDirectory(prefix='offer_shards_', dir=SHARD_TMP_DIR) as tmp_dir:
+        shard_paths = []
+        for index, frames in enumerate(shards):
+            paths = {}
+            for name, df in frames.items():
+                paths[name] = os.path.join(tmp_dir, f'{index}_{name}.arrow')
+                _write_arrow(df, paths[name])
+            shard_paths.append(paths)
+
+        pool = _get_shard_pool(workers)
+        futures = [pool.submit(_run_shard_task, task, paths, shared_args) for paths in shard_paths]
+        return [future.result() for future in futures]
+
+
+def _advertiser_rule_task(frames, context):
+    return evaluate_advertiser_shard(frames['offers'], frames['affiliate_diffs'], context)
+
+
+def _revenue_ranking_task(frames, max_date):
+    return calculate_revenue_ranking(frames['cube'], max_date=max_date)
+
+
+def evaluate_advertiser_shards(eligible_offers, affiliate_diffs, context, workers=0):
+    """workers<=1时整体作为一片在当前进程计算，否则按广告主分片到进程池"""
+    offers = eligible_offers[SHARD_OFFER_COLUMNS]
+    if not workers or workers <= 1 or len(offers) == 0:
+        return [evaluate_advertiser_shard(offers, affiliate_diffs, context)]
+
+    shards = []
+    for mask in partition_by_advertiser(offers['Advertiser'], workers):
+        shard_offers = offers[mask]
+        shards.append({
+            'offers': shard_offers,
+            'affiliate_diffs': affiliate_diffs[affiliate_diffs['Offer ID'].isin(shard_offers['Offer ID'])]
+        })
+    print(f"  规则4-6按广告主分为{len(shards)}片并行计算")
+    return run_sharded(_advertiser_rule_task, shards, (context,), workers)
+
+
+def calculate_revenue_ranking_sharded(qualified_cube, workers=0):
+    """收入排序的分片版本：各片以全量数据的最大日期为基准，合并后按广告主、收入重新排序"""
+    if not workers or workers <= 1 or len(qualified_cube) == 0:
+        return calculate_revenue_ranking(qualified_cube)
+
+    max_date = pd.to_datetime(qualified_cube['Time'], errors='coerce').max()
+    shards = [
+        {'cube': qualified_cube.loc[mask, SHARD_RANKING_COLUMNS]}
+        for mask in partition_by_advertiser(qualified_cube['Advertiser'], workers)
+    ]
+    ranking = pd.concat(run_sharded(_revenue_ranking_task, shards, (max_date,), workers), ignore_index=True)
+    # 同一广告主只在一片中，多列排序是稳定的，同广告主同收入的Offer保持原来的Offer ID顺序
+    return ranking.sort_values(
+        by=['Advertiser', 'Time_Offer_Advertiser_Revenue'], ascending=[True, False], ignore_index=True
+    )
+
+
+# ==================== 增强待办事项 ====================
+TODO_SPECIFIC_COLUMNS = ['Affiliate', '待办事项', '预算空间']
+
+
+def build_enhanced_todo(todo_df, final_offer_analysis):
+    """
+    待办事项按Offer ID关联Offer分析结果（Offer ID在final_offer_analysis中唯一）：
+    - 结果保留待办事项的顺序，Offer分析的所有列在前，待办事项特有的列覆盖同名列
+    - 没有预算空间的待办事项（规则6）预算空间记为0
+    - 找不到Offer数据的待办事项保留其自身的列
+    """
+    todo_specific = todo_df[['Offer ID'] + TODO_SPECIFIC_COLUMNS]
+    offer_columns = final_offer_analysis.drop(
+        columns=[col for col in TODO_SPECIFIC_COLUMNS if col in final_offer_analysis.columns]
+    )
+    enhanced_todo_df = todo_specific.merge(
+        offer_columns, on='Offer ID', how='left', validate='many_to_one', indicator=True
+    )
+    enhanced_todo_df['预算空间'] = enhanced_todo_df['预算空间'].fillna(0).astype(int)
+
+    missing = (enhanced_todo_df.pop('_merge') == 'left_only').to_numpy()
+    if missing.any():
+        print(f"⚠️ 警告：{int(missing.sum())}条待办事项的Offer ID在final_offer_analysis中未找到，使用原始待办事项数据")
+        shared_columns = [col for col in offer_columns.columns if col in todo_df.columns and col != 'Offer ID']
+        enhanced_todo_df.loc[missing, shared_columns] = todo_df.loc[missing, shared_columns].to_numpy()
+
+    return enhanced_todo_df[list(offer_columns.columns) + TODO_SPECIFIC_COLUMNS]
+
+
+# ==================== 上传文件解析缓存 ====================
+# 以上传文件内容的哈希为键，把解析好的工作表以Parquet列式格式缓存到本地磁盘，
+# 同一份导出文件再次分析（包括其他同事上传同一份文件）时无需再用openpyxl解析
+UPLOAD_CACHE_DIR = os.environ.get(
+    'OFFER_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'offer_analysis')
+)
+UPLOAD_CACHE_MAX_BYTES = int(os.environ.get('OFFER_CACHE_MAX_MB', '2048')) * 1024 * 1024
+UPLOAD_SHEETS = ('1-all data', 'blacklist')
+
+
+def get_upload_bytes(uploaded_file):
+    """读取上传文件的全部字节（兼容Streamlit上传对象、文件路径和BytesIO）"""
+    if hasattr(uploaded_file, 'getvalue'):
+        return uploaded_file.getvalue()
+    if hasattr(uploaded_file, 'read'):
+        uploaded_file.seek(0)
+        return uploaded_file.read()
+    with open(uploaded_file, 'rb') as f:
+        return f.read()
+
+
+def upload_digest(file_bytes):
+    """上传内容的哈希值，作为缓存键"""
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def _cache_sheet_path(digest, sheet_name):
+    sheet_slug = re.sub(r'\W+', '_', sheet_name).strip('_')
+    return os.path.join(UPLOAD_CACHE_DIR, digest, f'{sheet_slug}.parquet')
+
+
+def load_cached_sheet(digest, sheet_name):
+    """从缓存读取工作表，未命中返回None；命中时刷新条目的最近使用时间"""
+    path = _cache_sheet_path(digest, sheet_name)
+    if not os.path.exists(path):
+        return None
+    try:
+        import pyarrow.parquet as pq
+
+        df = arrow_to_frame(pq.read_table(path))
+        os.utime(os.path.dirname(path))
+        return df
+    except Exception as e:
+        print(f"读取缓存失败（{sheet_name}）：{str(e)}")
+        return None
+
+
+def store_cached_sheet(digest, sheet_name, df):
+    """
+    把解析好的工作表写入缓存（先写临时文件再原子替换，避免并发会话读到半个文件）；
+    混合类型的对象列按frame_to_arrow原样保存，读取时还原
+    """
+    import pyarrow.parquet as pq
+
+    path = _cache_sheet_path(digest, sheet_name)
+    entry_dir = os.path.dirname(path)
+    # 同一进程中的多个会话线程可能同时写同一条目，临时文件名加上随机后缀
+    tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(entry_dir, exist_ok=True)
+        pq.write_table(frame_to_arrow(df), tmp_path)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        # 仍无法按列式存储的表跳过缓存，不影响分析；不留下空的缓存条目
+        print(f"写入缓存失败（{sheet_name}）：{str(e)}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if os.path.isdir(entry_dir) and not os.listdir(entry_dir):
+            os.rmdir(entry_dir)
+        return
+    evict_upload_cache()
+
+
+def evict_upload_cache(max_bytes=None):
+    """按最近使用时间淘汰缓存条目，直到总大小不超过上限"""
+    max_bytes = UPLOAD_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    if not os.path.isdir(UPLOAD_CACHE_DIR):
+        return
+    entries = []
+    for name in os.listdir(UPLOAD_CACHE_DIR):
+        entry_dir = os.path.join(UPLOAD_CACHE_DIR, name)
+        if not os.path.isdir(entry_dir):
+            continue
+        size = sum(
+            os.path.getsize(os.path.join(entry_dir, f))
+            for f in os.listdir(entry_dir)
+            if os.path.isfile(os.path.join(entry_dir, f))
+        )
+        entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry_dir in sorted(entries):
+        if total_size <= max_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= size
+
+
+def read_upload_sheets(uploaded_file, sheet_names=UPLOAD_SHEETS):
+    """
+    读取上传文件的工作表，优先使用缓存：
+    - 以文件内容哈希为键，命中时直接读取Parquet
+    - 未命中的工作表只打开一次Excel解析，并写入缓存
+    """
+    file_bytes = get_upload_bytes(uploaded_file)
+    digest = upload_digest(file_bytes)
+
+    sheets = {}
+    for sheet_name in sheet_names:
+        cached = load_cached_sheet(digest, sheet_name)
+        if cached is not None:
+            sheets[sheet_name] = cached
+
+    missing_sheets = [name for name in sheet_names if name not in sheets]
+    if missing_sheets:
+        excel_file = pd.ExcelFile(BytesIO(file_bytes))
+        for sheet_name in missing_sheets:
+            sheets[sheet_name] = excel_file.parse(sheet_name)
+            store_cached_sheet(digest, sheet_name, sheets[sheet_name])
+    else:
+        print(f"命中解析缓存：{digest[:12]}")
+
+    return sheets
+
+# ==================== 分块流式读取 ====================
+# 大文件不再一次性读入完整数据表：openpyxl只读模式逐行迭代，只保留分析用到的列，
+# 每块数据立即折叠进部分聚合，内存占用取决于聚合结果大小而不是原始行数
+STREAM_CHUNK_ROWS = 50000
+STREAM_FOLD_PARTS = 8  # 每累积多少块部分聚合折叠一次
+STREAMING_AUTO_BYTES = 20 * 1024 * 1024  # 上传文件超过该大小时界面默认开启分块读取
+
+
+def iter_sheet_chunks(file_bytes, sheet_name, columns=PIPELINE_COLUMNS, chunk_rows=STREAM_CHUNK_ROWS):
+    """逐块读取工作表，每块是只包含指定列的DataFrame"""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(BytesIO(file_bytes), read_only=True, data_only=True)
+    try:
+        rows = workbook[sheet_name].iter_rows(values_only=True)
+        header = list(next(rows, ()))
+        missing_columns = [col for col in columns if col not in header]
+        if missing_columns:
+            raise ValueError(f"工作表'{sheet_name}'缺少列：{missing_columns}")
+        positions = [header.index(col) for col in columns]
+
+        buffer = []
+        for row in rows:
+            buffer.append([row[i] if i < len(row) else None for i in positions])
+            if len(buffer) >= chunk_rows:
+                yield pd.DataFrame(buffer, columns=columns)
+                buffer = []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=columns)
+    finally:
+        workbook.close()
+
+
+def build_offer_cube_streaming(file_bytes, sheet_name='1-all data', chunk_rows=STREAM_CHUNK_ROWS):
+    """分块读取数据表并逐块折叠为聚合立方体和Offer属性表，完整原始数据从不驻留内存"""
+    cube_parts, attrs_parts = [], []
+    row_count = 0
+    for chunk in iter_sheet_chunks(file_bytes, sheet_name, chunk_rows=chunk_rows):
+        row_count += len(chunk)
+        chunk_cube, chunk_attrs = build_offer_cube(build_canonical_frame(chunk))
+        cube_parts.append(chunk_cube)
+        attrs_parts.append(chunk_attrs)
+        # 定期折叠部分聚合，避免部分结果随块数无限增长
+        if len(cube_parts) >= STREAM_FOLD_PARTS:
+            cube_parts = [merge_offer_cubes(cube_parts)]
+            attrs_parts = [merge_offer_attrs(attrs_parts)]
+
+    if not cube_parts:
+        raise ValueError(f"工作表'{sheet_name}'没有数据")
+    cube = merge_offer_cubes(cube_parts)
+    offer_attrs = merge_offer_attrs(attrs_parts)
+    print(f"分块读取完成：原始数据{row_count}行，立方体{len(cube)}行")
+    return cube, offer_attrs
+
+
+# ==================== 持久化聚合存储 ====================
+# 每天上传的都是近30天的数据，其中多数日期与前一次上传相同。增量模式下单日立方体按(数据来源, 日期, 内容哈希)
+# 保存在本地SQLite中：内容哈希未变的日期直接复用已存分区，不再聚合，只有新增或变化的日期聚合后写入；
+# 分析用的立方体（前两天对比、30天汇总、当月排名）由本次上传覆盖日期的分区拼成
+AGGREGATE_STORE_PATH = os.environ.get(
+    'OFFER_AGGREGATE_STORE',
+    os.path.join(os.path.expanduser('~'), '.local', 'share', 'offer_analysis', 'aggregates.sqlite3')
+)
+AGGREGATE_STORE_SOURCE = 'default'
+AGGREGATE_STORE_VERSION = 1  # 立方体口径变化时递增，使已存分区失效
+AGGREGATE_STORE_KEEP_SECONDS = 24 * 60 * 60  # 被同一日期的新内容取代后，旧分区保留的时长
+STORE_ROW_COLUMNS = CUBE_KEYS + CUBE_METRICS + ['day']
+AGGREGATE_STORE_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS cube_days (
+        source TEXT NOT NULL,
+        day INTEGER NOT NULL,
+        digest TEXT NOT NULL,
+        cube BLOB NOT NULL,
+        cube_rows INTEGER NOT NULL,
+        ingested_at TEXT NOT NULL,
+        used_at TEXT NOT NULL,
+        PRIMARY KEY (source, day, digest)
+    )
+    """,
+)
+
+
+def update_day_digests(digests, canonical, layout):
+    """
+    按天累积规范化数据的内容哈希（{日期编号: hashlib对象}），分块读取时逐块调用：
+    每行立方体用到的列值按文件中的先后顺序计入所在日期，各列类型和读取方式layout也计入，
+    哈希相同的日期聚合结果完全相同
+    """
+    if len(canonical) == 0:
+        return
+    rows = canonical[STORE_ROW_COLUMNS[:-1]]
+    header = f"{AGGREGATE_STORE_VERSION}|{layout}|{'|'.join(str(dtype) for dtype in rows.dtypes)}".encode()
+    row_hashes = pd.util.hash_pandas_object(rows, index=False).to_numpy()
+    days = canonical['day'].to_numpy()
+    order = np.argsort(days, kind='stable')
+    bounds = np.flatnonzero(np.diff(days[order])) + 1
+    for positions in np.split(order, bounds):
+        day = int(days[positions[0]])
+        if day not in digests:
+            digests[day] = hashlib.sha256()
+        digests[day].update(header)
+        digests[day].update(row_hashes[positions].tobytes())
+
+
+def split_cube_days(cube):
+    """立方体按day拆成单日分区：{日期编号: 单日立方体}"""
+    return {int(day): part.reset_index(drop=True) for day, part in cube.groupby('day', sort=True)}
+
+
+def _cube_to_bytes(cube):
+    import pyarrow.parquet as pq
+
+    buffer = BytesIO()
+    pq.write_table(frame_to_arrow(cube), buffer)
+    return buffer.getvalue()
+
+
+def _cube_from_bytes(data):
+    import pyarrow.parquet as pq
+
+    return arrow_to_frame(pq.read_table(BytesIO(data)))
+
+
+class AggregateStore:
+    """
+    本地聚合存储（SQLite，单个文件）：单日立方体以Parquet格式按(数据来源, 日期, 内容哈希)保存
+    - digests：某数据来源已存各日期的内容哈希
+    - sync：在一个写事务中写入新分区、读出需要复用的分区，并清理被取代超过保留时长的旧分区
+    同一日期的不同内容各存一份、按内容哈希读取，同时运行的分析不会读到其他上传的分区；每次操作使用独立连接
+    """
+
+    def __init__(self, path=None):
+        self.path = path or AGGREGATE_STORE_PATH
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            for statement in AGGREGATE_STORE_SCHEMA:
+                conn.execute(statement)
+
+    @contextmanager
+    def _connect(self):
+        import sqlite3
+
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def sources(self):
+        """已有分区的数据来源"""
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute("SELECT DISTINCT source FROM cube_days ORDER BY source")]
+
+    def digests(self, source):
+        """数据来源已存的内容哈希：{日期编号: {内容哈希, ...}}"""
+        known = {}
+        with self._connect() as conn:
+            for day, digest in conn.execute("SELECT day, digest FROM cube_days WHERE source = ?", (source,)):
+                known.setdefault(int(day), set()).add(digest)
+        return known
+
+    def sync(self, source, day_digests, partitions):
+        """
+        写入partitions（{日期编号: 单日立方体}，内容哈希取自day_digests），并读出day_digests中其余日期按哈希
+        已存的分区；返回{日期编号: 单日立方体}，读取前已被清理的日期不在其中
+        """
+        now = datetime.now()
+        used_at = now.isoformat(timespec='seconds')
+        expired_at = (now - timedelta(seconds=AGGREGATE_STORE_KEEP_SECONDS)).isoformat(timespec='seconds')
+        cubes = dict(partitions)
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            # 其他分析同时写入了相同内容时保留已有分区，只刷新使用时间
+            conn.executemany(
+                """
+                INSERT INTO cube_days (source, day, digest, cube, cube_rows, ingested_at, used_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (source, day, digest) DO UPDATE SET used_at = excluded.used_at
+                """,
+                [
+                    (source, day, day_digests[day], _cube_to_bytes(cube), len(cube), used_at, used_at)
+                    for day, cube in partitions.items()
+                ]
+            )
+            for day, digest in day_digests.items():
+                if day in partitions:
+                    continue
+                row = conn.execute(
+                    "SELECT cube FROM cube_days WHERE source = ? AND day = ? AND digest = ?", (source, day, digest)
+                ).fetchone()
+                if row is not None:
+                    cubes[day] = _cube_from_bytes(row[0])
+                    conn.execute(
+                        "UPDATE cube_days SET used_at = ? WHERE source = ? AND day = ? AND digest = ?",
+                        (used_at, source, day, digest)
+                    )
+            conn.execute(
+                """
+                DELETE FROM cube_days
+                WHERE source = ? AND used_at < ? AND EXISTS (
+                    SELECT 1 FROM cube_days AS newer
+                    WHERE newer.source = cube_days.source AND newer.day = cube_days.day
+                      AND newer.used_at > cube_days.used_at
+                )
+                """,
+                (source, expired_at)
+            )
+        return cubes
+
+
+def _held_day_rows(held, day):
+    return held[held['day'].to_numpy() == day]
+
+
+def build_offer_cube_incremental(canonical_chunks, layout, source=AGGREGATE_STORE_SOURCE, store=None):
+    """
+    增量构建聚合立方体和Offer属性表，canonical_chunks为按文件顺序的规范化数据块（整表读取时只有一块）：
+    - 逐块累积每天的内容哈希；存储中没有的日期随块聚合，已存日期的行只保留立方体用到的列，
+      读完后只聚合内容哈希变化的日期，未变的日期复用存储中的分区
+    - Offer属性表取整个文件中的第一条记录，每次从本次上传计算，不进存储
+    返回(立方体, Offer属性表, 复用的日期, 聚合写入的日期)，立方体只包含本次上传覆盖的日期
+    """
+    store = store or AggregateStore()
+    known = store.digests(source)
+    known_days = list(known)
+    digests = {}
+    cube_parts, attrs_parts, held_parts = [], [], []
+    for canonical in canonical_chunks:
+        update_day_digests(digests, canonical, layout)
+        attrs_parts.append(build_offer_attrs(canonical))
+        is_known = canonical['day'].isin(known_days).to_numpy()
+        if not is_known.any():
+            cube_parts.append(aggregate_offer_cube(canonical))
+        else:
+            if not is_known.all():
+                cube_parts.append(aggregate_offer_cube(canonical[~is_known]))
+            held_parts.append(canonical.loc[is_known, STORE_ROW_COLUMNS])
+        # 与分块读取相同，定期折叠部分结果
+        if len(cube_parts) >= STREAM_FOLD_PARTS:
+            cube_parts = [merge_offer_cubes(cube_parts)]
+        if len(attrs_parts) >= STREAM_FOLD_PARTS:
+            attrs_parts = [merge_offer_attrs(attrs_parts)]
+    if not digests:
+        raise ValueError("数据表中没有有效的Time")
+
+    offer_attrs = attrs_parts[0] if len(attrs_parts) == 1 else merge_offer_attrs(attrs_parts)
+    day_digests = {day: digest.hexdigest() for day, digest in sorted(digests.items())}
+    partitions = {}
+    if cube_parts:
+        partitions.update(split_cube_days(cube_parts[0] if len(cube_parts) == 1 else merge_offer_cubes(cube_parts)))
+    held = held_parts[0] if len(held_parts) == 1 else pd.concat(held_parts, ignore_index=True) if held_parts else None
+    reused_days = [day for day in day_digests if day_digests[day] in known.get(day, ())]
+    for day in day_digests:
+        if day not in partitions and day not in reused_days:
+            partitions[day] = aggregate_offer_cube(_held_day_rows(held, day))
+    ingested_days = sorted(partitions)
+
+    cubes = store.sync(source, day_digests, partitions)
+    # 复用的分区恰好在读取前被清理时，从保留的行重新聚合写入
+    missing = {day: aggregate_offer_cube(_held_day_rows(held, day)) for day in day_digests if day not in cubes}
+    if missing:
+        cubes.update(store.sync(source, {day: day_digests[day] for day in missing}, missing))
+        reused_days = [day for day in reused_days if day not in missing]
+        ingested_days = sorted(ingested_days + list(missing))
+
+    cube = pd.concat([cubes[day] for day in day_digests], ignore_index=True)
+    return cube, offer_attrs, reused_days, ingested_days
+
+
+def load_offer_cube(uploaded_file, streaming=False, incremental=False, store_source=None, store=None):
+    """
+    读取上传文件，返回(黑名单, 聚合立方体, Offer属性表)：
+    - 默认整表读取（走解析缓存），构建规范化数据表后再聚合
+    - streaming=True时分块读取数据表，聚合结果同样按文件内容哈希缓存
+    - incremental=True时按天与持久化聚合存储中store_source（默认AGGREGATE_STORE_SOURCE）的分区比对，
+      只聚合新增或变化的日期，见build_offer_cube_incremental
+    """
+    if incremental:
+        source = store_source or AGGREGATE_STORE_SOURCE
+        if not streaming:
+            sheets = read_upload_sheets(uploaded_file)
+            blacklist = load_blacklist_from_excel(sheets['blacklist'])
+            chunks, layout = [build_canonical_frame(sheets['1-all data'])], 'sheet'
+            del sheets
+        else:
+            blacklist = load_blacklist_from_excel(
+                read_upload_sheets(uploaded_file, sheet_names=('blacklist',))['blacklist']
+            )
+            file_bytes = get_upload_bytes(uploaded_file)
+            chunks = (build_canonical_frame(chunk) for chunk in iter_sheet_chunks(file_bytes, '1-all data'))
+            layout = f'chunks={STREAM_CHUNK_ROWS}'
+        cube, offer_attrs, reused_days, ingested_days = build_offer_cube_incremental(chunks, layout, source, store)
+        print(f"增量同步（{source}）：上传覆盖{len(reused_days) + len(ingested_days)}天，复用{len(reused_days)}天，"
+              f"聚合写入{len(ingested_days)}天{[day_to_date(day).strftime('%Y-%m-%d') for day in ingested_days]}")
+        return blacklist, cube, offer_attrs
+
+    if not streaming:
+        sheets = read_upload_sheets(uploaded_file)
+        blacklist = load_blacklist_from_excel(sheets['blacklist'])
+
+        # 构建规范化数据表后释放原始表
+        df = build_canonical_frame(sheets['1-all data'])
+        del sheets
+        print(f"规范化数据表：{len(df)}行，占用内存{frame_memory_mb(df):.1f}MB")
+        cube, offer_attrs = build_offer_cube(df)
+        print(f"原始数据行数：{len(df)}，立方体行数：{len(cube)}")
+        return blacklist, cube, offer_attrs
+
+    blacklist = load_blacklist_from_excel(read_upload_sheets(uploaded_file, sheet_names=('blacklist',))['blacklist'])
+    file_bytes = get_upload_bytes(uploaded_file)
+    digest = upload_digest(file_bytes)
+    cube = load_cached_sheet(digest, 'offer cube')
+    offer_attrs = load_cached_sheet(digest, 'offer attrs')
+    if cube is None or offer_attrs is None:
+        cube, offer_attrs = build_offer_cube_streaming(file_bytes)
+        store_cached_sheet(digest, 'offer cube', cube)
+        store_cached_sheet(digest, 'offer attrs', offer_attrs)
+    else:
+        print(f"命中聚合缓存：{digest[:12]}")
+    return blacklist, cube, offer_attrs
+
+
+def preview_upload_sheet(uploaded_file, sheet_name=0, nrows=5):
+    """
+    数据预览：默认与原界面一样预览第一个工作表；按名称预览且已缓存时直接取前几行，
+    否则只解析前几行，不读取整个文件
+    """
+    file_bytes = get_upload_bytes(uploaded_file)
+    if isinstance(sheet_name, str):
+        cached = load_cached_sheet(upload_digest(file_bytes), sheet_name)
+        if cached is not None:
+            return cached.head(nrows)
+    return pd.read_excel(BytesIO(file_bytes), sheet_name=sheet_name, nrows=nrows)
+
+
+# ==================== 性能指标 ====================
+# 每次分析记录各编号阶段和规则1-6的耗时、内存和行数，界面展示、可下载为JSON，并追加到本地指标日志，
+# 用于追踪不同日期之间的性能回退
+METRICS_LOG_PATH = os.environ.get(
+    'OFFER_METRICS_LOG',
+    os.path.join(os.path.expanduser('~'), '.local', 'share', 'offer_analysis', 'metrics.jsonl')
+)
+
+
+def _max_rss_bytes():
+    """进程最大常驻内存（字节），不支持的平台返回0"""
+    try:
+        import resource
+    except ImportError:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryTraceGate:
+    """
+    tracemalloc和ru_maxrss都是进程级的，后台执行器中的多个分析共用同一个进程：
+    低内存模式的分析独占内存统计，开始前等待进程内其他分析结束，统计期间新开始的分析等待它结束，
+    一个任务的reset_peak/stop不会清掉或关闭另一个任务的统计
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._active = 0
+        self._pending = 0   # 正在等待独占统计的低内存分析数，等待期间不再放行新的分析
+        self._tracing = False
+
+    @contextmanager
+    def scope(self, low_memory, waiting=None):
+        """
+        一次分析的内存统计范围，返回是否由本次分析开启了tracemalloc；
+        需要等待时每隔JOB_POLL_SECONDS调用一次waiting()（可抛出AnalysisCancelled中止等待）
+        """
+        with self._condition:
+            if low_memory:
+                self._pending += 1
+            try:
+                while self._active > 0 if low_memory else (self._tracing or self._pending > 0):
+                    if waiting is not None:
+                        waiting()
+                    self._condition.wait(timeout=JOB_POLL_SECONDS)
+            finally:
+                if low_memory:
+                    self._pending -= 1
+            self._active += 1
+            tracing = low_memory and not tracemalloc.is_tracing()
+            self._tracing = tracing
+        if tracing:
+            tracemalloc.start()
+        try:
+            yield tracing
+        finally:
+            if tracing:
+                tracemalloc.stop()
+            with self._condition:
+                self._active -= 1
+                if tracing:
+                    self._tracing = False
+                self._condition.notify_all()
+
+
+MEMORY_TRACE_GATE = MemoryTraceGate()
+
+
+class PipelineMetrics:
+    """
+    分析各阶段的性能记录，阶段可以嵌套（规则记录在“8. 生成待办事项”之下，level为嵌套层级）：
+    - wall_seconds/cpu_seconds：墙钟时间和当前线程的CPU时间（分片到其他进程的计算不计入CPU时间）
+    - peak_memory_delta_mb：只在本次分析开启tracemalloc时（低内存模式）记录，阶段内Python内存分配峰值相对阶段开始时的增量
+    - process_max_rss_mb：未开启tracemalloc时记录阶段结束时进程的最大常驻内存，是整个进程的最高水位，
+      包括此前的分析和其他线程，不是本阶段的增量
+    - rows_in/rows_out：阶段输入和输出的行数
+    trace_memory由开启tracemalloc的分析设置，其他分析即使tracemalloc在运行也不读取或重置它的峰值
+    """
+
+    def __init__(self):
+        self.records = []
+        self.meta = {'started_at': datetime.now().isoformat(timespec='seconds')}
+        self.trace_memory = False
+        self._open = []
+
+    def _tracing(self):
+        return self.trace_memory and tracemalloc.is_tracing()
+
+    def _memory_now(self):
+        if self._tracing():
+            return tracemalloc.get_traced_memory()[0], 'tracemalloc'
+        return _max_rss_bytes(), 'maxrss'
+
+    def _fold_peak(self):
+        """把目前为止的峰值并入所有未结束的阶段；tracemalloc的峰值随后重置，供下一个阶段单独统计"""
+        if self._tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+        else:
+            peak = _max_rss_bytes()
+        for record in self._open:
+            record['_peak'] = max(record['_peak'], peak)
+
+    def begin(self, name, rows_in=None):
+        self._fold_peak()
+        memory, memory_source = self._memory_now()
+        record = {
+            'stage': name, 'level': len(self._open), 'rows_in': rows_in, 'rows_out': None,
+            'memory_source': memory_source,
+            '_wall': time.perf_counter(), '_cpu': time.thread_time(), '_memory': memory, '_peak': memory
+        }
+        self.records.append(record)
+        self._open.append(record)
+        return record
+
+    def end(self, rows_out=None, record=None):
+        """结束record（默认为最内层的阶段）；因异常没有结束的内层阶段一并结束"""
+        record = record if record is not None else self._open[-1]
+        self._fold_peak()
+        while self._open:
+            current = self._open.pop()
+            current['wall_seconds'] = round(time.perf_counter() - current['_wall'], 4)
+            current['cpu_seconds'] = round(time.thread_time() - current['_cpu'], 4)
+            if current['memory_source'] == 'tracemalloc':
+                current['peak_memory_delta_mb'] = round(max(0, current['_peak'] - current['_memory']) / 1024 / 1024, 2)
+            else:
+                current['process_max_rss_mb'] = round(current['_peak'] / 1024 / 1024, 2)
+            if current is record:
+                break
+        if rows_out is not None:
+            record['rows_out'] = rows_out
+        return record
+
+    @contextmanager
+    def measure(self, name, rows_in=None):
+        """with块内可以设置record['rows_out']"""
+        record = self.begin(name, rows_in)
+        try:
+            yield record
+        finally:
+            self.end(record=record)
+
+    def stages(self):
+        return [{key: value for key, value in record.items() if not key.startswith('_')} for record in self.records]
+
+    def to_dict(self):
+        return {'meta': self.meta, 'stages': self.stages()}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False, indent=1, default=str)
+
+    def to_frame(self):
+        """界面展示用的表格，阶段名按层级缩进"""
+        frame = pd.DataFrame(self.stages())
+        if len(frame) > 0:
+            frame['stage'] = ['    ' * level + name for level, name in zip(frame['level'], frame['stage'])]
+            frame = frame.drop(columns=['level'])
+        return frame
+
+    def peak_memory_mb(self):
+        """整个分析的峰值内存增量（最外层阶段）；没有开启tracemalloc统计时返回None"""
+        outermost = [record for record in self.records if record['level'] == 0 and 'peak_memory_delta_mb' in record]
+        return max((record['peak_memory_delta_mb'] for record in outermost), default=None)
+
+    def process_max_rss_mb(self):
+        """未开启tracemalloc时各阶段记录到的进程最大常驻内存（进程最高水位），没有记录时返回None"""
+        return max((record['process_max_rss_mb'] for record in self.records if 'process_max_rss_mb' in record),
+                   default=None)
+
+
+def append_metrics_log(metrics, path=None):
+    """把一次分析的性能记录作为一行JSON追加到本地指标日志"""
+    path = path or METRICS_LOG_PATH
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(metrics.to_dict(), ensure_ascii=False, default=str) + '\n')
+    except OSError as e:
+        print(f"写入性能指标日志失败：{str(e)}")
+
+
+# ==================== Offer追踪 ====================
+# 按需追踪选中Offer在各条规则中的判断过程，记录预算空间、流水差值、类型匹配、黑名单命中等中间值；
+# 追踪在规则计算结束后只对选中的Offer按相同口径重算，trace为None时规则引擎不做任何额外计算
+def _plain(value):
+    """numpy标量转为Python值，NaN转为None，便于输出JSON"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def _format_amount(value):
+    return '无数据' if value is None else f"{value:.2f}"
+
+
+def parse_offer_ids(text):
+    """解析逗号、空格或换行分隔的Offer ID，忽略不是整数的部分，保持输入顺序并去重"""
+    offer_ids = []
+    for part in re.split(r'[\s,，;；]+', str(text or '')):
+        if part.isdigit() and int(part) not in offer_ids:
+            offer_ids.append(int(part))
+    return offer_ids
+
+
+class OfferTrace:
+    """
+    选中Offer的结构化追踪记录，offers[Offer ID]包含：
+    - qualification：最高日流水及是否达到筛选阈值（未达到的Offer不参与后续规则）
+    - offer：状态、预算空间、最新两天流水、所选比较口径的两个值、30天流水及广告主黑名单命中等规则输入
+    - rules：规则3、1、2是否触发；eligible_4_6：规则4-6的候选条件逐项结果
+    - affiliates：规则4/5逐个Affiliate的黑名单命中、最新两天流水、差值、所选口径的差值和结果
+    - rule6：广告主类型、可匹配的Affiliate类型，以及每个候选组合的黑名单命中、规则4/5占用、组合胜出Offer和结果
+    """
+
+    def __init__(self, offer_ids):
+        self.offer_ids = list(dict.fromkeys(int(offer_id) for offer_id in offer_ids))
+        self.offers = {offer_id: {'Offer ID': offer_id} for offer_id in self.offer_ids}
+
+    def select(self, df):
+        """df中属于追踪Offer的行"""
+        return df[df['Offer ID'].isin(self.offer_ids)]
+
+    def record(self, offer_id, section, value):
+        self.offers[int(offer_id)][section] = value
+
+    def record_qualification(self, daily_offer_revenue, threshold):
+        max_daily_revenue = self.select(daily_offer_revenue).groupby('Offer ID')['Daily_Revenue'].max()
+        for offer_id in self.offer_ids:
+            if offer_id not in max_daily_revenue.index:
+                self.record(offer_id, 'qualification', {'found': False, 'qualified': False})
+                continue
+            value = _plain(max_daily_revenue.loc[offer_id])
+            self.record(offer_id, 'qualification', {
+                'found': True, 'max_daily_revenue': value, 'threshold': threshold, 'qualified': value >= threshold
+            })
+
+    def to_dict(self):
+        return {'offers': list(self.offers.values())}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False, indent=1, default=str)
+
+    def to_text(self):
+        """逐个Offer的可读说明，命令行和界面展示用"""
+        lines = []
+        for entry in self.offers.values():
+            lines.append(f"Offer {entry['Offer ID']}")
+            qualification = entry.get('qualification', {})
+            if not qualification.get('found'):
+                lines.append("  数据中没有该Offer")
+                continue
+            lines.append(
+                f"  筛选：最高日流水{_format_amount(qualification['max_daily_revenue'])}，"
+                f"{'达到' if qualification['qualified'] else '未达到'}{qualification['threshold']}"
+            )
+            if 'offer' not in entry:
+                lines.append("  未参与规则计算")
+                continue
+
+            offer = entry['offer']
+            lines.append(
+                f"  状态{offer['Status']}，预算空间{offer['预算空间']}（caps {offer['Total caps']} - "
+                f"最新转化{offer['latest_conversions']}），最新流水{_format_amount(offer['latest_revenue'])}，"
+                f"次新流水{_format_amount(offer['second_latest_revenue'])}，30天流水{_format_amount(offer['total_revenue_30d'])}"
+            )
+            if offer.get('trend_window', 'day') != 'day':
+                lines.append(
+                    f"  比较口径{trend_window_label(offer['trend_window'])}：当前{_format_amount(offer['trend_latest'])}，"
+                    f"比较{_format_amount(offer['trend_second'])}"
+                )
+            lines.append(
+                f"  广告主{offer['Advertiser']}：固定黑名单{'命中' if offer['config_blacklisted'] else '未命中'}，"
+                f"Excel黑名单{'命中' if offer['excel_blacklisted'] else '未命中'}"
+            )
+            for rule in entry['rules']:
+                lines.append(f"  规则{rule['rule_id']}（{rule['name']}）：{'触发' if rule['triggered'] else '未触发'}")
+
+            eligible = entry['eligible_4_6']
+            if not eligible['eligible']:
+                reasons = [
+                    label for key, label in [
+                        ('status_active', '状态不是ACTIVE'), ('budget_positive', '预算空间≤0'),
+                        ('not_triggered_1_3', '已触发规则1-3'), ('advertiser_not_blacklisted', '广告主在Excel黑名单中')
+                    ] if not eligible[key]
+                ]
+                lines.append(f"  规则4-6：不是候选Offer（{'、'.join(reasons)}）")
+                continue
+
+            lines.append("  规则4/5：")
+            if not entry['affiliates']:
+                lines.append("    没有Affiliate流水占比记录")
+            for affiliate in entry['affiliates']:
+                if affiliate['blacklisted']:
+                    outcome = "黑名单组合，跳过"
+                else:
+                    fired = [f"规则{rule_id}触发" for rule_id in (4, 5) if affiliate[f'rule{rule_id}']]
+                    outcome = '、'.join(fired) or '未触发'
+                trend = ''
+                if offer.get('trend_window', 'day') != 'day':
+                    trend = f"，{trend_window_label(offer['trend_window'])}差值{_format_amount(affiliate['trend_diff'])}"
+                lines.append(
+                    f"    {affiliate['Affiliate']}：最新{_format_amount(affiliate['latest_revenue'])}，"
+                    f"次新{_format_amount(affiliate['second_latest_revenue'])}，"
+                    f"差值{_format_amount(affiliate['revenue_diff'])}{trend} → {outcome}"
+                )
+
+            rule6 = entry['rule6']
+            lines.append(
+                f"  规则6：广告主类型{rule6['advertiser_type'] or '未知'}，"
+                f"可匹配Affiliate类型{'、'.join(rule6['compatible_affiliate_types']) or '无'}"
+            )
+            for combo in rule6['combos']:
+                if combo['blacklisted']:
+                    outcome = "黑名单组合，跳过"
+                elif combo['taken_by_rule_4_5']:
+                    outcome = "组合已由规则4/5触发"
+                elif combo['winner_offer_id'] != entry['Offer ID']:
+                    outcome = f"组合由Offer {combo['winner_offer_id']}胜出（30天流水{_format_amount(combo['winner_revenue_30d'])}）"
+                elif not combo['triggered']:
+                    outcome = f"胜出但30天流水低于{rule6['min_revenue_30d']}"
+                else:
+                    outcome = "触发"
+                lines.append(f"    {combo['GEO']}_{combo['App ID']}_{combo['Affiliate']} → {outcome}")
+        return '\n'.join(lines)
+
+
+def trace_todo_rules(trace, todo_base_data, eligible_offers, affiliate_diff_index, shard_results, triggered_45_pairs,
+                     revenue_columns, context):
+    """对追踪的Offer按规则引擎相同的口径重算规则1-6并记录中间值，只处理追踪Offer的行"""
+    latest_col, second_col = revenue_columns
+    compare_latest_col, compare_second_col = offer_comparison_columns(context, latest_col, second_col)
+    latest_conversions_col = latest_col.replace('_total_revenue', '_total_conversions')
+    base = trace.select(todo_base_data)
+    config_blacklisted = context.config_blacklist.exact_advertiser_mask(base['Advertiser'])
+    excel_blacklisted = context.blacklist.mask(base['Advertiser'], '')
+    rule_hits = {
+        rule['rule_id']: (rule['mask'](base, compare_latest_col, compare_second_col) & ~config_blacklisted).to_numpy()
+        for rule in OFFER_RULES
+    }
+    eligible_ids = set(trace.select(eligible_offers)['Offer ID'])
+
+    for position in range(len(base)):
+        values = base.iloc[position]
+        offer_id = values['Offer ID']
+        trace.record(offer_id, 'offer', {
+            'Advertiser': _plain(values['Advertiser']), 'GEO': _plain(values['GEO']), 'App ID': _plain(values['App ID']),
+            'Status': _plain(values['Status']), 'Total caps': _plain(values['Total caps']),
+            'latest_conversions': _plain(values[latest_conversions_col]), '预算空间': _plain(values['预算空间']),
+            'latest_revenue': _plain(values[latest_col]), 'second_latest_revenue': _plain(values[second_col]),
+            'total_revenue_30d': _plain(values['total_revenue']),
+            'trend_window': context.trend_window,
+            'trend_latest': _plain(values[compare_latest_col]), 'trend_second': _plain(values[compare_second_col]),
+            'config_blacklisted': bool(config_blacklisted[position]),
+            'excel_blacklisted': bool(excel_blacklisted[position]),
+        })
+        trace.record(offer_id, 'rules', [
+            {'rule_id': rule['rule_id'], 'name': rule['name'], 'triggered': bool(rule_hits[rule['rule_id']][position])}
+            for rule in OFFER_RULES
+        ])
+        trace.record(offer_id, 'eligible_4_6', {
+            'status_active': str(values['Status']).upper() == 'ACTIVE',
+            'budget_positive': bool(values['预算空间'] > 0),
+            'not_triggered_1_3': not any(hits[position] for hits in rule_hits.values()),
+            'advertiser_not_blacklisted': not excel_blacklisted[position],
+            'eligible': offer_id in eligible_ids,
+        })
+
+    offers = trace.select(eligible_offers)
+    if len(offers) == 0:
+        return
+
+    # 规则4/5：展开全部Affiliate组合，黑名单组合和无流水数据的组合也保留，便于说明未触发的原因
+    traced_diffs = affiliate_diff_index[
+        affiliate_diff_index.index.get_level_values('Offer ID').isin(trace.offer_ids)
+    ].reset_index()
+    pairs = build_offer_affiliate_pairs(offers).merge(offers[['Offer ID', 'Advertiser']], on='Offer ID', how='left')
+    pairs['blacklisted'] = context.blacklist.mask(pairs['Advertiser'], pairs['Affiliate'])
+    pairs['Affiliate_clean'] = pairs['Affiliate'].str.strip().str.lower()
+    pairs = pairs.merge(traced_diffs, on=['Offer ID', 'Affiliate_clean'], how='left')
+    pairs['trend_diff'] = pairs[affiliate_comparison_column(context)]
+    for rule in AFFILIATE_RULES:
+        pairs[f"rule{rule['rule_id']}"] = ~pairs['blacklisted'] & rule['mask'](pairs['trend_diff'], context)
+    affiliate_columns = [
+        'Affiliate', 'blacklisted', 'latest_revenue', 'second_latest_revenue', 'revenue_diff', 'trend_diff',
+        'rule4', 'rule5'
+    ]
+
+    # 规则6：候选组合关联全局胜出Offer和规则4/5已触发的组合
+    candidates = rule6_candidate_pairs(offers, context)
+    candidates['blacklisted'] = context.blacklist.mask(candidates['Advertiser'], candidates['Affiliate'])
+    winners = combine_rule6_winners(shard_results)[RULE6_COMBO_KEYS + ['Offer ID', 'total_revenue_30d']]
+    candidates = candidates.merge(
+        winners.rename(columns={'Offer ID': 'winner_offer_id', 'total_revenue_30d': 'winner_revenue_30d'}),
+        on=RULE6_COMBO_KEYS, how='left'
+    )
+    triggered_combos = rule6_triggered_combos(triggered_45_pairs, todo_base_data)
+    candidates['taken_by_rule_4_5'] = (
+        pd.MultiIndex.from_frame(candidates[RULE6_COMBO_KEYS]).isin(pd.MultiIndex.from_frame(triggered_combos))
+        if len(candidates) > 0 and len(triggered_combos) > 0 else False
+    )
+    candidates['triggered'] = (
+        ~candidates['blacklisted'] & ~candidates['taken_by_rule_4_5'] &
+        (candidates['winner_offer_id'] == candidates['Offer ID']) &
+        (candidates['winner_revenue_30d'] >= context.rule6_min_revenue_30d)
+    )
+    combo_columns = RULE6_COMBO_KEYS + [
+        'blacklisted', 'taken_by_rule_4_5', 'winner_offer_id', 'winner_revenue_30d', 'triggered'
+    ]
+
+    for offer_id, advertiser in zip(offers['Offer ID'], offers['Advertiser']):
+        offer_pairs = pairs[pairs['Offer ID'] == offer_id]
+        trace.record(offer_id, 'affiliates', [
+            {col: _plain(value) for col, value in zip(affiliate_columns, row)}
+            for row in offer_pairs[affiliate_columns].itertuples(index=False)
+        ])
+        advertiser_type = get_advertiser_type(advertiser, context.advertiser_type_map)
+        offer_candidates = candidates[candidates['Offer ID'] == offer_id].sort_values('aff_pos')
+        trace.record(offer_id, 'rule6', {
+            'advertiser_type': advertiser_type,
+            'compatible_affiliate_types': list(context.rule6_type_compatibility.get(advertiser_type, ())),
+            'min_revenue_30d': context.rule6_min_revenue_30d,
+            'combos': [
+                {col: _plain(value) for col, value in zip(combo_columns, row)}
+                for row in offer_candidates[combo_columns].itertuples(index=False)
+            ],
+        })
+
+
+# ==================== 历史回填 ====================
+# 对上传数据中每一对相邻日期（前一日期, 日期）都按规则1-6计算待办事项，输出带日期列的长表：
+# 不逐日重跑整个流程，而是把逐日汇总按日期展开为滞后列（当日流水、前一日流水、截至当日的累计流水），
+# 每条规则在所有日期上一次向量化计算；每个日期的结果与只上传到该日期的数据单独分析一致
+# （Status、Total caps等Offer属性只有上传时的取值，所有日期共用）
+TODO_HISTORY_COLUMNS = [
+    '日期', '对比日期', 'Offer ID', 'Advertiser', 'App ID', 'GEO', 'Status', '预算空间', 'Affiliate', '待办事项',
+    'rule_id', 'total_revenue', 'revenue_latest', 'revenue_second_latest', 'diff_affiliate_revenue'
+]
+HISTORY_OFFER_COLUMNS = [
+    'day', 'previous_day', 'Offer ID', 'Advertiser', 'App ID', 'GEO', 'Status', '预算空间',
+    'total_revenue', 'revenue_latest', 'revenue_second_latest'
+]
+
+
+def backfill_day_pairs(all_days):
+    """回填的(日期, 前一日期)：每一对相邻日期；只有一个日期时与单次分析一致，前一日期同该日期"""
+    all_days = np.asarray(all_days)
+    if len(all_days) < 2:
+        return all_days, all_days
+    return all_days[1:], all_days[:-1]
+
+
+def build_history_offer_days(cube, offer_attrs, context, days, previous_days):
+    """
+    (Offer, 日期)长表：每个日期只保留截至该日期已达标的Offer（任意一天流水≥达标线），
+    带当日/前一日流水、截至当日的累计流水和预算空间，比较口径不是day时另带该口径的两个值（见trend_columns）；
+    同时返回达标Offer的立方体
+    """
+    all_days = np.unique(cube['day'].to_numpy())
+    daily_offer_revenue = cube.groupby(['Time', 'Offer ID'])['Total Revenue'].sum().reset_index()
+    qualifying = daily_offer_revenue[daily_offer_revenue['Total Revenue'] >= context.qualify_daily_revenue]
+    qualified_from = pd.Series(
+        to_day_number(qualifying['Time']), index=qualifying['Offer ID'].to_numpy()
+    ).groupby(level=0).min()
+    qualified_cube = cube[cube['Offer ID'].isin(qualified_from.index)]
+
+    daily = qualified_cube.groupby(['Offer ID', 'day'])[['Total Conversions', 'Total Revenue']].sum()
+    revenue = daily['Total Revenue'].unstack(fill_value=0).reindex(columns=all_days, fill_value=0)
+    conversions = daily['Total Conversions'].unstack(fill_value=0).reindex(columns=all_days, fill_value=0)
+    latest = np.searchsorted(all_days, days)
+    second = np.searchsorted(all_days, previous_days)
+    offer_ids = revenue.index.to_numpy()
+    revenue_values = revenue.to_numpy()
+
+    offer_days = pd.DataFrame({
+        'Offer ID': np.repeat(offer_ids, len(days)),
+        'day': np.tile(days, len(offer_ids)),
+        'previous_day': np.tile(previous_days, len(offer_ids)),
+        'total_revenue': revenue_values.cumsum(axis=1)[:, latest].ravel(),
+        'revenue_latest': revenue_values[:, latest].ravel(),
+        'revenue_second_latest': revenue_values[:, second].ravel(),
+        'conversions_latest': conversions.to_numpy()[:, latest].ravel(),
+    })
+    if context.trend_window != 'day':
+        trend_index, matrix, first_day = daily_revenue_matrix(qualified_cube, ['Offer ID'])
+        trend_latest, trend_second = trend_comparison(
+            matrix[trend_index.get_indexer(offer_ids)], first_day, days, previous_days, context.trend_window
+        )
+        trend_latest_col, trend_second_col = trend_columns(context.trend_window)[:2]
+        offer_days[trend_latest_col] = trend_latest.ravel()
+        offer_days[trend_second_col] = trend_second.ravel()
+    qualified = np.repeat(qualified_from.reindex(offer_ids).to_numpy(), len(days)) <= offer_days['day'].to_numpy()
+    offer_days = offer_days[qualified].merge(
+        offer_attrs.rename(columns={'Total Caps': 'Total caps'}), on='Offer ID', how='left'
+    )
+    # 与单次分析口径一致：缺失的Total caps按0计算预算空间
+    offer_days['预算空间'] = (offer_days['Total caps'].fillna(0) - offer_days['conversions_latest']).astype(int)
+    offer_days['Status'] = offer_days['Status'].fillna('')
+    return offer_days.reset_index(drop=True), qualified_cube
+
+
+def history_affiliate_pairs(qualified_cube):
+    """
+    (Offer ID, Affiliate)组合及首次出现的日期，Affiliate按流水占比文本的解析口径取名称，
+    与build_offer_affiliate_pairs一致；某日期的组合为首次出现不晚于该日期的组合
+    """
+    affiliates = qualified_cube.dropna(subset=['Affiliate'])
+    pairs = affiliates.groupby(['Offer ID', 'Affiliate'])['day'].min().reset_index(name='first_day')
+    pairs['Affiliate'] = pairs['Affiliate'].astype(str).str.split('流水').str[0].str.strip()
+    pairs = pairs[pairs['Affiliate'] != '']
+    return pairs.groupby(['Offer ID', 'Affiliate'])['first_day'].min().reset_index()
+
+
+def history_affiliate_diffs(pair_days, qualified_cube, context):
+    """
+    每个(组合, 日期)的Affiliate流水日环比：按清洗后的Affiliate查当日和前一日流水，
+    与build_affiliate_diff_index一致，有数据但两天都无流水的组合差值为0，完全没有数据的组合为NaN；
+    比较口径不是day时为该口径的差值，从逐日流水矩阵上按(组合, 日期)直接取值
+    """
+    qualified_cube = qualified_cube.assign(
+        Affiliate_clean=qualified_cube['Affiliate'].fillna('').str.strip().str.lower()
+    )
+    keys = pd.DataFrame({
+        'Offer ID': pair_days['Offer ID'].to_numpy(),
+        'Affiliate_clean': pair_days['Affiliate'].str.strip().str.lower().to_numpy(),
+        'day': pair_days['day'].to_numpy(),
+        'previous_day': pair_days['previous_day'].to_numpy()
+    })
+    if context.trend_window != 'day':
+        day_pairs = keys[['day', 'previous_day']].drop_duplicates().sort_values('day')
+        days, previous_days = day_pairs['day'].to_numpy(), day_pairs['previous_day'].to_numpy()
+        trend_index, matrix, first_day = daily_revenue_matrix(qualified_cube, ['Offer ID', 'Affiliate_clean'])
+        latest, second = trend_comparison(matrix, first_day, days, previous_days, context.trend_window)
+        rows = trend_index.get_indexer(pd.MultiIndex.from_frame(keys[['Offer ID', 'Affiliate_clean']]))
+        diff = np.full(len(keys), np.nan)
+        known = rows >= 0
+        columns = np.searchsorted(days, keys['day'].to_numpy()[known])
+        diff[known] = (latest - second)[rows[known], columns]
+        return pd.Series(diff, index=pair_days.index)
+
+    daily = qualified_cube.groupby(['Offer ID', 'Affiliate_clean', 'day'])['Total Revenue'].sum().reset_index()
+    known = daily[['Offer ID', 'Affiliate_clean']].drop_duplicates().assign(known=True)
+    keys = keys.merge(known, on=['Offer ID', 'Affiliate_clean'], how='left')
+    keys = keys.merge(
+        daily.rename(columns={'Total Revenue': 'latest'}), on=['Offer ID', 'Affiliate_clean', 'day'], how='left'
+    )
+    keys = keys.merge(
+        daily.rename(columns={'day': 'previous_day', 'Total Revenue': 'second'}),
+        on=['Offer ID', 'Affiliate_clean', 'previous_day'], how='left'
+    )
+    diff = keys['latest'].fillna(0) - keys['second'].fillna(0)
+    return pd.Series(diff.where(keys['known'].notna().to_numpy()).to_numpy(), index=pair_days.index)
+
+
+def history_rule6(eligible, triggered_45, context):
+    """
+    规则6在所有日期上一次计算：每个(日期, geo, app id, affiliate)组合取截至当日累计流水最高的候选Offer
+    （并列取Offer ID较小的，与单次分析的候选顺序一致），去掉当日规则4/5已触发的组合和累计流水过低的组合
+    """
+    candidates = eligible[HISTORY_OFFER_COLUMNS].assign(
+        GEO=eligible['GEO'].fillna(''), **{'App ID': eligible['App ID'].fillna('')}
+    )
+    advertiser_types = {
+        adv: get_advertiser_type(adv, context.advertiser_type_map) for adv in candidates['Advertiser'].unique()
+    }
+    candidates['advertiser_type'] = candidates['Advertiser'].map(advertiser_types)
+    compatible_affiliates = build_compatible_affiliate_table(
+        context.affiliate_type_map, context.rule6_type_compatibility
+    )
+    candidates = candidates.merge(compatible_affiliates, on='advertiser_type', how='inner')
+    candidates = candidates[~context.blacklist.mask(candidates['Advertiser'], candidates['Affiliate'])]
+    if len(candidates) == 0:
+        return candidates
+
+    candidates = candidates.sort_values(['day', 'Offer ID'], kind='stable', ignore_index=True)
+    combo_keys = ['day'] + RULE6_COMBO_KEYS
+    winners = candidates.loc[candidates.groupby(combo_keys, sort=False)['total_revenue'].idxmax()]
+
+    triggered_combos = triggered_45[['day', 'Offer ID', 'Affiliate']].merge(
+        eligible[['day', 'Offer ID', 'GEO', 'App ID']], on=['day', 'Offer ID'], how='inner'
+    )
+    triggered_combos = triggered_combos.assign(
+        GEO=triggered_combos['GEO'].fillna(''), **{'App ID': triggered_combos['App ID'].fillna('')}
+    )
+    if len(winners) > 0 and len(triggered_combos) > 0:
+        already_triggered = pd.MultiIndex.from_frame(winners[combo_keys]).isin(
+            pd.MultiIndex.from_frame(triggered_combos[combo_keys])
+        )
+        winners = winners[~already_triggered]
+    return winners[winners['total_revenue'] >= context.rule6_min_revenue_30d]
+
+
+def backfill_todo_history(cube, offer_attrs, context, metrics=None):
+    """
+    在聚合立方体上回填每一对相邻日期的待办事项，返回TODO_HISTORY_COLUMNS列的长表：
+    日期为该行对应的分析日期，对比日期为其前一日期；context须已包含上传文件的Excel黑名单
+    （见analyze_offer_cube）。规则优先级、黑名单和阈值与单次分析相同，同一日期内按(Offer ID, Affiliate, 待办事项)去重
+    """
+    metrics = metrics if metrics is not None else PipelineMetrics()
+    days, previous_days = backfill_day_pairs(np.unique(cube['day'].to_numpy()))
+    metrics.meta['backfill_days'] = len(days)
+
+    with metrics.measure('回填：逐日汇总', rows_in=len(cube)) as record:
+        offer_days, qualified_cube = build_history_offer_days(cube, offer_attrs, context, days, previous_days)
+        record['rows_out'] = len(offer_days)
+
+    frames = []
+    compare_latest_col, compare_second_col = offer_comparison_columns(context, 'revenue_latest', 'revenue_second_latest')
+    triggered_123 = np.zeros(len(offer_days), dtype=bool)
+    advertiser_blacklisted = context.config_blacklist.exact_advertiser_mask(offer_days['Advertiser'])
+    for rule in OFFER_RULES:
+        with metrics.measure(f"回填：规则{rule['rule_id']}", rows_in=len(offer_days)) as record:
+            hit = rule['mask'](offer_days, compare_latest_col, compare_second_col).to_numpy() & ~advertiser_blacklisted
+            frames.append(offer_days.loc[hit, HISTORY_OFFER_COLUMNS].assign(
+                Affiliate='', **{'待办事项': rule['todo']}, rule_id=rule['rule_id']
+            ))
+            triggered_123 |= hit
+            record['rows_out'] = int(hit.sum())
+
+    # 规则4-6共用的候选：ACTIVE+预算>0，当日未触发规则1-3，广告主不在黑名单
+    eligible = offer_days[
+        _is_status(offer_days, 'ACTIVE').to_numpy() &
+        (offer_days['预算空间'] > 0).to_numpy() &
+        ~triggered_123 &
+        ~context.blacklist.mask(offer_days['Advertiser'], '')
+    ]
+
+    with metrics.measure('回填：规则4-5', rows_in=len(eligible)) as record:
+        pair_days = eligible[HISTORY_OFFER_COLUMNS].merge(
+            history_affiliate_pairs(qualified_cube), on='Offer ID', how='inner'
+        )
+        pair_days = pair_days[pair_days['first_day'] <= pair_days['day']].drop(columns='first_day')
+        pair_days = pair_days[~context.blacklist.mask(pair_days['Advertiser'], pair_days['Affiliate'])]
+        diff = history_affiliate_diffs(pair_days, qualified_cube, context)
+        triggered_45 = []
+        for rule in AFFILIATE_RULES:
+            hit = rule['mask'](diff, context).to_numpy()
+            triggered_45.append(pair_days[hit].assign(
+                **{'待办事项': rule['todo']}, rule_id=rule['rule_id'], diff_affiliate_revenue=diff[hit]
+            ))
+        frames += triggered_45
+        triggered_45 = pd.concat(triggered_45, ignore_index=True)
+        record['rows_out'] = len(triggered_45)
+
+    with metrics.measure('回填：规则6', rows_in=len(eligible)) as record:
+        rule6_rows = history_rule6(eligible, triggered_45, context)
+        frames.append(rule6_rows[HISTORY_OFFER_COLUMNS + ['Affiliate']].assign(
+            **{'待办事项': RULE6_TODO}, rule_id=6
+        ))
+        record['rows_out'] = len(rule6_rows)
+
+    history = pd.concat(frames, ignore_index=True)
+    history = history.drop_duplicates(subset=['day', 'Offer ID', 'Affiliate', '待办事项'])
+    history = history.sort_values(['day', 'Advertiser', 'Offer ID', 'rule_id'], kind='stable', ignore_index=True)
+    history['日期'] = pd.to_datetime(history['day'].astype(np.int64), unit='D')
+    history['对比日期'] = pd.to_datetime(history['previous_day'].astype(np.int64), unit='D')
+    return history.reindex(columns=TODO_HISTORY_COLUMNS)
+
+
+def backfill_offer_data(uploaded_file, context=None, streaming=False, incremental=False, store_source=None,
+                        metrics=None):
+    """读取上传文件并回填每一天的待办事项历史，读取失败时返回None；参数含义同process_offer_data_web"""
+    if context is None:
+        context = RunContext.from_module_config()
+    try:
+        blacklist, cube, offer_attrs = load_offer_cube(
+            uploaded_file, streaming=streaming, incremental=incremental, store_source=store_source
+        )
+        if len(cube) == 0:
+            raise ValueError("数据表中没有有效的Time")
+    except Exception as e:
+        print(f"读取数据失败：{str(e)}")
+        return None
+    return backfill_todo_history(cube, offer_attrs, context.with_blacklist(blacklist), metrics)
+
+
+def todo_history_filename(history):
+    """待办历史的默认文件名"""
+    last_date = history['日期'].max() if len(history) > 0 else pd.Timestamp.today()
+    return f"offer_todo_history_{last_date.strftime('%Y%m%d')}.xlsx"
+
+
+# ==================== 待办事项存储 ====================
+# 每次分析的待办事项按(日期, Offer ID, Affiliate, 待办事项)写入本地SQLite，
+# 与前一个已记录日期对比得到新增/持续/已解决的变化，同事在界面上更新的处理进度随持续的待办事项逐日带到下一天
+TODO_STORE_PATH = os.environ.get(
+    'OFFER_TODO_STORE',
+    os.path.join(os.path.expanduser('~'), '.local', 'share', 'offer_analysis', 'todos.sqlite3')
+)
+TODO_STATUSES = ('待处理', '处理中', '已完成', '无需处理')
+TODO_CHANGES = ('新增', '持续', '已解决')
+TODO_KEY_COLUMNS = ['date', 'offer_id', 'affiliate', 'todo']
+TODO_VALUE_COLUMNS = [
+    'rule_id', 'advertiser', 'app_id', 'geo', 'status_offer', 'budget',
+    'total_revenue', 'revenue_latest', 'revenue_second_latest', 'diff_affiliate_revenue'
+]
+# 待办事项历史的列 -> 存储的列
+TODO_STORE_FIELDS = {
+    '日期': 'date', 'Offer ID': 'offer_id', 'Affiliate': 'affiliate', '待办事项': 'todo', 'rule_id': 'rule_id',
+    'Advertiser': 'advertiser', 'App ID': 'app_id', 'GEO': 'geo', 'Status': 'status_offer', '预算空间': 'budget',
+    'total_revenue': 'total_revenue', 'revenue_latest': 'revenue_latest',
+    'revenue_second_latest': 'revenue_second_latest', 'diff_affiliate_revenue': 'diff_affiliate_revenue'
+}
+# 存储的列 -> 界面显示的列名
+TODO_STORE_LABELS = {
+    **{column: label for label, column in TODO_STORE_FIELDS.items()},
+    'first_seen': '首次出现', 'age_days': '持续天数', 'status': '处理进度', 'note': '备注',
+    'updated_at': '更新时间', 'resolved_at': '已解决时间', 'change': '变化'
+}
+TODO_STORE_SCHEMA = (
+    # 待办事项文本很长且只有几种，单独存一份，待办事项表和各索引中只存编号
+    "CREATE TABLE IF NOT EXISTS todo_texts (todo_id INTEGER PRIMARY KEY, todo TEXT NOT NULL UNIQUE)",
+    f"""
+    CREATE TABLE IF NOT EXISTS todo_items (
+        date TEXT NOT NULL,
+        offer_id INTEGER NOT NULL,
+        affiliate TEXT NOT NULL,
+        todo_id INTEGER NOT NULL REFERENCES todo_texts (todo_id),
+        rule_id INTEGER,
+        advertiser TEXT,
+        app_id TEXT,
+        geo TEXT,
+        status_offer TEXT,
+        budget INTEGER,
+        total_revenue REAL,
+        revenue_latest REAL,
+        revenue_second_latest REAL,
+        diff_affiliate_revenue REAL,
+        first_seen TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT '{TODO_STATUSES[0]}',
+        note TEXT NOT NULL DEFAULT '',
+        updated_at TEXT NOT NULL,
+        resolved_at TEXT,
+        PRIMARY KEY (date, offer_id, affiliate, todo_id)
+    ) WITHOUT ROWID
+    """,
+    # 按日期（含持续天数）的查询走主键，按广告主/Affiliate/处理进度的查询走以下索引
+    "CREATE INDEX IF NOT EXISTS idx_todo_advertiser ON todo_items (advertiser, date)",
+    "CREATE INDEX IF NOT EXISTS idx_todo_affiliate ON todo_items (affiliate, date)",
+    "CREATE INDEX IF NOT EXISTS idx_todo_status ON todo_items (status, date)",
+    "CREATE VIEW IF NOT EXISTS todo_items_view AS "
+    "SELECT todo_items.*, todo_texts.todo FROM todo_items JOIN todo_texts USING (todo_id)",
+)
+TODO_SELECT_COLUMNS = (
+    TODO_KEY_COLUMNS + TODO_VALUE_COLUMNS + ['first_seen', 'status', 'note', 'updated_at', 'resolved_at']
+)
+
+
+def todo_rule_ids(todos):
+    """待办事项文本对应的规则编号（1-6），不是规则产生的文本为NaN"""
+    rule_by_todo = {rule['todo']: rule['rule_id'] for rule in OFFER_RULES + AFFILIATE_RULES}
+    rule_by_todo[RULE6_TODO] = 6
+    return todos.map(rule_by_todo)
+
+
+def result_todo_history(enhanced_todo_df, latest_date):
+    """
+    单次分析的enhanced_todo_df转为待办事项历史的格式（TODO_HISTORY_COLUMNS），日期为latest_date：
+    带日期前缀的流水列依次为最新、次新一天，对比日期取自次新一天的列名
+    """
+    date_columns = [
+        col for col in enhanced_todo_df.columns if col.endswith('_total_revenue') and col != 'total_revenue'
+    ]
+    latest_col = date_columns[0] if date_columns else None
+    second_col = date_columns[1] if len(date_columns) > 1 else latest_col
+    second_date = pd.to_datetime(second_col[:-len('_total_revenue')]) if second_col else pd.Timestamp(latest_date)
+
+    history = enhanced_todo_df.assign(**{
+        '日期': pd.Timestamp(latest_date),
+        '对比日期': second_date,
+        'Affiliate': enhanced_todo_df['Affiliate'].fillna(''),
+        'rule_id': todo_rule_ids(enhanced_todo_df['待办事项']),
+        'revenue_latest': enhanced_todo_df[latest_col] if latest_col else np.nan,
+        'revenue_second_latest': enhanced_todo_df[second_col] if second_col else np.nan,
+        'diff_affiliate_revenue': np.nan,
+    })
+    return history.reindex(columns=TODO_HISTORY_COLUMNS)
+
+
+class TodoStore:
+    """
+    本地待办事项存储（SQLite，单个文件）：
+    - upsert：按日期批量插入或更新待办事项，不删除已有记录：同一日期再次分析（其他同事上传、重新导出的文件）时，
+      本次没有出现的待办事项保留处理进度和备注，记下resolved_at标记为已解决，再次出现时清除；
+      与前一个已记录日期相同的待办事项沿用其首次出现日期、处理进度和备注
+    - delta：某日期相对前一个已记录日期的新增/持续/已解决
+    - update_statuses：更新处理进度和备注
+    - query：按广告主、Affiliate、处理进度、持续天数和日期范围查询，都走索引
+    每次操作使用独立连接，多个会话的线程可以同时读写
+    """
+
+    def __init__(self, path=None):
+        self.path = path or TODO_STORE_PATH
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            for statement in TODO_STORE_SCHEMA:
+                conn.execute(statement)
+            # 早期版本创建的存储没有resolved_at列
+            if 'resolved_at' not in {row[1] for row in conn.execute("PRAGMA table_info(todo_items)")}:
+                conn.execute("ALTER TABLE todo_items ADD COLUMN resolved_at TEXT")
+
+    @contextmanager
+    def _connect(self):
+        import sqlite3
+
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _frame(self, sql, params=()):
+        with self._connect() as conn:
+            cursor = conn.execute(sql, params)
+            columns = [description[0] for description in cursor.description]
+            return pd.DataFrame(cursor.fetchall(), columns=columns)
+
+    def dates(self):
+        """已记录的日期（YYYY-MM-DD），升序"""
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute("SELECT DISTINCT date FROM todo_items ORDER BY date")]
+
+    def previous_date(self, date):
+        """早于date的最近一个已记录日期，没有时返回None"""
+        with self._connect() as conn:
+            return conn.execute("SELECT MAX(date) FROM todo_items WHERE date < ?", (str(date),)).fetchone()[0]
+
+    @staticmethod
+    def _records(history):
+        """待办事项历史转为按日期分组的写入记录，列顺序为TODO_KEY_COLUMNS + TODO_VALUE_COLUMNS"""
+        frame = history[list(TODO_STORE_FIELDS)].rename(columns=TODO_STORE_FIELDS)
+        frame = frame.assign(
+            date=pd.to_datetime(frame['date']).dt.strftime('%Y-%m-%d'),
+            offer_id=pd.to_numeric(frame['offer_id'], errors='coerce'),
+            affiliate=frame['affiliate'].fillna('').astype(str)
+        ).dropna(subset=['offer_id'])
+        frame['offer_id'] = frame['offer_id'].astype(np.int64)
+        frame = frame.drop_duplicates(subset=TODO_KEY_COLUMNS)
+        # 与Excel导出相同，整块转换为Python对象，空值写为NULL
+        records = frame[TODO_KEY_COLUMNS + TODO_VALUE_COLUMNS].astype(object)
+        records = records.where(records.notna(), None)
+        for date, day_records in records.groupby(frame['date'].to_numpy(), sort=True):
+            yield date, list(day_records.itertuples(index=False, name=None))
+
+    def upsert(self, history):
+        """
+        批量写入待办事项历史（TODO_HISTORY_COLUMNS格式，见backfill_todo_history和result_todo_history），
+        在一个事务中按日期先后逐日写入，返回写入的行数
+        """
+        columns = TODO_KEY_COLUMNS + TODO_VALUE_COLUMNS
+        stored_columns = ['date', 'offer_id', 'affiliate', 'todo_id'] + TODO_VALUE_COLUMNS
+        placeholders = ', '.join('?' for _ in columns)
+        updated_at = datetime.now().isoformat(timespec='seconds')
+        written = 0
+        with self._connect() as conn:
+            conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS todo_staging ({', '.join(columns)}, todo_id INTEGER)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS temp.idx_staging_key ON todo_staging (offer_id, affiliate, todo_id)"
+            )
+            for date, records in self._records(history):
+                conn.execute("DELETE FROM todo_staging")
+                conn.executemany(f"INSERT INTO todo_staging ({', '.join(columns)}) VALUES ({placeholders})", records)
+                conn.execute("INSERT OR IGNORE INTO todo_texts (todo) SELECT DISTINCT todo FROM todo_staging")
+                conn.execute(
+                    "UPDATE todo_staging SET todo_id = (SELECT todo_id FROM todo_texts t WHERE t.todo = todo_staging.todo)"
+                )
+                previous = conn.execute("SELECT MAX(date) FROM todo_items WHERE date < ?", (date,)).fetchone()[0]
+                # 本日期已有但本次没有出现的待办事项不删除，标记为已解决；其余的插入或更新（保留已有的处理进度和备注）
+                conn.execute(
+                    "UPDATE todo_items SET resolved_at = ? WHERE date = ? AND resolved_at IS NULL AND NOT EXISTS ("
+                    " SELECT 1 FROM todo_staging s WHERE s.offer_id = todo_items.offer_id"
+                    " AND s.affiliate = todo_items.affiliate AND s.todo_id = todo_items.todo_id)",
+                    (updated_at, date)
+                )
+                conn.execute(
+                    f"INSERT INTO todo_items ({', '.join(stored_columns)}, first_seen, status, note, updated_at) "
+                    f"SELECT {', '.join('s.' + col for col in stored_columns)}, "
+                    f"COALESCE(prev.first_seen, s.date), COALESCE(prev.status, ?), COALESCE(prev.note, ''), ? "
+                    f"FROM todo_staging s LEFT JOIN todo_items prev ON prev.date = ? AND prev.offer_id = s.offer_id "
+                    f"AND prev.affiliate = s.affiliate AND prev.todo_id = s.todo_id "
+                    f"WHERE true "
+                    f"ON CONFLICT (date, offer_id, affiliate, todo_id) DO UPDATE SET "
+                    + ', '.join(f"{col} = excluded.{col}" for col in TODO_VALUE_COLUMNS + ['first_seen', 'updated_at'])
+                    + ", resolved_at = NULL",
+                    (TODO_STATUSES[0], updated_at, previous)
+                )
+                written += len(records)
+        return written
+
+    def record_result(self, enhanced_todo_df, latest_date):
+        """写入一次分析的待办事项（日期为latest_date），返回写入的行数"""
+        return self.upsert(result_todo_history(enhanced_todo_df, latest_date))
+
+    def delta(self, date=None):
+        """
+        date（默认最新已记录日期）相对前一个已记录日期的变化，change列为新增/持续/已解决：
+        已解决的待办事项是前一日期未解决、本日期没有记录的待办事项，以及本日期被后来的分析标记为已解决的记录；
+        age_days为截至所在日期的持续天数（首次出现当天为0）
+        """
+        date = str(date) if date is not None else (self.dates() or [None])[-1]
+        columns = ', '.join(f"{{table}}.{col}" for col in TODO_SELECT_COLUMNS)
+        key_match = ' AND '.join(f"other.{col} = {{table}}.{col}" for col in ['offer_id', 'affiliate', 'todo_id'])
+        age = "CAST(julianday({table}.date) - julianday({table}.first_seen) AS INTEGER) AS age_days"
+        previous = self.previous_date(date) if date is not None else None
+        sql = (
+            f"SELECT {columns.format(table='cur')}, {age.format(table='cur')}, "
+            f"CASE WHEN cur.resolved_at IS NOT NULL THEN '{TODO_CHANGES[2]}' "
+            f"WHEN EXISTS (SELECT 1 FROM todo_items other WHERE other.date = :previous AND other.resolved_at IS NULL "
+            f"AND {key_match.format(table='cur')}) THEN '{TODO_CHANGES[1]}' ELSE '{TODO_CHANGES[0]}' END AS change "
+            f"FROM todo_items_view cur WHERE cur.date = :date "
+            f"UNION ALL "
+            f"SELECT {columns.format(table='prev')}, {age.format(table='prev')}, '{TODO_CHANGES[2]}' AS change "
+            f"FROM todo_items_view prev WHERE prev.date = :previous AND prev.resolved_at IS NULL AND NOT EXISTS ("
+            f"SELECT 1 FROM todo_items other WHERE other.date = :date AND {key_match.format(table='prev')})"
+        )
+        return self._frame(sql, {'date': date, 'previous': previous})
+
+    def update_statuses(self, updates):
+        """
+        更新处理进度和备注，updates为含TODO_KEY_COLUMNS和status、note列的DataFrame；
+        status不在TODO_STATUSES中时抛出ValueError，返回更新的行数
+        """
+        invalid = set(updates['status']) - set(TODO_STATUSES)
+        if invalid:
+            raise ValueError(f"未知的处理进度：{'、'.join(map(str, sorted(invalid)))}")
+        updated_at = datetime.now().isoformat(timespec='seconds')
+        rows = [
+            (status, note if isinstance(note, str) else '', updated_at,
+             str(date), int(offer_id), str(affiliate), str(todo))
+            for date, offer_id, affiliate, todo, status, note in updates[
+                TODO_KEY_COLUMNS + ['status', 'note']
+            ].itertuples(index=False, name=None)
+        ]
+        with self._connect() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "UPDATE todo_items SET status = ?, note = ?, updated_at = ? "
+                "WHERE date = ? AND offer_id = ? AND affiliate = ? "
+                "AND todo_id = (SELECT todo_id FROM todo_texts WHERE todo = ?)",
+                rows
+            )
+            return conn.total_changes - before
+
+    def query(self, advertiser=None, affiliate=None, status=None, min_age_days=None, start_date=None,
+              end_date=None, limit=None):
+        """按条件查询待办事项记录（条件为None时不限制），按日期倒序；持续天数按首次出现日期计算"""
+        conditions, params = [], []
+        for column, value in (('advertiser', advertiser), ('affiliate', affiliate), ('status', status)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if start_date is not None:
+            conditions.append("date >= ?")
+            params.append(str(start_date))
+        if end_date is not None:
+            conditions.append("date <= ?")
+            params.append(str(end_date))
+        if min_age_days is not None:
+            conditions.append("first_seen <= date(date, ?)")
+            params.append(f"-{int(min_age_days)} days")
+        sql = (
+            f"SELECT {', '.join(TODO_SELECT_COLUMNS)}, "
+            f"CAST(julianday(date) - julianday(first_seen) AS INTEGER) AS age_days FROM todo_items_view"
+            + (f" WHERE {' AND '.join(conditions)}" if conditions else '')
+            + " ORDER BY date DESC, advertiser, offer_id"
+            + (f" LIMIT {int(limit)}" if limit else '')
+        )
+        return self._frame(sql, params)
+
+
+# ==================== 多维汇总 ====================
+# 导出报告附带的汇总表：工作表名 -> 分组维度。不在立方体中的维度（GEO、App ID）按Offer ID取Offer属性，
+# 增加一个维度只需在这里加一项
+ROLLUP_SHEETS = {
+    'Advertiser汇总': ['Advertiser'],
+    'Affiliate汇总': ['Affiliate'],
+    'GEO汇总': ['GEO'],
+    'Advertiser×Affiliate汇总': ['Advertiser', 'Affiliate'],
+}
+
+
+def _group_sum(group_codes, group_count, values):
+    """按分组号累加，整数列的结果保持整数"""
+    sums = np.bincount(group_codes, weights=values, minlength=group_count)
+    return sums.astype(np.int64) if np.issubdtype(values.dtype, np.integer) else sums
+
+
+def build_rollups(cube, offer_attrs, grouping_sets=ROLLUP_SHEETS):
+    """
+    在聚合立方体上按grouping_sets生成多维汇总表，返回{工作表名: DataFrame}，相当于一次GROUPING SETS：
+    - 立方体只扫描一次：所有维度的并集编码为分组号，每个指标拆为全部日期、最新一天、次新一天三列后按分组累加
+    - 各维度组合再从这张小得多的汇总表上累加，增加维度不再扫描立方体
+    汇总覆盖上传数据中的全部Offer（与在原始数据表上做透视表一致），列名与Offer Analysis相同，
+    另加最新两天的流水差值和变化率；维度为空的记为空白，按全部日期的流水从高到低排序
+    """
+    all_days = np.unique(cube['day'].to_numpy())
+    latest_day = all_days[-1]
+    second_latest_day = all_days[-2] if len(all_days) >= 2 else all_days[0]
+    latest_date_str = day_to_date(latest_day).strftime("%Y/%m/%d")
+    second_latest_date_str = day_to_date(second_latest_day).strftime("%Y/%m/%d")
+    is_latest = (cube['day'] == latest_day).to_numpy()
+    is_second = (cube['day'] == second_latest_day).to_numpy()
+
+    keys = list(dict.fromkeys(key for dimensions in grouping_sets.values() for key in dimensions))
+    attributes = offer_attrs.set_index('Offer ID')
+    base_codes, base_keys = encode_groups([
+        (cube[key] if key in cube.columns else cube['Offer ID'].map(attributes[key])).fillna('').astype(str).to_numpy()
+        for key in keys
+    ])
+    base_count = len(base_keys[0])
+    base_values = {}
+    for metric in CUBE_METRICS:
+        values = cube[metric].to_numpy()
+        column = metric.lower().replace(' ', '_')
+        base_values[column] = _group_sum(base_codes, base_count, values)
+        base_values[f'{latest_date_str}_{column}'] = _group_sum(base_codes, base_count, np.where(is_latest, values, 0))
+        base_values[f'{second_latest_date_str}_{column}'] = _group_sum(
+            base_codes, base_count, np.where(is_second, values, 0)
+        )
+
+    latest_col = f'{latest_date_str}_total_revenue'
+    second_col = f'{second_latest_date_str}_total_revenue'
+    rollups = {}
+    for sheet_name, dimensions in grouping_sets.items():
+        group_codes, group_keys = encode_groups([base_keys[keys.index(dimension)] for dimension in dimensions])
+        rollup = pd.DataFrame({
+            **dict(zip(dimensions, group_keys)),
+            **{column: _group_sum(group_codes, len(group_keys[0]), values) for column, values in base_values.items()}
+        })
+        rollup['revenue_diff'] = rollup[latest_col] - rollup[second_col]
+        rollup['revenue_change_rate'] = np.where(
+            rollup[second_col] > 0,
+            rollup['revenue_diff'] / rollup[second_col].where(rollup[second_col] > 0),
+            np.where(rollup[latest_col] > 0, 1, 0)
+        ).round(4)
+        rollups[sheet_name] = rollup.sort_values('total_revenue', ascending=False, kind='stable', ignore_index=True)
+    return rollups
+
+
+# ==================== 核心处理函数 ====================
+class AnalysisCancelled(Exception):
+    """分析任务在阶段之间被取消"""
+
+
+class AnalysisAggregates:
+    """
+    第1阶段读取得到的聚合立方体、Offer属性和Excel黑名单：调整阈值时在此基础上只重新计算2-9阶段，
+    不再读取和解析上传文件
+    """
+
+    def __init__(self):
+        self.cube = None
+        self.offer_attrs = None
+        self.blacklist = None
+
+    def update(self, cube, offer_attrs, blacklist):
+        self.cube = cube
+        self.offer_attrs = offer_attrs
+        self.blacklist = blacklist
+
+    @property
+    def ready(self):
+        return self.cube is not None
+
+    def memory_bytes(self):
+        if not self.ready:
+            return 0
+        return int(self.cube.memory_usage(deep=True).sum() + self.offer_attrs.memory_usage(deep=True).sum())
+
+
+def reanalyze_aggregates(aggregates, context, metrics=None):
+    """
+    按新的运行上下文（阈值）在保留的聚合数据上重新计算2-9阶段（筛选、汇总、规则和排序），
+    跳过读取和聚合上传文件的第1阶段，返回与process_offer_data_web相同的结果
+    """
+    return analyze_offer_cube(
+        aggregates.cube, aggregates.offer_attrs, context.with_blacklist(aggregates.blacklist), metrics=metrics
+    )
+
+
+def backfill_aggregates(aggregates, context, metrics=None):
+    """按运行上下文在保留的聚合数据上回填每一天的待办事项历史，见backfill_todo_history"""
+    return backfill_todo_history(
+        aggregates.cube, aggregates.offer_attrs, context.with_blacklist(aggregates.blacklist), metrics
+    )
+
+
+def todo_counts_by_rule(todo_df):
+    """待办事项按规则1-6计数（按待办事项文本对应规则）"""
+    counts = todo_rule_ids(todo_df['待办事项']).value_counts() if len(todo_df) > 0 else pd.Series(dtype=int)
+    return {rule_id: int(counts.get(rule_id, 0)) for rule_id in range(1, 7)}
+
+
+def make_progress_reporter(progress_bar=None, status_text=None):
+    """把Streamlit进度条和状态文本包装为进度回调progress(百分比, 提示文本)"""
+    def report(percent, message):
+        if progress_bar and status_text:
+            progress_bar.progress(percent)
+            status_text.text(message)
+    return report
+
+
+def process_offer_data_web(uploaded_file, progress_bar=None, status_text=None, low_memory=False, streaming=False,
+                           incremental=False, store_source=None, context=None, progress=None, workers=0, metrics=None,
+                           trace=None, aggregates=None):
+    """
+    网页版处理函数，基于原脚本逻辑
+    low_memory=True时记录整个分析过程的峰值内存并输出
+    streaming=True时分块读取数据表，不在内存中保留完整的原始数据
+    incremental=True时按天同步持久化聚合存储中store_source的分区，只聚合新增或变化的日期
+    context为运行上下文（阈值、类型映射），默认按模块配置创建；上传文件中的黑名单会替换其中的黑名单
+    progress为进度回调progress(百分比, 提示文本)，在每个编号阶段开始时调用，可抛出AnalysisCancelled中止分析；
+    未提供时使用progress_bar/status_text
+    workers>1时规则4-6和收入排序按广告主分片到多个进程计算
+    metrics为PipelineMetrics，记录各阶段和各规则的耗时、内存和行数；每次分析结束后追加到本地指标日志
+    trace为OfferTrace时记录选中Offer在筛选和各条规则中的判断过程，默认不追踪
+    aggregates为AnalysisAggregates时保留第1阶段的聚合数据，供调整阈值后用reanalyze_aggregates重新计算
+    """
+    if context is None:
+        context = RunContext.from_module_config()
+    if progress is None:
+        progress = make_progress_reporter(progress_bar, status_text)
+    if metrics is None:
+        metrics = PipelineMetrics()
+    metrics.meta.update(low_memory=low_memory, streaming=streaming, incremental=incremental, workers=workers)
+    if incremental:
+        metrics.meta['store_source'] = store_source or AGGREGATE_STORE_SOURCE
+
+    result = None
+    try:
+        waiting = (lambda: progress(5, "⏳ 低内存模式需要单独统计内存，等待进程内其他分析结束...")) if low_memory else None
+        with MEMORY_TRACE_GATE.scope(low_memory, waiting) as tracing:
+            metrics.trace_memory = tracing
+            with metrics.measure('总计'):
+                result = _process_offer_data(
+                    uploaded_file, progress, streaming, incremental, store_source, context, workers, metrics, trace,
+                    aggregates
+                )
+    finally:
+        metrics.meta['status'] = 'done' if result is not None else 'failed'
+        append_metrics_log(metrics)
+
+    peak_mb = metrics.peak_memory_mb()
+    if low_memory and peak_mb is not None:
+        print(f"峰值内存：{peak_mb:.1f}MB")
+        if result is not None:
+            progress(100, f"🎉 处理完成！峰值内存：{peak_mb:.1f}MB")
+    return result
+
+
+def _process_offer_data(uploaded_file, progress, streaming, incremental, store_source, context, workers, metrics, trace,
+                        aggregates):
+    # 更新进度
+    progress(10, "📁 正在读取Excel文件...")
+
+    metrics.begin('1. 读取数据并构建聚合立方体')
+    try:
+        # 读取上传的文件并压缩为聚合立方体，后续各阶段只扫描立方体
+        print("\n=== 1. 读取数据并构建聚合立方体 ===")
+        blacklist, cube, offer_attrs = load_offer_cube(
+            uploaded_file, streaming=streaming, incremental=incremental, store_source=store_source
+        )
+        if len(cube) == 0:
+            raise ValueError("数据表中没有有效的Time")
+    except Exception as e:
+        print(f"读取数据失败：{str(e)}")
+        return None
+    metrics.end(rows_out=len(cube))
+    if aggregates is not None:
+        aggregates.update(cube, offer_attrs, blacklist)
+
+    return analyze_offer_cube(
+        cube, offer_attrs, context.with_blacklist(blacklist), progress, workers, metrics, trace
+    )
+
+
+def analyze_offer_cube(cube, offer_attrs, context, progress=None, workers=0, metrics=None, trace=None):
+    """
+    在聚合立方体上执行2-9阶段（筛选、汇总、规则和排序），返回(final_offer_analysis, enhanced_todo_df, latest_date)；
+    context须已包含上传文件的Excel黑名单。阈值调整时直接在保留的立方体上调用，不再读取上传文件
+    """
+    progress = progress or (lambda percent, message: None)
+    metrics = metrics if metrics is not None else PipelineMetrics()
+
+    # 提取最新两天日期
+    all_days = np.unique(cube['day'].to_numpy())
+    all_dates = [day_to_date(day) for day in all_days]
+    print(f"数据包含的唯一日期列表：{all_dates}")
+    print(f"数据时间范围：{all_dates[0]} 至 {all_dates[-1]}")
+
+    if len(all_days) >= 2:
+        latest_day = all_days[-1]
+        second_latest_day = all_days[-2]
+    else:
+        latest_day = all_days[0]
+        second_latest_day = all_days[0]
+    latest_date = day_to_date(latest_day)
+    second_latest_date = day_to_date(second_latest_day)
+    if len(all_days) >= 2:
+        print(f"提取到最新两天日期：{second_latest_date}（次新）、{latest_date}（最新）")
+    else:
+        print(f"⚠️ 数据仅包含1个日期：{latest_date}，次新日期默认同最新日期")
+
+    latest_date_str = latest_date.strftime("%Y/%m/%d")
+    second_latest_date_str = second_latest_date.strftime("%Y/%m/%d")
+    metrics.meta['latest_date'] = latest_date.isoformat()
+
+    # 2. 筛选符合条件的Offer ID
+    progress(30, "🔍 正在筛选符合条件的Offer...")
+    print("\n=== 2. 筛选符合条件的Offer ID ===")
+    metrics.begin('2. 筛选符合条件的Offer ID', rows_in=len(cube))
+    daily_offer_revenue = cube.groupby(['Time', 'Offer ID'])['Total Revenue'].sum().reset_index()
+    daily_offer_revenue.columns = ['Time', 'Offer ID', 'Daily_Revenue']
+    qualified_offer_ids = daily_offer_revenue[daily_offer_revenue['Daily_Revenue'] >= context.qualify_daily_revenue]['Offer ID'].unique()
+    qualified_cube = cube[cube['Offer ID'].isin(qualified_offer_ids)]
+    print(f"符合条件的Offer ID数量：{len(qualified_offer_ids)}")
+    if trace is not None:
+        trace.record_qualification(daily_offer_revenue, context.qualify_daily_revenue)
+    metrics.end(rows_out=len(qualified_cube))
+
+    # 3. 计算Offer核心汇总指标
+    progress(40, "🧮 正在计算Offer汇总指标...")
+    print("\n=== 3. 计算Offer汇总指标 ===")
+    metrics.begin('3. 计算Offer汇总指标', rows_in=len(qualified_cube))
+    offer_summary = qualified_cube.groupby('Offer ID')[CUBE_METRICS].sum().reset_index()
+    offer_summary = offer_summary.merge(offer_attrs, on='Offer ID', how='left')
+
+    offer_summary.columns = [
+        'Offer ID', 'total_clicks', 'total_conversions',
+        'total_revenue', 'total_profit', 'Advertiser',
+        'App ID', 'GEO', 'Total caps', 'Status'
+    ]
+
+    metrics.end(rows_out=len(offer_summary))
+
+    # 4. 按Affiliate计算收入占比
+    progress(50, "📊 正在计算Affiliate收入占比...")
+    print("\n=== 4. 计算Affiliate收入占比 ===")
+    metrics.begin('4. 计算Affiliate收入占比', rows_in=len(qualified_cube))
+    affiliate_revenue = qualified_cube.groupby(['Offer ID', 'Affiliate'])['Total Revenue'].sum().reset_index()
+    affiliate_revenue.columns = ['Offer ID', 'Affiliate', 'affilate_revenue']
+    
+    affiliate_revenue = affiliate_revenue.merge(
+        offer_summary[['Offer ID', 'total_revenue']], 
+        on='Offer ID', 
+        how='left'
+    )
+
+    affiliate_revenue['affilate_revenue_rate'] = np.where(
+        affiliate_revenue['affilate_revenue'] > 0,
+        (affiliate_revenue['affilate_revenue'] / affiliate_revenue['total_revenue']).round(4),
+        0
+    )
+
+    affiliate_revenue['affilate_revenue_rate_str'] = affiliate_revenue['affilate_revenue_rate'].apply(
+        lambda x: f"{x:.2%}" if x > 0 else "0.00%"
+    )
+
+    affiliate_revenue['affilate_revenue_text'] = (
+        affiliate_revenue['Affiliate'] + "流水占比：" + 
+        affiliate_revenue['affilate_revenue'].round(2).astype(str) + "美金" + 
+        affiliate_revenue['affilate_revenue_rate_str']
+    )
+
+    affiliate_summary = affiliate_revenue.sort_values(
+        by=['Offer ID', 'affilate_revenue_rate'], 
+        ascending=[True, False]
+    ).groupby('Offer ID')['affilate_revenue_text'].agg(
+        lambda x: '\n'.join(x)
+    ).reset_index()
+    affiliate_summary.columns = ['Offer ID', 'affilate_revenue_rate_all']
+
+    metrics.end(rows_out=len(affiliate_summary))
+
+    # 5. 计算最新两天分别的数据
+    progress(60, "📅 正在计算最新两天数据...")
+    print("\n=== 5. 计算最新两天数据 ===")
+    metrics.begin('5. 计算最新两天数据', rows_in=len(qualified_cube))
+    latest_day_cube = qualified_cube[qualified_cube['day'] == latest_day]
+    latest_summary = latest_day_cube.groupby('Offer ID')[CUBE_METRICS].sum().reset_index()
+    
+    latest_fields = [
+        f'{latest_date_str}_total_clicks', 
+        f'{latest_date_str}_total_conversions', 
+        f'{latest_date_str}_total_revenue', 
+        f'{latest_date_str}_total_profit'
+    ]
+    latest_summary.columns = ['Offer ID'] + latest_fields
+    
+    second_day_cube = qualified_cube[qualified_cube['day'] == second_latest_day]
+    second_summary = second_day_cube.groupby('Offer ID')[CUBE_METRICS].sum().reset_index()
+    
+    second_fields = [
+        f'{second_latest_date_str}_total_clicks', 
+        f'{second_latest_date_str}_total_conversions', 
+        f'{second_latest_date_str}_total_revenue', 
+        f'{second_latest_date_str}_total_profit'
+    ]
+    second_summary.columns = ['Offer ID'] + second_fields
+
+    metrics.end(rows_out=len(latest_summary) + len(second_summary))
+
+    # 6. 最新一天Affiliate分析
+    progress(70, "🔎 正在分析最新一天Affiliate波动...")
+    print("\n=== 6. 最新一天Affiliate分析 ===")
+    metrics.begin('6. 最新一天Affiliate分析', rows_in=len(latest_day_cube) + len(second_day_cube))
+    latest_affiliate_summary = pd.DataFrame({'Offer ID': offer_summary['Offer ID'], 'latest_affilate_revenue_rate_all': ''})
+    if len(latest_day_cube) > 0:
+        latest_affiliate_revenue = latest_day_cube.groupby(['Offer ID', 'Affiliate'])['Total Revenue'].sum().reset_index()
+        latest_affiliate_revenue.columns = ['Offer ID', 'Affiliate', 'latest_affilate_revenue']
+
+        latest_offer_total = latest_summary[['Offer ID', f'{latest_date_str}_total_revenue']]
+        latest_offer_total.columns = ['Offer ID', 'latest_total_revenue']
+        
+        latest_affiliate_revenue = latest_affiliate_revenue.merge(latest_offer_total, on='Offer ID', how='left')
+        latest_affiliate_revenue['latest_affilate_revenue_rate'] = np.where(
+            (latest_affiliate_revenue['latest_affilate_revenue'] > 0) & 
+            (latest_affiliate_revenue['latest_total_revenue'] > 0),
+            (latest_affiliate_revenue['latest_affilate_revenue'] / latest_affiliate_revenue['latest_total_revenue']).round(4),
+            0
+        )
+
+        latest_affiliate_revenue['latest_affilate_revenue_rate_str'] = latest_affiliate_revenue['latest_affilate_revenue_rate'].apply(
+            lambda x: f"{x:.2%}" if x > 0 else "0.00%"
+        )
+
+        latest_affiliate_revenue['latest_affiliate_text'] = (
+            latest_affiliate_revenue['Affiliate'] + "流水占比：" + 
+            latest_affiliate_revenue['latest_affilate_revenue'].round(2).astype(str) + "美金" + 
+            latest_affiliate_revenue['latest_affilate_revenue_rate_str']
+        )
+
+        latest_affiliate_summary = latest_affiliate_revenue.sort_values(
+            by=['Offer ID', 'latest_affilate_revenue_rate'], 
+            ascending=[True, False]
+        ).groupby('Offer ID')['latest_affiliate_text'].agg(lambda x: '\n'.join(x)).reset_index()
+        latest_affiliate_summary.columns = ['Offer ID', 'latest_affilate_revenue_rate_all']
+
+        # ==================== 新增：计算每个Affiliate波动的原因 ====================
+        # 1. 计算Affiliate两天的流水/点击/转化数据
+        # 最新日期Affiliate数据（点击+转化+流水）
+        latest_aff_full = latest_day_cube.groupby(['Offer ID', 'Affiliate']).agg({
+            'Total Clicks': 'sum',
+            'Total Conversions': 'sum',
+            'Total Revenue': 'sum'
+        }).reset_index()
+        latest_aff_full.columns = ['Offer ID', 'Affiliate', 'clicks_latest', 'conversions_latest', 'revenue_latest']
+        
+        # 次新日期Affiliate数据
+        second_aff_full = second_day_cube.groupby(['Offer ID', 'Affiliate']).agg({
+            'Total Clicks': 'sum',
+            'Total Conversions': 'sum',
+            'Total Revenue': 'sum'
+        }).reset_index()
+        second_aff_full.columns = ['Offer ID', 'Affiliate', 'clicks_second', 'conversions_second', 'revenue_second_latest']
+        
+        # 合并两天数据
+        affiliate_revenue_diff = latest_aff_full.merge(
+            second_aff_full, 
+            on=['Offer ID', 'Affiliate'], 
+            how='outer'
+        ).fillna(0)
+        
+        # 2. 计算差值和变化率
+        # 流水差值
+        affiliate_revenue_diff['diff_affiliate_revenue'] = affiliate_revenue_diff['revenue_latest'] - affiliate_revenue_diff['revenue_second_latest']
+        affiliate_revenue_diff['diff_affiliate_abs'] = abs(affiliate_revenue_diff['diff_affiliate_revenue'])
+        
+        # 流水变化率（避免除0）
+        affiliate_revenue_diff['revenue_change_rate'] = np.where(
+            affiliate_revenue_diff['revenue_second_latest'] > 0,
+            affiliate_revenue_diff['diff_affiliate_revenue'] / affiliate_revenue_diff['revenue_second_latest'],
+            np.where(affiliate_revenue_diff['revenue_latest'] > 0, 1, 0)
+        )
+        
+        # 点击变化率
+        affiliate_revenue_diff['clicks_change_rate'] = np.where(
+            affiliate_revenue_diff['clicks_second'] > 0,
+            (affiliate_revenue_diff['clicks_latest'] - affiliate_revenue_diff['clicks_second']) / affiliate_revenue_diff['clicks_second'],
+            np.where(affiliate_revenue_diff['clicks_latest'] > 0, 1, 0)
+        )
+        
+        # CR（转化/点击）和CR变化
+        affiliate_revenue_diff['cr_latest'] = np.where(
+            affiliate_revenue_diff['clicks_latest'] > 0,
+            affiliate_revenue_diff['conversions_latest'] / affiliate_revenue_diff['clicks_latest'],
+            0
+        )
+        affiliate_revenue_diff['cr_second'] = np.where(
+            affiliate_revenue_diff['clicks_second'] > 0,
+            affiliate_revenue_diff['conversions_second'] / affiliate_revenue_diff['clicks_second'],
+            0
+        )
+        affiliate_revenue_diff['cr_change'] = affiliate_revenue_diff['cr_latest'] - affiliate_revenue_diff['cr_second']
+        
+        # 3. 筛选显著影响的Affiliate
+        significant_diff = affiliate_revenue_diff[affiliate_revenue_diff['diff_affiliate_abs'] >= context.affiliate_diff_threshold]
+        
+        if len(significant_diff) > 0:
+            significant_diff = significant_diff.sort_values(
+                by=['Offer ID', 'diff_affiliate_revenue'],
+                ascending=[True, True],
+                ignore_index=True
+            )
+
+            def generate_influence_text(row):
+                revenue_latest = float(row['revenue_latest'])
+                revenue_second = float(row['revenue_second_latest'])
+                diff_revenue = float(row['diff_affiliate_revenue'])
+                
+                if revenue_latest > 0 and revenue_second == 0:
+                    return f"{row['Affiliate']}新增流水{round(revenue_latest, 2)}美金"
+                
+                elif revenue_latest == 0 and revenue_second > 0:
+                    return f"{row['Affiliate']}停止产生流水，减少流水{round(revenue_second, 2)}美金"
+                
+                else:
+                    if diff_revenue < 0:
+                        revenue_abs = abs(diff_revenue)
+                        revenue_text = f"减少流水{round(revenue_abs, 2)}美金"
+                        revenue_rate = abs(float(row['revenue_change_rate']))
+                        revenue_rate_text = f"{round(revenue_rate * 100, 1)}%" if revenue_rate > 0 else "0.0%"
+                        full_revenue_text = f"{row['Affiliate']}{revenue_text}/{revenue_rate_text}"
+                    else:
+                        revenue_text = f"增加流水{round(diff_revenue, 2)}美金"
+                        revenue_rate = float(row['revenue_change_rate'])
+                        revenue_rate_text = f"{round(revenue_rate * 100, 1)}%" if revenue_rate > 0 else "0.0%"
+                        full_revenue_text = f"{row['Affiliate']}{revenue_text}/{revenue_rate_text}"
+                    
+                    clicks_rate = float(row['clicks_change_rate'])
+                    clicks_abs_rate = abs(clicks_rate)
+                    if clicks_rate > 0:
+                        clicks_text = f"Total Clicks增加{round(clicks_abs_rate * 100, 1)}%"
+                    elif clicks_rate < 0:
+                        clicks_text = f"Total Clicks减少{round(clicks_abs_rate * 100, 1)}%"
+                    else:
+                        clicks_text = "Total Clicks无变化"
+                    
+                    cr_change = float(row['cr_change'])
+                    cr_abs_change = abs(cr_change)
+                    if cr_change > 0:
+                        cr_text = f"CR增加{round(cr_abs_change * 100, 1)}%"
+                    elif cr_change < 0:
+                        cr_text = f"CR减少{round(cr_abs_change * 100, 1)}%"
+                    else:
+                        cr_text = "CR无变化"
+                    
+                    return f"{full_revenue_text}，对应{clicks_text}，{cr_text}"
+            
+            significant_diff['influence_text'] = significant_diff.apply(generate_influence_text, axis=1)
+
+            def aggregate_affiliate_text(group):
+                return '\n'.join(group['influence_text'].tolist())
+            
+            influence_affiliate_temp = significant_diff.groupby('Offer ID').apply(
+                aggregate_affiliate_text
+            ).reset_index(name='influence_affiliate')
+            
+            influence_affiliate_summary = offer_summary[['Offer ID']].merge(
+                influence_affiliate_temp, on='Offer ID', how='left'
+            ).fillna({'influence_affiliate': ''})
+    
+    # 无显著影响规则应用
+    high_diff_offers = offer_summary[
+        abs(offer_summary['total_revenue'] - offer_summary['total_revenue'].shift(1)) >= context.offer_diff_threshold
+    ]['Offer ID'].tolist() if 'total_revenue' in offer_summary.columns else []
+    affiliate_diff_data = affiliate_revenue_diff if 'affiliate_revenue_diff' in locals() else pd.DataFrame()
+    
+    # 高差异Offer中，所有Affiliate波动都未达到阈值的视为无显著影响
+    no_significant_impact_offers = []
+    if len(affiliate_diff_data) > 0:
+        max_aff_diff = affiliate_diff_data.groupby('Offer ID')['diff_affiliate_abs'].max()
+        no_significant_impact_offers = max_aff_diff[
+            max_aff_diff.index.isin(high_diff_offers) & (max_aff_diff < context.affiliate_diff_threshold)
+        ].index.tolist()
+
+    # 填充无显著影响文本
+    if 'influence_affiliate_summary' in locals():
+        influence_affiliate_summary.loc[
+            influence_affiliate_summary['Offer ID'].isin(no_significant_impact_offers), 'influence_affiliate'
+        ] = '无显著影响'
+    else:
+        # 初始化空的波动分析结果
+        influence_affiliate_summary = pd.DataFrame({'Offer ID': offer_summary['Offer ID'], 'influence_affiliate': ''})
+    # ==================== 新增结束 ====================
+    metrics.end(rows_out=len(influence_affiliate_summary))
+
+    # 8. 生成待办事项
+    progress(80, "✅ 正在生成待办事项...")
+    print("\n=== 8. 生成待办事项 ===")
+    metrics.begin('8. 生成待办事项', rows_in=len(offer_summary))
+    todo_base_data = offer_summary.merge(affiliate_summary, on='Offer ID', how='left').fillna({'affilate_revenue_rate_all': ''})
+    todo_base_data = todo_base_data.merge(latest_summary, on='Offer ID', how='left').fillna(0)
+    todo_base_data = todo_base_data.merge(second_summary, on='Offer ID', how='left').fillna(0)
+    todo_base_data = todo_base_data.merge(latest_affiliate_summary, on='Offer ID', how='left').fillna({'latest_affilate_revenue_rate_all': ''})
+    # 合并波动分析结果到待办数据
+    todo_base_data = todo_base_data.merge(influence_affiliate_summary, on='Offer ID', how='left').fillna({'influence_affiliate': ''})
+    
+    todo_base_data['预算空间'] = np.where(
+        (todo_base_data['Total caps'].notna()) & (todo_base_data[f'{latest_date_str}_total_conversions'].notna()),
+        todo_base_data['Total caps'] - todo_base_data[f'{latest_date_str}_total_conversions'],
+        0
+    ).astype(int)
+    
+    # Affiliate日环比索引，规则4/5直接查表
+    affiliate_diff_index = build_affiliate_diff_index(qualified_cube, latest_day, second_latest_day)
+
+    # 比较口径不是day时，Offer和Affiliate组合的各滚动窗口流水，规则按所选口径比较
+    offer_trends = None
+    if context.trend_window != 'day':
+        with metrics.measure('滚动窗口', rows_in=len(qualified_cube)) as record:
+            trend_windows = context.trend_window_options()[1:]
+            offer_trends = build_trend_table(
+                qualified_cube, ['Offer ID'], latest_day, second_latest_day, trend_windows
+            )
+            todo_base_data = todo_base_data.merge(offer_trends, left_on='Offer ID', right_index=True, how='left')
+            pair_cube = qualified_cube[['Offer ID', 'day', 'Total Revenue']].assign(
+                Affiliate_clean=qualified_cube['Affiliate'].fillna('').str.strip().str.lower()
+            )
+            affiliate_diff_index = affiliate_diff_index.join(build_trend_table(
+                pair_cube, ['Offer ID', 'Affiliate_clean'], latest_day, second_latest_day, trend_windows
+            ))
+            record['rows_out'] = len(offer_trends) + len(affiliate_diff_index)
+
+    todo_df = evaluate_todo_rules(
+        todo_base_data, affiliate_diff_index, latest_date_str, second_latest_date_str, context, workers, metrics,
+        trace
+    )
+
+    # 去重
+    todo_df = todo_df.drop_duplicates(subset=['Offer ID', 'Affiliate', '待办事项'])
+    print(f"\n✅ 待办事项总计：{len(todo_df)}条")
+    metrics.end(rows_out=len(todo_df))
+
+    # 9. 生成最终Excel
+    progress(90, "📝 正在整理分析结果...")
+    print("\n=== 9. 生成Excel文件 ===")
+    metrics.begin('9. 生成Excel文件', rows_in=len(todo_df))
+    final_offer_analysis = offer_summary.merge(affiliate_summary, on='Offer ID', how='left').fillna({'affilate_revenue_rate_all': ''})
+    final_offer_analysis = final_offer_analysis.merge(latest_summary, on='Offer ID', how='left').fillna(0)
+    final_offer_analysis = final_offer_analysis.merge(second_summary, on='Offer ID', how='left').fillna(0)
+    final_offer_analysis = final_offer_analysis.merge(latest_affiliate_summary, on='Offer ID', how='left').fillna({'latest_affilate_revenue_rate_all': ''})
+    final_offer_analysis = final_offer_analysis.merge(influence_affiliate_summary, on='Offer ID', how='left').fillna({'influence_affiliate': ''})
+    if offer_trends is not None:
+        final_offer_analysis = final_offer_analysis.merge(offer_trends, left_on='Offer ID', right_index=True, how='left')
+    
+    # 定义final_offer_analysis的列顺序
+    final_offer_analysis_columns = [
+        'Offer ID', 'Advertiser', 'App ID', 'GEO', 
+        'total_clicks', 'total_conversions', 'total_revenue', 'total_profit',
+        'Total caps', 'Status', 'affilate_revenue_rate_all',
+        f'{latest_date_str}_total_clicks', f'{latest_date_str}_total_conversions', 
+        f'{latest_date_str}_total_revenue', f'{latest_date_str}_total_profit',
+        f'{second_latest_date_str}_total_clicks', f'{second_latest_date_str}_total_conversions', 
+        f'{second_latest_date_str}_total_revenue', f'{second_latest_date_str}_total_profit',
+        'latest_affilate_revenue_rate_all', 'influence_affiliate'
+    ]
+    
+    # 重新排列final_offer_analysis的列顺序
+    existing_columns = [col for col in final_offer_analysis_columns if col in final_offer_analysis.columns]
+    extra_columns = [col for col in final_offer_analysis.columns if col not in final_offer_analysis_columns]
+    final_offer_analysis = final_offer_analysis[existing_columns + extra_columns]
+    
+    # 创建增强的待办事项列表：按Offer ID一次关联final_offer_analysis的所有列，
+    # 待办事项特有的列覆盖可能存在的同名列
+    enhanced_todo_df = build_enhanced_todo(todo_df, final_offer_analysis)
+
+    # 定义enhanced_todo_df的列顺序
+    enhanced_todo_columns = existing_columns + ['Affiliate', '待办事项', '预算空间'] + extra_columns
+    existing_enhanced_columns = [col for col in enhanced_todo_columns if col in enhanced_todo_df.columns]
+    enhanced_todo_df = enhanced_todo_df[existing_enhanced_columns]
+
+    # 去重
+    enhanced_todo_df = enhanced_todo_df.drop_duplicates(subset=['Offer ID', 'Affiliate', '待办事项'])
+
+    with metrics.measure('收入排序', rows_in=len(qualified_cube)) as record:
+        revenue_ranking_df = calculate_revenue_ranking_sharded(qualified_cube, workers)
+        record['rows_out'] = len(revenue_ranking_df)
+
+    
+    final_offer_analysis = final_offer_analysis.merge(
+        revenue_ranking_df[['Offer ID','Advertiser','Advertiser_Rank']],
+        on=['Offer ID','Advertiser'],
+        how='left'
+    )
+
+    enhanced_todo_df = enhanced_todo_df.merge(
+        revenue_ranking_df[['Offer ID','Advertiser','Advertiser_Rank']],
+        on=['Offer ID','Advertiser'],
+        how='left'
+    )
+    sort_columns = ['Advertiser', 'Advertiser_Rank']
+    sort_ascending = [True, True]
+    
+    # 排序两个数据集，ignore_index=True 重置行索引，导出Excel更整洁
+    final_offer_analysis = final_offer_analysis.sort_values(
+        by=sort_columns,
+        ascending=sort_ascending,
+        ignore_index=True
+    )
+    
+    enhanced_todo_df = enhanced_todo_df.sort_values(
+        by=sort_columns,
+        ascending=sort_ascending,
+        ignore_index=True
+    )       
+    metrics.end(rows_out=len(enhanced_todo_df))
+    progress(100, "🎉 处理完成！")
+
+    return final_offer_analysis, enhanced_todo_df, latest_date
+    
+
+# ==================== 分析结果缓存 ====================
+# 多位同事上传同一份导出文件时直接复用结果：键为(上传内容哈希, 运行配置哈希, 结果版本)，
+# 值为分析结果、导出的Excel内容和调整阈值用的聚合数据；按内存占用上限做LRU淘汰，配置变化后键不同，旧结果自然不再命中
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('OFFER_RESULT_CACHE_MB', '512')) * 1024 * 1024
+RESULT_CACHE_VERSION = 1  # 分析口径变化时递增，使旧结果失效
+
+
+def result_cache_key(file_bytes, context):
+    return (upload_digest(file_bytes), context.config_digest(), RESULT_CACHE_VERSION)
+
+
+class AnalysisResultCache:
+    """按内存占用上限淘汰的LRU结果缓存，线程安全"""
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = RESULT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self._entries = OrderedDict()  # 键 -> {'result', 'export_bytes', 'aggregates', 'size'}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _entry_size(result, export_bytes, aggregates):
+        final_offer_analysis, todo_df, _ = result
+        size = final_offer_analysis.memory_usage(deep=True).sum() + todo_df.memory_usage(deep=True).sum()
+        size += aggregates.memory_bytes() if aggregates is not None else 0
+        return int(size) + (len(export_bytes) if export_bytes else 0)
+
+    def get(self, key):
+        """返回(分析结果, 导出内容或None, 聚合数据或None)，未命中返回None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry['result'], entry['export_bytes'], entry['aggregates']
+
+    def put(self, key, result, export_bytes=None, aggregates=None):
+        size = self._entry_size(result, export_bytes, aggregates)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = {
+                'result': result, 'export_bytes': export_bytes, 'aggregates': aggregates, 'size': size
+            }
+            self._total_bytes += size
+            self._evict()
+
+    def attach_export(self, key, export_bytes):
+        """导出内容生成后补充到已缓存的结果上"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['export_bytes'] is not None:
+                return
+        self.put(key, entry['result'], export_bytes, entry['aggregates'])
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= entry['size']
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._total_bytes -= entry['size']
+
+
+# ==================== 后台分析任务 ====================
+# 分析提交到有界线程池中执行，不占用Streamlit脚本线程：界面切换标签等重跑不会丢弃正在进行的分析，
+# 截止前同时提交的分析排队执行；每个会话只保留最近一次提交的任务
+ANALYSIS_MAX_WORKERS = int(os.environ.get('OFFER_ANALYSIS_WORKERS', '2'))
+ANALYSIS_JOB_TTL_SECONDS = 2 * 60 * 60  # 已结束任务的结果保留时长
+JOB_POLL_SECONDS = 0.5
+WHAT_IF_MAX_RESULTS = 8  # 每个任务保留的阈值调整结果数
+
+
+class AnalysisJob:
+    """
+    一次后台分析任务：
+    - status：queued（排队中）/ running / done / failed / cancelled
+    - percent/message由分析各阶段的进度回调更新，result为process_offer_data_web的返回值
+    - context为提交时的运行上下文；aggregates保留聚合数据，result_for按调整后的阈值只重新计算2-9阶段，
+      todo_history在同一份聚合数据上回填每一天的待办事项，rollups为导出报告附带的多维汇总表
+    - todo_store为写入了本次待办事项的TodoStore，未记录时为None
+    """
+
+    def __init__(self, session_id, file_name=''):
+        self.job_id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.file_name = file_name
+        self.status = 'queued'
+        self.percent = 0
+        self.message = '⏳ 排队中...'
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.future = None
+        self._cancel_event = threading.Event()
+        self._export_bytes = None
+        self._export_lock = threading.Lock()
+        self.cache_key = None
+        self.result_cache = None
+        self.metrics = None
+        self.trace = None
+        self.context = None
+        self.aggregates = None
+        self._what_if = OrderedDict()  # 配置哈希 -> {'result', 'export_bytes'}
+        self._histories = OrderedDict()  # 配置哈希 -> {'history', 'export_bytes'}
+        self._rollups = None
+        self.record_todos = False
+        self.todo_store = None
+        self._what_if_lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def report(self, percent, message):
+        """进度回调：记录进度；已请求取消时抛出AnalysisCancelled，在阶段之间中止分析"""
+        if self._cancel_event.is_set():
+            raise AnalysisCancelled(self.job_id)
+        self.percent = percent
+        self.message = message
+
+    def cancel(self):
+        """请求取消：排队中的任务直接取消，运行中的任务在下一个阶段开始时中止"""
+        self._cancel_event.set()
+        if self.future is not None and self.future.cancel():
+            self._finish('cancelled')
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_event.is_set()
+
+    def is_submitted_config(self, context):
+        return context is None or context.config_digest() == self.context.config_digest()
+
+    def result_for(self, context=None):
+        """
+        按context的阈值返回分析结果：与提交时的配置相同直接返回result，
+        否则在保留的聚合数据上只重新计算2-9阶段（每个配置只计算一次）；没有聚合数据时返回None
+        """
+        if self.is_submitted_config(context):
+            return self.result
+        if self.aggregates is None or not self.aggregates.ready:
+            return None
+        return self._what_if_entry(context)['result']
+
+    def _what_if_entry(self, context):
+        key = context.config_digest()
+        with self._what_if_lock:
+            entry = self._what_if.get(key)
+            if entry is None:
+                entry = {'result': reanalyze_aggregates(self.aggregates, context), 'export_bytes': None}
+                self._what_if[key] = entry
+                while len(self._what_if) > WHAT_IF_MAX_RESULTS:
+                    self._what_if.popitem(last=False)
+            self._what_if.move_to_end(key)
+            return entry
+
+    def _history_entry(self, context):
+        key = (context or self.context).config_digest()
+        with self._what_if_lock:
+            entry = self._histories.get(key)
+            if entry is None:
+                entry = {'history': backfill_aggregates(self.aggregates, context or self.context), 'export_bytes': None}
+                self._histories[key] = entry
+                while len(self._histories) > WHAT_IF_MAX_RESULTS:
+                    self._histories.popitem(last=False)
+            self._histories.move_to_end(key)
+            return entry
+
+    def rollups(self):
+        """多维汇总表（与阈值无关，只计算一次）；没有聚合数据时返回None"""
+        if self.aggregates is None or not self.aggregates.ready:
+            return None
+        with self._what_if_lock:
+            if self._rollups is None:
+                self._rollups = build_rollups(self.aggregates.cube, self.aggregates.offer_attrs)
+            return self._rollups
+
+    def todo_history(self, context=None):
+        """按context（默认提交时的配置）的阈值回填的待办事项历史，每个配置只计算一次；没有聚合数据时返回None"""
+        if self.aggregates is None or not self.aggregates.ready:
+            return None
+        return self._history_entry(context)['history']
+
+    def todo_history_export_bytes(self, context=None):
+        """待办事项历史的Excel内容，第一次需要时生成"""
+        entry = self._history_entry(context)
+        with self._export_lock:
+            if entry['export_bytes'] is None:
+                output = BytesIO()
+                write_todo_history_excel(entry['history'], output)
+                entry['export_bytes'] = output.getvalue()
+            return entry['export_bytes']
+
+    def export_bytes(self, context=None):
+        """分析报告的Excel内容，第一次需要时生成，之后的重跑直接复用；context为调整后的阈值时导出对应的结果"""
+        if not self.is_submitted_config(context):
+            entry = self._what_if_entry(context)
+            with self._export_lock:
+                if entry['export_bytes'] is None:
+                    entry['export_bytes'] = build_analysis_excel_bytes(*entry['result'][:2], self.rollups())
+                return entry['export_bytes']
+
+        with self._export_lock:
+            if self._export_bytes is None:
+                final_offer_analysis, todo_df, _ = self.result
+                self._export_bytes = build_analysis_excel_bytes(final_offer_analysis, todo_df, self.rollups())
+                if self.result_cache is not None:
+                    self.result_cache.attach_export(self.cache_key, self._export_bytes)
+            return self._export_bytes
+
+    def _finish(self, status, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.status = status
+        self.finished_at = time.time()
+
+
+class AnalysisJobExecutor:
+    """有界线程池 + 按会话索引的任务表 + 所有会话共用的结果缓存和待办事项存储"""
+
+    def __init__(self, max_workers=ANALYSIS_MAX_WORKERS, result_cache=None, todo_store=None):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='offer-analysis')
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.result_cache = result_cache if result_cache is not None else AnalysisResultCache()
+        self.todo_store = todo_store
+
+    def submit(self, session_id, file_bytes, file_name='', context=None, trace_offer_ids=None, record_todos=False,
+               **options):
+        """
+        提交分析任务，options透传给process_offer_data_web；
+        同一会话中未结束的旧任务会被取消；相同上传内容和配置的结果已缓存时直接完成
+        trace_offer_ids不为空时追踪这些Offer，追踪需要重新计算，不使用缓存的结果
+        record_todos=True且执行器有待办事项存储时，分析完成后把待办事项写入存储
+        """
+        if context is None:
+            context = RunContext.from_module_config()
+        job = AnalysisJob(session_id, file_name)
+        job.cache_key = result_cache_key(file_bytes, context)
+        job.result_cache = self.result_cache
+        job.context = context
+        job.record_todos = record_todos
+        if trace_offer_ids:
+            job.trace = OfferTrace(trace_offer_ids)
+
+        cached = self.result_cache.get(job.cache_key) if job.trace is None else None
+        if cached is not None:
+            self._record_todos(job, cached[0])
+        with self._lock:
+            self._evict_finished()
+            previous = self._jobs.get(session_id)
+            if previous is not None and not previous.done:
+                previous.cancel()
+            self._jobs[session_id] = job
+            if cached is not None:
+                job._export_bytes = cached[1]
+                job.aggregates = cached[2]
+                job.percent, job.message = 100, '⚡ 命中结果缓存'
+                job._finish('done', result=cached[0])
+            else:
+                job.future = self._pool.submit(self._run, job, file_bytes, dict(options, context=context))
+        return job
+
+    def get(self, session_id):
+        with self._lock:
+            return self._jobs.get(session_id)
+
+    def queue_position(self, job):
+        """排在该任务之前的排队任务数"""
+        with self._lock:
+            return sum(
+                1 for other in self._jobs.values()
+                if other.status == 'queued' and other.submitted_at < job.submitted_at
+            )
+
+    def _run(self, job, file_bytes, options):
+        if job.cancel_requested:
+            job._finish('cancelled')
+            return
+        job.status = 'running'
+        job.metrics = PipelineMetrics()
+        job.metrics.meta['file_name'] = job.file_name
+        job.aggregates = AnalysisAggregates()
+        try:
+            result = process_offer_data_web(
+                BytesIO(file_bytes), progress=job.report, metrics=job.metrics, trace=job.trace,
+                aggregates=job.aggregates, **options
+            )
+        except AnalysisCancelled:
+            job._finish('cancelled')
+        except Exception as e:
+            job._finish('failed', error=str(e))
+        else:
+            if result is None:
+                job._finish('failed', error='读取数据失败，请检查文件格式')
+            else:
+                self.result_cache.put(job.cache_key, result, aggregates=job.aggregates)
+                self._record_todos(job, result)
+                job._finish('done', result=result)
+
+    def _record_todos(self, job, result):
+        """把任务的待办事项写入待办事项存储；写入失败只输出警告，不影响分析结果"""
+        if not job.record_todos or self.todo_store is None:
+            return
+        try:
+            self.todo_store.record_result(result[1], result[2])
+        except Exception as e:
+            print(f"⚠️ 写入待办事项存储失败：{str(e)}")
+        else:
+            job.todo_store = self.todo_store
+
+    def _evict_finished(self):
+        expire_before = time.time() - ANALYSIS_JOB_TTL_SECONDS
+        for session_id, job in list(self._jobs.items()):
+            if job.done and job.finished_at < expire_before:
+                del self._jobs[session_id]
+
+
+# ==================== Excel导出 ====================
+def analysis_output_filename(latest_date):
+    """分析报告的默认文件名"""
+    return f"offer_analysis_{latest_date.strftime('%Y%m%d')}.xlsx"
+
+
+EXCEL_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+EXCEL_WRITE_CHUNK_ROWS = 10000
+
+
+def write_excel_sheets(sheets, output):
+    """
+    按顺序把{工作表名: DataFrame}写入Excel，output可以是文件路径或BytesIO：
+    - xlsxwriter的constant_memory模式逐行写出，每行写完即刷到临时文件，内存占用与行数无关
+    - 每次只把一块行转换为Python对象；空值写为空单元格，日期时间按pandas导出的默认格式写为日期单元格
+    - 未安装xlsxwriter时退回openpyxl
+    """
+    try:
+        import xlsxwriter
+    except ImportError:
+        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+            for sheet_name, df in sheets.items():
+                df.to_excel(writer, sheet_name=sheet_name, index=False)
+        return
+
+    workbook = xlsxwriter.Workbook(output, {
+        'constant_memory': True, 'nan_inf_to_errors': True, 'default_date_format': 'YYYY-MM-DD HH:MM:SS'
+    })
+    try:
+        # 与pandas导出的表头样式一致
+        header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+        for sheet_name, df in sheets.items():
+            worksheet = workbook.add_worksheet(sheet_name)
+            worksheet.write_row(0, 0, [str(col) for col in df.columns], header_format)
+            row = 1
+            for start in range(0, len(df), EXCEL_WRITE_CHUNK_ROWS):
+                chunk = df.iloc[start:start + EXCEL_WRITE_CHUNK_ROWS].astype(object)
+                chunk = chunk.where(chunk.notna(), None)
+                for values in chunk.itertuples(index=False, name=None):
+                    worksheet.write_row(row, 0, values)
+                    row += 1
+    finally:
+        workbook.close()
+
+
+def write_analysis_excel(final_df, todo_df, output, rollups=None):
+    """
+    把Offer分析结果和待办事项写入Excel，output可以是文件路径或BytesIO；
+    rollups为build_rollups的多维汇总表，依次追加在这两张表之后
+    """
+    write_excel_sheets({'Offer Analysis': final_df, '预算待办事项': todo_df, **(rollups or {})}, output)
+
+
+def write_todo_history_excel(history, output):
+    """把回填的待办事项历史写入Excel，output可以是文件路径或BytesIO"""
+    write_excel_sheets({'待办事项历史': history}, output)
+
+
+def build_analysis_excel_bytes(final_df, todo_df, rollups=None):
+    """分析报告的Excel文件内容"""
+    output = BytesIO()
+    write_analysis_excel(final_df, todo_df, output, rollups)
+    return output.getvalue()
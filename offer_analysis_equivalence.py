@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+参考实现与优化实现的等价性对比：
+在录制的上传文件或合成数据上分别运行冻结的参考实现（offer_analysis_reference）和各种优化运行方式
+（串行、多进程分片、分块流式读取、增量存储），逐个单元格比较final_offer_analysis和enhanced_todo_df，
+包括多行的Affiliate文本和按Advertiser_Rank的排序，数值列允许浮点误差
+
+命令行入口见offer_analysis_cli的equivalence子命令
+"""
+
+import contextlib
+import io
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from offer_analysis_bench import generate_workload, isolated_local_state
+from offer_analysis_core import process_offer_data_web, write_excel_sheets
+
+FLOAT_RTOL = 1e-9
+FLOAT_ATOL = 1e-6
+RESULT_SORT_COLUMNS = ['Advertiser', 'Advertiser_Rank']
+RESULT_TABLES = ('final_offer_analysis', 'enhanced_todo_df')
+ROW_LABEL_COLUMNS = ['Offer ID', 'Affiliate', '待办事项']
+BLANK_OFFER_COLUMNS = ('GEO', 'App ID')
+BLANK_OFFERS_PER_COLUMN = 3
+
+# 优化实现的运行方式 -> process_offer_data_web的参数
+OPTIMIZED_ENGINES = {
+    'serial': {},
+    'parallel': {'workers': 2},
+    'streaming': {'streaming': True},
+    'incremental': {'incremental': True},
+}
+
+
+def run_reference(file_bytes):
+    import offer_analysis_reference
+
+    return offer_analysis_reference.process_offer_data_web(BytesIO(file_bytes))
+
+
+def run_optimized(file_bytes, **options):
+    return process_offer_data_web(BytesIO(file_bytes), progress=lambda percent, message: None, **options)
+
+
+def run_engine(name, file_bytes, verbose=False):
+    """运行参考实现（name为'reference'）或OPTIMIZED_ENGINES中的一种运行方式，解析缓存和存储都在临时目录中"""
+    log = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with isolated_local_state(), log:
+        if name == 'reference':
+            return run_reference(file_bytes)
+        options = OPTIMIZED_ENGINES[name]
+        if options.get('incremental'):
+            # 第一次运行写入聚合存储，对比的是第二次运行：每一天都复用存储中的分区
+            run_optimized(file_bytes, **options)
+        return run_optimized(file_bytes, **options)
+
+
+def canonical_tie_order(df, sort_columns=RESULT_SORT_COLUMNS):
+    """
+    排序键相同的连续行块内按全部列的文本排序，块本身的顺序不变：
+    参考实现用set收集每个Offer的Affiliate，同一Offer的规则4/5行的先后取决于字符串哈希种子，不是确定的输出
+    """
+    keys = [col for col in sort_columns if col in df.columns]
+    if not keys or len(df) == 0:
+        return df.reset_index(drop=True)
+    text = df.astype(str).reset_index(drop=True)
+    text.columns = [f'c{position}' for position in range(len(df.columns))]
+    text.insert(0, '_block', df.groupby(keys, sort=False, dropna=False).ngroup().to_numpy())
+    order = text.sort_values(list(text.columns), kind='stable').index
+    return df.reset_index(drop=True).iloc[order].reset_index(drop=True)
+
+
+def _is_numeric(series):
+    return pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series)
+
+
+def cell_mismatches(expected, actual, rtol=FLOAT_RTOL, atol=FLOAT_ATOL):
+    """两列按位置逐个单元格比较，返回不一致的布尔数组；两边都为空视为一致"""
+    expected = expected.reset_index(drop=True)
+    actual = actual.reset_index(drop=True)
+    if _is_numeric(expected) and _is_numeric(actual):
+        return ~np.isclose(
+            expected.to_numpy(dtype=float), actual.to_numpy(dtype=float), rtol=rtol, atol=atol, equal_nan=True
+        )
+    expected_na = expected.isna().to_numpy()
+    actual_na = actual.isna().to_numpy()
+    different_text = expected.astype(str).to_numpy() != actual.astype(str).to_numpy()
+    return (expected_na != actual_na) | (~expected_na & ~actual_na & different_text)
+
+
+def _plain(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def compare_frames(expected, actual, table, rtol=FLOAT_RTOL, atol=FLOAT_ATOL):
+    """
+    逐个单元格比较两张结果表，返回差异列表：
+    列名和顺序、行数不一致各记一条（column为'<columns>'/'<rows>'），其余每个不一致的单元格一条，
+    带上参考表中该行的Offer ID、Affiliate和待办事项便于定位
+    """
+    diffs = []
+    if list(expected.columns) != list(actual.columns):
+        diffs.append({
+            'table': table, 'row': None, 'column': '<columns>',
+            'expected': list(map(str, expected.columns)), 'actual': list(map(str, actual.columns))
+        })
+    if len(expected) != len(actual):
+        diffs.append({'table': table, 'row': None, 'column': '<rows>', 'expected': len(expected), 'actual': len(actual)})
+
+    rows = min(len(expected), len(actual))
+    expected = expected.iloc[:rows].reset_index(drop=True)
+    actual = actual.iloc[:rows].reset_index(drop=True)
+    label_columns = [col for col in ROW_LABEL_COLUMNS if col in expected.columns]
+    for col in [col for col in expected.columns if col in actual.columns]:
+        for row in np.flatnonzero(cell_mismatches(expected[col], actual[col], rtol, atol)):
+            diffs.append({
+                'table': table, 'row': int(row), 'column': str(col),
+                'expected': _plain(expected.at[row, col]), 'actual': _plain(actual.at[row, col]),
+                **{f'key:{label}': _plain(expected.at[row, label]) for label in label_columns}
+            })
+    return diffs
+
+
+def compare_results(expected, actual, canonical_ties=False, rtol=FLOAT_RTOL, atol=FLOAT_ATOL):
+    """
+    比较两次process_offer_data_web的返回值(final_offer_analysis, enhanced_todo_df, latest_date)，返回差异列表；
+    canonical_ties=True时先把排序键相同的行块规范为确定顺序（与参考实现比较时使用）
+    """
+    if expected is None or actual is None:
+        if expected is None and actual is None:
+            return []
+        return [{'table': '<result>', 'row': None, 'column': '<result>',
+                 'expected': expected is not None, 'actual': actual is not None}]
+
+    diffs = []
+    if expected[2] != actual[2]:
+        diffs.append({'table': 'latest_date', 'row': None, 'column': '<value>',
+                      'expected': str(expected[2]), 'actual': str(actual[2])})
+    for table, expected_df, actual_df in zip(RESULT_TABLES, expected[:2], actual[:2]):
+        if canonical_ties:
+            expected_df, actual_df = canonical_tie_order(expected_df), canonical_tie_order(actual_df)
+        diffs += compare_frames(expected_df, actual_df, table, rtol, atol)
+    return diffs
+
+
+def check_equivalence(file_bytes, engines=tuple(OPTIMIZED_ENGINES), reference=True, verbose=False,
+                      rtol=FLOAT_RTOL, atol=FLOAT_ATOL):
+    """
+    在一份上传内容上运行各实现并两两对比，返回{对比名称: 差异列表}：
+    - '<engine> vs reference'：与参考实现比较（排序键相同的行块内顺序不比较，见canonical_tie_order）
+    - '<engine> vs <第一个engine>'：优化实现之间严格按行顺序比较，输出必须完全确定
+    """
+    results = {name: run_engine(name, file_bytes, verbose) for name in engines}
+    report = {}
+    if reference:
+        expected = run_engine('reference', file_bytes, verbose)
+        for name in engines:
+            report[f'{name} vs reference'] = compare_results(expected, results[name], True, rtol, atol)
+    first = engines[0] if engines else None
+    for name in engines[1:]:
+        report[f'{name} vs {first}'] = compare_results(results[first], results[name], False, rtol, atol)
+    return report
+
+
+def blank_offer_cells(data, columns=BLANK_OFFER_COLUMNS, offers_per_column=BLANK_OFFERS_PER_COLUMN, seed=0):
+    """
+    把少数Offer的GEO、App ID整列置空：空白单元格在合并后被fillna(0)成整数0，
+    与文本混在同一对象列中，多进程分片需要原样传给工作进程
+    """
+    rng = np.random.default_rng(seed)
+    data = data.copy()
+    offer_ids = data['Offer ID'].unique()
+    for col in columns:
+        blank_ids = rng.choice(offer_ids, size=min(offers_per_column, len(offer_ids)), replace=False)
+        data.loc[data['Offer ID'].isin(blank_ids), col] = np.nan
+    return data
+
+
+def generated_input(rows, seed=0):
+    """equivalence对比用的合成上传内容，包含GEO、App ID为空的Offer"""
+    data, blacklist = generate_workload(rows, seed=seed)
+    output = BytesIO()
+    write_excel_sheets({'1-all data': blank_offer_cells(data, seed=seed), 'blacklist': blacklist}, output)
+    return output.getvalue()
+
+
+def format_report(source, report, max_diffs=20):
+    """对比结果的文本摘要，每组对比最多列出max_diffs条差异"""
+    lines = []
+    for comparison, diffs in report.items():
+        status = '一致' if not diffs else f'{len(diffs)}处差异'
+        lines.append(f"{source} | {comparison}：{status}")
+        for diff in diffs[:max_diffs]:
+            keys = '，'.join(f"{name[4:]}={value}" for name, value in diff.items() if name.startswith('key:'))
+            location = f"第{diff['row']}行 " if diff['row'] is not None else ''
+            lines.append(
+                f"    {diff['table']} {location}{diff['column']}：参考{diff['expected']!r}，实际{diff['actual']!r}"
+                + (f"（{keys}）" if keys else '')
+            )
+        if len(diffs) > max_diffs:
+            lines.append(f"    ……另有{len(diffs) - max_diffs}处差异")
+    return '\n'.join(lines)
@@ -0,0 +1,936 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+冻结的参考实现：优化前逐行计算的原始处理逻辑，只供等价性对比（offer_analysis_equivalence）使用。
+与原脚本相比只去掉了Streamlit依赖（提示改为print）、单个Offer的调试输出和规则6写入工作目录的调试CSV，
+配置和阈值取自offer_analysis_core；
+请勿在此优化或修改规则口径，口径变化应同时体现在两边并通过对比确认
+"""
+
+import pandas as pd
+import numpy as np
+
+from offer_analysis_core import (
+    ADVERTISER_TYPE_MAP,
+    AFFILIATE_TYPE_MAP,
+    AFFILIATE_DIFF_THRESHOLD,
+    BLACKLIST_CONFIG,
+    OFFER_DIFF_THRESHOLD,
+    RULE4_REVENUE_DIFF_ABS,
+    RULE4_REVENUE_DIFF_UP,
+    RULE5_REVENUE_DIFF_THRESHOLD,
+)
+
+
+# 全局变量，用于存储从Excel读取的黑名单配置
+BLACKLIST_RECORDS = []
+
+def load_blacklist_from_excel(blacklist_df):
+    """从Excel黑名单表加载黑名单配置"""
+    try:
+        if 'Advertiser' not in blacklist_df.columns or 'Affiliate' not in blacklist_df.columns:
+            print("❌ 黑名单表格必须包含'Advertiser'和'Affiliate'两列")
+            return []
+        
+        blacklist_records = []
+        for _, row in blacklist_df.iterrows():
+            advertiser = str(row['Advertiser']).strip() if pd.notna(row['Advertiser']) else ''
+            affiliate = str(row['Affiliate']).strip() if pd.notna(row['Affiliate']) else ''
+            if advertiser or affiliate:
+                blacklist_records.append({
+                    'advertiser': advertiser,
+                    'affiliate': affiliate
+                })
+        
+        return blacklist_records
+    except Exception as e:
+        print(f"⚠️ 处理黑名单数据失败: {str(e)}")
+        return []
+
+def is_in_blacklist(advertiser, affiliate):
+    """检查广告主和Affiliate组合是否在黑名单中"""
+    if not BLACKLIST_RECORDS:
+        return False
+    
+    advertiser_clean = str(advertiser).strip() if pd.notna(advertiser) else ''
+    affiliate_clean = str(affiliate).strip() if pd.notna(affiliate) else ''
+    
+    for record in BLACKLIST_RECORDS:
+        advertiser_match = (not record['advertiser'] or record['advertiser'] == advertiser_clean)
+        affiliate_match = (not record['affiliate'] or record['affiliate'] == affiliate_clean)
+        
+        if advertiser_match and affiliate_match:
+            return True
+    
+    return False
+
+
+
+def parse_affiliate_rate_text(text):
+    affiliate_list = []
+    if pd.isna(text) or text == '':
+        return affiliate_list
+    lines = text.split('\n')
+    for line in lines:
+        line = line.strip()
+        if '流水' in line:
+            affiliate_part = line.split('流水')[0].strip()
+            if affiliate_part:
+                affiliate_list.append(affiliate_part)
+    return affiliate_list
+
+
+def get_affiliate_type(affiliate_name):
+    if pd.isna(affiliate_name):
+        return ""
+    clean_aff = affiliate_name.strip().lower().replace(' ', '')
+    for aff_key, aff_type in AFFILIATE_TYPE_MAP.items():
+        clean_key = aff_key.strip().lower().replace(' ', '')
+        if clean_key in clean_aff or clean_aff in clean_key:
+            return aff_type
+    return ""
+
+def get_affiliate_revenue_diff(qualified_df, offer_id, affiliate, latest_date, second_latest_date):
+    offer_data = qualified_df[qualified_df['Offer ID'] == offer_id].copy()
+    if len(offer_data) == 0:
+        return np.nan
+    
+    def clean_aff_name(name):
+        if pd.isna(name):
+            return ""
+        return name.strip().lower()
+    target_aff_clean = clean_aff_name(affiliate)
+    offer_data['Affiliate_clean'] = offer_data['Affiliate'].apply(clean_aff_name)
+    aff_data = offer_data[offer_data['Affiliate_clean'] == target_aff_clean].copy()
+    
+    if len(aff_data) == 0:
+        return np.nan
+    
+    
+    aff_data['date'] = aff_data['Time'].dt.date
+    latest_rev = aff_data[aff_data['date'] == latest_date]['Total Revenue'].sum() if len(aff_data) > 0 else 0
+    second_rev = aff_data[aff_data['date'] == second_latest_date]['Total Revenue'].sum() if len(aff_data) > 0 else 0
+    
+    
+    return latest_rev - second_rev
+
+# ==================== 新增：收入排序计算逻辑 ====================
+def calculate_revenue_ranking(qualified_df):
+    """
+    计算收入排序：
+    - 如果是本月1号，计算所有日期的Total Revenue
+    - 否则，只计算本月所有日期的Total Revenue
+    - 按Advertiser维度汇总并降序排序
+    """
+    # 确保Time列是datetime类型
+    qualified_df = qualified_df.copy()
+    qualified_df['Time'] = pd.to_datetime(qualified_df['Time'], errors='coerce')
+    
+    # 获取数据中的最大日期（判断是否为当月1号的基准）
+    max_date = qualified_df['Time'].max()
+    is_first_day = (max_date.day == 1)
+    
+    # 筛选时间范围
+    if is_first_day:
+        # 本月1号：计算所有日期数据
+        filtered_df = qualified_df
+    else:
+        # 非本月1号：只计算本月数据
+        filtered_df = qualified_df[
+            (qualified_df['Time'].dt.year == max_date.year) & 
+            (qualified_df['Time'].dt.month == max_date.month)
+        ]
+    
+    #计算每个(Time, Offer ID, Advertiser)的总收入
+    time_offer_advertiser_revenue = filtered_df.groupby(['Offer ID', 'Advertiser'])['Total Revenue'].sum().reset_index()
+    time_offer_advertiser_revenue.rename(columns={'Total Revenue': 'Time_Offer_Advertiser_Revenue'}, inplace=True)
+
+    time_offer_advertiser_revenue = time_offer_advertiser_revenue.sort_values(
+    by=['Advertiser', 'Time_Offer_Advertiser_Revenue'],  # 优先按广告主排序，同广告主内按收入排序
+    ascending=[True, False],  # Advertiser升序（字母/数字顺序），Revenue降序
+    ignore_index=True)
+    
+    time_offer_advertiser_revenue['Advertiser_Rank'] = time_offer_advertiser_revenue.groupby('Advertiser')['Time_Offer_Advertiser_Revenue'].rank(
+    method='min', ascending=False).astype(int)
+
+   
+    
+    return time_offer_advertiser_revenue
+
+# ==================== 核心处理函数（适配Streamlit） ====================
+def process_offer_data_web(uploaded_file, progress_bar=None, status_text=None):
+    """
+    网页版处理函数，基于原脚本逻辑
+    """
+    global BLACKLIST_RECORDS
+    # 更新进度
+    if progress_bar and status_text:
+        progress_bar.progress(10)
+        status_text.text("📁 正在读取Excel文件...")
+    
+    try:
+        # 读取上传的文件
+        excel_file = pd.ExcelFile(uploaded_file)
+        df = pd.read_excel(uploaded_file, sheet_name='1-all data')
+        blacklist_df = pd.read_excel(uploaded_file, sheet_name='blacklist')
+        BLACKLIST_RECORDS = load_blacklist_from_excel(blacklist_df)
+
+        print(BLACKLIST_RECORDS)
+   
+        
+        # 数据预处理
+        df['Time'] = pd.to_datetime(df['Time'], errors='coerce')
+        df = df.dropna(subset=['Time'])
+        df['Offer ID'] = pd.to_numeric(df['Offer ID'], errors='coerce')
+        df['Total Caps'] = pd.to_numeric(df['Total Caps'], errors='coerce')
+        
+        # 提取最新两天日期
+        all_dates = sorted(df['Time'].dt.date.unique())
+        print(f"数据包含的唯一日期列表：{all_dates}")
+        print(f"数据时间范围：{all_dates[0]} 至 {all_dates[-1]}")
+        
+        if len(all_dates) >= 2:
+            latest_date = all_dates[-1]          
+            second_latest_date = all_dates[-2]   
+            print(f"提取到最新两天日期：{second_latest_date}（次新）、{latest_date}（最新）")
+        else:
+            latest_date = all_dates[0]
+            second_latest_date = all_dates[0]
+            print(f"⚠️ 数据仅包含1个日期：{latest_date}，次新日期默认同最新日期")
+        
+        latest_date_str = latest_date.strftime("%Y/%m/%d")
+        second_latest_date_str = second_latest_date.strftime("%Y/%m/%d")
+        output_file = f"processed_offer_{latest_date.strftime('%Y%m%d')}.xlsx"
+            
+    except Exception as e:
+        print(f"读取数据失败：{str(e)}")
+        return None
+
+    # 2. 筛选符合条件的Offer ID
+    print("\n=== 2. 筛选符合条件的Offer ID ===")
+    daily_offer_revenue = df.groupby(['Time', 'Offer ID'])['Total Revenue'].sum().reset_index()
+    daily_offer_revenue.columns = ['Time', 'Offer ID', 'Daily_Revenue']
+    qualified_offer_ids = daily_offer_revenue[daily_offer_revenue['Daily_Revenue'] >= 10]['Offer ID'].unique()
+    qualified_df = df[df['Offer ID'].isin(qualified_offer_ids)].copy()
+    print(f"符合条件的Offer ID数量：{len(qualified_offer_ids)}")
+
+    # 3. 计算Offer核心汇总指标
+    print("\n=== 3. 计算Offer汇总指标 ===")
+    offer_summary = qualified_df.groupby('Offer ID').agg({
+        'Total Clicks': 'sum',
+        'Total Conversions': 'sum', 
+        'Total Revenue': 'sum',
+        'Total Profit': lambda x: x.sum() if 'Total Profit' in df.columns else 0,
+        'Advertiser': 'first',
+        'App ID': lambda x: x.iloc[0] if 'App ID' in df.columns else '',
+        'GEO': lambda x: x.iloc[0] if 'GEO' in df.columns else '',
+        'Total Caps': 'first',
+        'Status': 'first'
+    }).reset_index()
+
+    offer_summary.columns = [
+        'Offer ID', 'total_clicks', 'total_conversions', 
+        'total_revenue', 'total_profit', 'Advertiser', 
+        'App ID', 'GEO', 'Total caps', 'Status'
+    ]
+
+    # 4. 按Affiliate计算收入占比
+    print("\n=== 4. 计算Affiliate收入占比 ===")
+    affiliate_revenue = qualified_df.groupby(['Offer ID', 'Affiliate'])['Total Revenue'].sum().reset_index()
+    affiliate_revenue.columns = ['Offer ID', 'Affiliate', 'affilate_revenue']
+    
+    affiliate_revenue = affiliate_revenue.merge(
+        offer_summary[['Offer ID', 'total_revenue']], 
+        on='Offer ID', 
+        how='left'
+    )
+
+    affiliate_revenue['affilate_revenue_rate'] = np.where(
+        affiliate_revenue['affilate_revenue'] > 0,
+        (affiliate_revenue['affilate_revenue'] / affiliate_revenue['total_revenue']).round(4),
+        0
+    )
+
+    affiliate_revenue['affilate_revenue_rate_str'] = affiliate_revenue['affilate_revenue_rate'].apply(
+        lambda x: f"{x:.2%}" if x > 0 else "0.00%"
+    )
+
+    affiliate_revenue['affilate_revenue_text'] = (
+        affiliate_revenue['Affiliate'] + "流水占比：" + 
+        affiliate_revenue['affilate_revenue'].round(2).astype(str) + "美金" + 
+        affiliate_revenue['affilate_revenue_rate_str']
+    )
+
+    affiliate_summary = affiliate_revenue.sort_values(
+        by=['Offer ID', 'affilate_revenue_rate'], 
+        ascending=[True, False]
+    ).groupby('Offer ID')['affilate_revenue_text'].agg(
+        lambda x: '\n'.join(x)
+    ).reset_index()
+    affiliate_summary.columns = ['Offer ID', 'affilate_revenue_rate_all']
+
+    # 5. 计算最新两天分别的数据
+    print("\n=== 5. 计算最新两天数据 ===")
+    latest_mask = qualified_df['Time'].dt.date == latest_date
+    latest_date_data = qualified_df[latest_mask].copy()
+    latest_summary = latest_date_data.groupby('Offer ID').agg({
+        'Total Clicks': 'sum',
+        'Total Conversions': 'sum',
+        'Total Revenue': 'sum',
+        'Total Profit': lambda x: x.sum() if 'Total Profit' in df.columns else 0
+    }).reset_index()
+    
+    latest_fields = [
+        f'{latest_date_str}_total_clicks', 
+        f'{latest_date_str}_total_conversions', 
+        f'{latest_date_str}_total_revenue', 
+        f'{latest_date_str}_total_profit'
+    ]
+    latest_summary.columns = ['Offer ID'] + latest_fields
+    
+    second_mask = qualified_df['Time'].dt.date == second_latest_date
+    second_latest_date_data = qualified_df[second_mask].copy()
+    second_summary = second_latest_date_data.groupby('Offer ID').agg({
+        'Total Clicks': 'sum',
+        'Total Conversions': 'sum',
+        'Total Revenue': 'sum',
+        'Total Profit': lambda x: x.sum() if 'Total Profit' in df.columns else 0
+    }).reset_index()
+    
+    second_fields = [
+        f'{second_latest_date_str}_total_clicks', 
+        f'{second_latest_date_str}_total_conversions', 
+        f'{second_latest_date_str}_total_revenue', 
+        f'{second_latest_date_str}_total_profit'
+    ]
+    second_summary.columns = ['Offer ID'] + second_fields
+
+    # 6. 最新一天Affiliate分析
+    print("\n=== 6. 最新一天Affiliate分析 ===")
+    latest_affiliate_summary = pd.DataFrame({'Offer ID': offer_summary['Offer ID'], 'latest_affilate_revenue_rate_all': ''})
+    latest_day_df = qualified_df[qualified_df['Time'].dt.date == latest_date].copy()
+    
+    if len(latest_day_df) > 0:
+        latest_affiliate_revenue = latest_day_df.groupby(['Offer ID', 'Affiliate'])['Total Revenue'].sum().reset_index()
+        latest_affiliate_revenue.columns = ['Offer ID', 'Affiliate', 'latest_affilate_revenue']
+        
+        latest_offer_total = latest_day_df.groupby('Offer ID')['Total Revenue'].sum().reset_index()
+        latest_offer_total.columns = ['Offer ID', 'latest_total_revenue']
+        
+        latest_affiliate_revenue = latest_affiliate_revenue.merge(latest_offer_total, on='Offer ID', how='left')
+        latest_affiliate_revenue['latest_affilate_revenue_rate'] = np.where(
+            (latest_affiliate_revenue['latest_affilate_revenue'] > 0) & 
+            (latest_affiliate_revenue['latest_total_revenue'] > 0),
+            (latest_affiliate_revenue['latest_affilate_revenue'] / latest_affiliate_revenue['latest_total_revenue']).round(4),
+            0
+        )
+
+        latest_affiliate_revenue['latest_affilate_revenue_rate_str'] = latest_affiliate_revenue['latest_affilate_revenue_rate'].apply(
+            lambda x: f"{x:.2%}" if x > 0 else "0.00%"
+        )
+
+        latest_affiliate_revenue['latest_affiliate_text'] = (
+            latest_affiliate_revenue['Affiliate'] + "流水占比：" + 
+            latest_affiliate_revenue['latest_affilate_revenue'].round(2).astype(str) + "美金" + 
+            latest_affiliate_revenue['latest_affilate_revenue_rate_str']
+        )
+
+        latest_affiliate_summary = latest_affiliate_revenue.sort_values(
+            by=['Offer ID', 'latest_affilate_revenue_rate'], 
+            ascending=[True, False]
+        ).groupby('Offer ID')['latest_affiliate_text'].agg(lambda x: '\n'.join(x)).reset_index()
+        latest_affiliate_summary.columns = ['Offer ID', 'latest_affilate_revenue_rate_all']
+
+        # ==================== 新增：计算每个Affiliate波动的原因 ====================
+        # 1. 计算Affiliate两天的流水/点击/转化数据
+        # 最新日期Affiliate数据（点击+转化+流水）
+        latest_aff_full = latest_day_df.groupby(['Offer ID', 'Affiliate']).agg({
+            'Total Clicks': 'sum',
+            'Total Conversions': 'sum',
+            'Total Revenue': 'sum'
+        }).reset_index()
+        latest_aff_full.columns = ['Offer ID', 'Affiliate', 'clicks_latest', 'conversions_latest', 'revenue_latest']
+        
+        # 次新日期Affiliate数据
+        second_aff_full = second_latest_date_data.groupby(['Offer ID', 'Affiliate']).agg({
+            'Total Clicks': 'sum',
+            'Total Conversions': 'sum',
+            'Total Revenue': 'sum'
+        }).reset_index()
+        second_aff_full.columns = ['Offer ID', 'Affiliate', 'clicks_second', 'conversions_second', 'revenue_second_latest']
+        
+        # 合并两天数据
+        affiliate_revenue_diff = latest_aff_full.merge(
+            second_aff_full, 
+            on=['Offer ID', 'Affiliate'], 
+            how='outer'
+        ).fillna(0)
+        
+        # 2. 计算差值和变化率
+        # 流水差值
+        affiliate_revenue_diff['diff_affiliate_revenue'] = affiliate_revenue_diff['revenue_latest'] - affiliate_revenue_diff['revenue_second_latest']
+        affiliate_revenue_diff['diff_affiliate_abs'] = abs(affiliate_revenue_diff['diff_affiliate_revenue'])
+        
+        # 流水变化率（避免除0）
+        affiliate_revenue_diff['revenue_change_rate'] = np.where(
+            affiliate_revenue_diff['revenue_second_latest'] > 0,
+            affiliate_revenue_diff['diff_affiliate_revenue'] / affiliate_revenue_diff['revenue_second_latest'],
+            np.where(affiliate_revenue_diff['revenue_latest'] > 0, 1, 0)
+        )
+        
+        # 点击变化率
+        affiliate_revenue_diff['clicks_change_rate'] = np.where(
+            affiliate_revenue_diff['clicks_second'] > 0,
+            (affiliate_revenue_diff['clicks_latest'] - affiliate_revenue_diff['clicks_second']) / affiliate_revenue_diff['clicks_second'],
+            np.where(affiliate_revenue_diff['clicks_latest'] > 0, 1, 0)
+        )
+        
+        # CR（转化/点击）和CR变化
+        affiliate_revenue_diff['cr_latest'] = np.where(
+            affiliate_revenue_diff['clicks_latest'] > 0,
+            affiliate_revenue_diff['conversions_latest'] / affiliate_revenue_diff['clicks_latest'],
+            0
+        )
+        affiliate_revenue_diff['cr_second'] = np.where(
+            affiliate_revenue_diff['clicks_second'] > 0,
+            affiliate_revenue_diff['conversions_second'] / affiliate_revenue_diff['clicks_second'],
+            0
+        )
+        affiliate_revenue_diff['cr_change'] = affiliate_revenue_diff['cr_latest'] - affiliate_revenue_diff['cr_second']
+        
+        # 3. 筛选显著影响的Affiliate
+        significant_diff = affiliate_revenue_diff[affiliate_revenue_diff['diff_affiliate_abs'] >= AFFILIATE_DIFF_THRESHOLD].copy()
+        
+        if len(significant_diff) > 0:
+            significant_diff.sort_values(
+                by=['Offer ID', 'diff_affiliate_revenue'],
+                ascending=[True, True],
+                inplace=True,
+                ignore_index=True
+            )
+
+            def generate_influence_text(row):
+                revenue_latest = float(row['revenue_latest'])
+                revenue_second = float(row['revenue_second_latest'])
+                diff_revenue = float(row['diff_affiliate_revenue'])
+                
+                if revenue_latest > 0 and revenue_second == 0:
+                    return f"{row['Affiliate']}新增流水{round(revenue_latest, 2)}美金"
+                
+                elif revenue_latest == 0 and revenue_second > 0:
+                    return f"{row['Affiliate']}停止产生流水，减少流水{round(revenue_second, 2)}美金"
+                
+                else:
+                    if diff_revenue < 0:
+                        revenue_abs = abs(diff_revenue)
+                        revenue_text = f"减少流水{round(revenue_abs, 2)}美金"
+                        revenue_rate = abs(float(row['revenue_change_rate']))
+                        revenue_rate_text = f"{round(revenue_rate * 100, 1)}%" if revenue_rate > 0 else "0.0%"
+                        full_revenue_text = f"{row['Affiliate']}{revenue_text}/{revenue_rate_text}"
+                    else:
+                        revenue_text = f"增加流水{round(diff_revenue, 2)}美金"
+                        revenue_rate = float(row['revenue_change_rate'])
+                        revenue_rate_text = f"{round(revenue_rate * 100, 1)}%" if revenue_rate > 0 else "0.0%"
+                        full_revenue_text = f"{row['Affiliate']}{revenue_text}/{revenue_rate_text}"
+                    
+                    clicks_rate = float(row['clicks_change_rate'])
+                    clicks_abs_rate = abs(clicks_rate)
+                    if clicks_rate > 0:
+                        clicks_text = f"Total Clicks增加{round(clicks_abs_rate * 100, 1)}%"
+                    elif clicks_rate < 0:
+                        clicks_text = f"Total Clicks减少{round(clicks_abs_rate * 100, 1)}%"
+                    else:
+                        clicks_text = "Total Clicks无变化"
+                    
+                    cr_change = float(row['cr_change'])
+                    cr_abs_change = abs(cr_change)
+                    if cr_change > 0:
+                        cr_text = f"CR增加{round(cr_abs_change * 100, 1)}%"
+                    elif cr_change < 0:
+                        cr_text = f"CR减少{round(cr_abs_change * 100, 1)}%"
+                    else:
+                        cr_text = "CR无变化"
+                    
+                    return f"{full_revenue_text}，对应{clicks_text}，{cr_text}"
+            
+            significant_diff['influence_text'] = significant_diff.apply(generate_influence_text, axis=1)
+
+            def aggregate_affiliate_text(group):
+                return '\n'.join(group['influence_text'].tolist())
+            
+            influence_affiliate_temp = significant_diff.groupby('Offer ID').apply(
+                aggregate_affiliate_text
+            ).reset_index(name='influence_affiliate')
+            
+            influence_affiliate_summary = offer_summary[['Offer ID']].merge(
+                influence_affiliate_temp, on='Offer ID', how='left'
+            ).fillna({'influence_affiliate': ''})
+    
+    # 无显著影响规则应用
+    high_diff_offers = offer_summary[
+        abs(offer_summary['total_revenue'] - offer_summary['total_revenue'].shift(1)) >= OFFER_DIFF_THRESHOLD
+    ]['Offer ID'].tolist() if 'total_revenue' in offer_summary.columns else []
+    affiliate_diff_data = affiliate_revenue_diff if 'affiliate_revenue_diff' in locals() else pd.DataFrame()
+    
+    no_significant_impact_offers = []
+    for offer_id in high_diff_offers:
+        offer_aff_diff = affiliate_diff_data[affiliate_diff_data['Offer ID'] == offer_id] if len(affiliate_diff_data) > 0 else pd.DataFrame()
+        if len(offer_aff_diff) > 0:
+            max_aff_diff = offer_aff_diff['diff_affiliate_abs'].max() if 'diff_affiliate_abs' in offer_aff_diff.columns else 0
+            if max_aff_diff < AFFILIATE_DIFF_THRESHOLD:
+                no_significant_impact_offers.append(offer_id)
+    
+    # 填充无显著影响文本
+    if 'influence_affiliate_summary' in locals():
+        for idx, row in influence_affiliate_summary.iterrows():
+            offer_id = row['Offer ID']
+            if offer_id in no_significant_impact_offers:
+                influence_affiliate_summary.at[idx, 'influence_affiliate'] = '无显著影响'
+            else:
+                influence_affiliate_summary.at[idx, 'influence_affiliate'] = row['influence_affiliate'] if row['influence_affiliate'] else ''
+    else:
+        # 初始化空的波动分析结果
+        influence_affiliate_summary = pd.DataFrame({'Offer ID': offer_summary['Offer ID'], 'influence_affiliate': ''})
+    # ==================== 新增结束 ====================
+
+    # 8. 生成待办事项
+    print("\n=== 8. 生成待办事项 ===")
+    todo_base_data = offer_summary.merge(affiliate_summary, on='Offer ID', how='left').fillna({'affilate_revenue_rate_all': ''})
+    todo_base_data = todo_base_data.merge(latest_summary, on='Offer ID', how='left').fillna(0)
+    todo_base_data = todo_base_data.merge(second_summary, on='Offer ID', how='left').fillna(0)
+    todo_base_data = todo_base_data.merge(latest_affiliate_summary, on='Offer ID', how='left').fillna({'latest_affilate_revenue_rate_all': ''})
+    # 合并波动分析结果到待办数据
+    todo_base_data = todo_base_data.merge(influence_affiliate_summary, on='Offer ID', how='left').fillna({'influence_affiliate': ''})
+    
+    todo_base_data['预算空间'] = np.where(
+        (todo_base_data['Total caps'].notna()) & (todo_base_data[f'{latest_date_str}_total_conversions'].notna()),
+        todo_base_data['Total caps'] - todo_base_data[f'{latest_date_str}_total_conversions'],
+        0
+    ).astype(int)
+    
+    todo_list = []
+    triggered_123_offer_ids = set()
+    triggered_45_affiliate = set()
+
+    # 规则3
+    print("  处理规则3：ACTIVE+预算空间<0...")
+    rule3_data = todo_base_data[
+        (todo_base_data['Status'].str.upper() == 'ACTIVE') & 
+        (todo_base_data['预算空间'] < 0) & 
+        (~todo_base_data['Advertiser'].isin(BLACKLIST_CONFIG['advertiser_blacklist']))
+    ].copy()
+    
+    print(f"  规则3筛选出的Offer数量：{len(rule3_data)}")
+    for _, row in rule3_data.iterrows():
+        todo_list.append({
+            'Offer ID': row['Offer ID'],
+            'Advertiser': row['Advertiser'],
+            'App ID': row['App ID'],
+            'GEO': row['GEO'],
+            'Total caps': row['Total caps'],
+            'Status': row['Status'],
+            '预算空间': row['预算空间'],
+            'Affiliate': '',
+            '待办事项': '请询问广告主是否有预算增加空间',
+            f'{latest_date_str}_total_revenue': row[f'{latest_date_str}_total_revenue'],
+            f'{second_latest_date_str}_total_revenue': row[f'{second_latest_date_str}_total_revenue'],
+            'affilate_revenue_rate_all': row['affilate_revenue_rate_all'],
+            'latest_affilate_revenue_rate_all': row['latest_affilate_revenue_rate_all'],
+            'influence_affiliate': row['influence_affiliate']  # 新增：波动原因
+        })
+    triggered_123_offer_ids.update(rule3_data['Offer ID'].tolist())
+    
+    # 规则1
+    print("  处理规则1：最新无流水+次新有流水...")
+    rule1_data = todo_base_data[
+        (todo_base_data[f'{latest_date_str}_total_revenue'] == 0) & 
+        (todo_base_data[f'{second_latest_date_str}_total_revenue'] > 10) &
+        (~todo_base_data['Advertiser'].isin(BLACKLIST_CONFIG['advertiser_blacklist']))
+    ].copy()
+    for _, row in rule1_data.iterrows():
+        todo_list.append({
+            'Offer ID': row['Offer ID'],
+            'Advertiser': row['Advertiser'],
+            'App ID': row['App ID'],
+            'GEO': row['GEO'],
+            'Total caps': row['Total caps'],
+            'Status': row['Status'],
+            '预算空间': row['预算空间'],
+            'Affiliate': '',
+            '待办事项': '请确认该预算暂停原因，比如是否质量不行、CPA预算波动比较大、预算换到新id',
+            f'{latest_date_str}_total_revenue': row[f'{latest_date_str}_total_revenue'],
+            f'{second_latest_date_str}_total_revenue': row[f'{second_latest_date_str}_total_revenue'],
+            'affilate_revenue_rate_all': row['affilate_revenue_rate_all'],
+            'latest_affilate_revenue_rate_all': row['latest_affilate_revenue_rate_all'],
+            'influence_affiliate': row['influence_affiliate']  # 新增：波动原因
+        })
+    triggered_123_offer_ids.update(rule1_data['Offer ID'].tolist())
+    
+    # 规则2
+    print("  处理规则2：Pause+收入波动显著...")
+    rule2_data = todo_base_data[
+        (todo_base_data['Status'].str.upper() == 'PAUSE') & 
+        (todo_base_data[f'{latest_date_str}_total_revenue'] >= 10) & 
+        (abs(todo_base_data[f'{latest_date_str}_total_revenue'] - todo_base_data[f'{second_latest_date_str}_total_revenue']) >= 10) &
+        (~todo_base_data['Advertiser'].isin(BLACKLIST_CONFIG['advertiser_blacklist']))
+    ].copy()
+    for _, row in rule2_data.iterrows():
+        todo_list.append({
+            'Offer ID': row['Offer ID'],
+            'Advertiser': row['Advertiser'],
+            'App ID': row['App ID'],
+            'GEO': row['GEO'],
+            'Total caps': row['Total caps'],
+            'Status': row['Status'],
+            '预算空间': row['预算空间'],
+            'Affiliate': '',
+            '待办事项': '关注今日是否有流水，如果无流水或者比昨日流水少10美金以上，和广告主确认暂停原因，如是否预算不够，否则保持观察',
+            f'{latest_date_str}_total_revenue': row[f'{latest_date_str}_total_revenue'],
+            f'{second_latest_date_str}_total_revenue': row[f'{second_latest_date_str}_total_revenue'],
+            'affilate_revenue_rate_all': row['affilate_revenue_rate_all'],
+            'latest_affilate_revenue_rate_all': row['latest_affilate_revenue_rate_all'],
+            'influence_affiliate': row['influence_affiliate']  # 新增：波动原因
+        })
+    triggered_123_offer_ids.update(rule2_data['Offer ID'].tolist())
+    
+    # 规则4
+    print("  处理规则4：ACTIVE+预算>0+流水差值≤5或增长≥5...")
+    rule4_offer_data = todo_base_data[
+        (todo_base_data['Status'].str.upper() == 'ACTIVE') & 
+        (todo_base_data['预算空间'] > 0) & 
+        (~todo_base_data['Offer ID'].isin(triggered_123_offer_ids)) &
+        (~todo_base_data.apply(lambda row: is_in_blacklist(row['Advertiser'], ''), axis=1))
+    ].copy()
+
+    print(f"  规则4初始筛选Offer数量：{len(rule4_offer_data)}")
+    rule4_count = 0
+    
+    for _, offer_row in rule4_offer_data.iterrows():
+        offer_id = offer_row['Offer ID']
+        history_affs = parse_affiliate_rate_text(offer_row['affilate_revenue_rate_all'])
+        latest_affs = parse_affiliate_rate_text(offer_row['latest_affilate_revenue_rate_all'])
+        all_affs = list(set(history_affs + latest_affs))
+        
+        
+        if not all_affs:
+            continue
+        
+        for aff in all_affs:
+            if is_in_blacklist(offer_row['Advertiser'], aff):
+                continue
+            
+            revenue_diff = get_affiliate_revenue_diff(qualified_df, offer_id, aff, latest_date, second_latest_date)
+            
+            if pd.notna(revenue_diff) and (abs(revenue_diff) <= RULE4_REVENUE_DIFF_ABS or revenue_diff >= RULE4_REVENUE_DIFF_UP):
+                todo_list.append({
+                    'Offer ID': offer_id,
+                    'Advertiser': offer_row['Advertiser'],
+                    'App ID': offer_row['App ID'],
+                    'GEO': offer_row['GEO'],
+                    'Total caps': offer_row['Total caps'],
+                    'Status': offer_row['Status'],
+                    '预算空间': offer_row['预算空间'],
+                    'Affiliate': aff,
+                    '待办事项': '优先push该下游消耗预算，原因该下游历史或者最新一天有产生过流水且该预算仍有空间',
+                    f'{latest_date_str}_total_revenue': offer_row[f'{latest_date_str}_total_revenue'],
+                    f'{second_latest_date_str}_total_revenue': offer_row[f'{second_latest_date_str}_total_revenue'],
+                    'affilate_revenue_rate_all': offer_row['affilate_revenue_rate_all'],
+                    'latest_affilate_revenue_rate_all': offer_row['latest_affilate_revenue_rate_all'],
+                    'influence_affiliate': offer_row['influence_affiliate']  # 新增：波动原因
+                })
+                triggered_45_affiliate.add((offer_id, aff))
+                rule4_count += 1
+                
+    
+    print(f"  规则4最终触发数量：{rule4_count}")
+    
+    # 规则5
+    print("  处理规则5：ACTIVE+预算>0+收入减少>5...")
+    rule5_offer_data = todo_base_data[
+    (todo_base_data['Status'].str.upper() == 'ACTIVE') & 
+    (todo_base_data['预算空间'] > 0) & 
+    (~todo_base_data['Offer ID'].isin(triggered_123_offer_ids)) &
+    (~todo_base_data.apply(lambda row: is_in_blacklist(row['Advertiser'], ''), axis=1))
+    ].copy()
+
+    rule5_count = 0
+    for _, offer_row in rule5_offer_data.iterrows():
+        offer_id = offer_row['Offer ID']
+        history_affs = parse_affiliate_rate_text(offer_row['affilate_revenue_rate_all'])
+        latest_affs = parse_affiliate_rate_text(offer_row['latest_affilate_revenue_rate_all'])
+        all_affs = list(set(history_affs + latest_affs))
+        
+        if not all_affs:
+            continue
+        
+        for aff in all_affs:
+            if is_in_blacklist(offer_row['Advertiser'], aff):
+                continue
+            
+            revenue_diff = get_affiliate_revenue_diff(qualified_df, offer_id, aff, latest_date, second_latest_date)
+            
+            if pd.notna(revenue_diff) and revenue_diff < RULE5_REVENUE_DIFF_THRESHOLD:
+                todo_list.append({
+                    'Offer ID': offer_id,
+                    'Advertiser': offer_row['Advertiser'],
+                    'App ID': offer_row['App ID'],
+                    'GEO': offer_row['GEO'],
+                    'Total caps': offer_row['Total caps'],
+                    'Status': offer_row['Status'],
+                    '预算空间': offer_row['预算空间'],
+                    'Affiliate': aff,
+                    '待办事项': '和下游沟通减少原因',
+                    f'{latest_date_str}_total_revenue': offer_row[f'{latest_date_str}_total_revenue'],
+                    f'{second_latest_date_str}_total_revenue': offer_row[f'{second_latest_date_str}_total_revenue'],
+                    'affilate_revenue_rate_all': offer_row['affilate_revenue_rate_all'],
+                    'latest_affilate_revenue_rate_all': offer_row['latest_affilate_revenue_rate_all'],
+                    'influence_affiliate': offer_row['influence_affiliate']  # 新增：波动原因
+                })
+                triggered_45_affiliate.add((offer_id, aff))
+                rule5_count += 1
+                
+    
+    print(f"  规则5最终触发数量：{rule5_count}")
+    
+    # ========== 规则6：ACTIVE+预算充足+类型匹配 ==========
+    # 步骤1：从AFFILIATE_TYPE_MAP中提取所有Affiliate名称（无视流水）
+    all_affs_from_map = list(AFFILIATE_TYPE_MAP.keys())
+    
+    # 步骤2：筛选符合规则6的Offer
+    rule6_offers = todo_base_data[
+        (todo_base_data['Status'].str.upper() == 'ACTIVE') &
+        (todo_base_data['预算空间'] > 0) &
+        (~todo_base_data['Offer ID'].isin(triggered_123_offer_ids)) &
+        (~todo_base_data.apply(lambda row: is_in_blacklist(row['Advertiser'], ''), axis=1))
+    ].copy()
+    
+    # 计算每个offerid过去30天的total revenue
+    offer_30d_revenue = qualified_df.groupby('Offer ID')['Total Revenue'].sum().reset_index()
+    offer_30d_revenue.columns = ['Offer ID', 'total_revenue_30d']
+    
+    # 新增：构建(geo, app id, affiliate)组合的规则4/5触发记录
+    triggered_45_geo_app_aff = set()
+    for (offer_id, aff) in triggered_45_affiliate:
+        # 获取该offer的geo和app id
+        offer_data = todo_base_data[todo_base_data['Offer ID'] == offer_id]
+        if not offer_data.empty:
+            geo = offer_data['GEO'].iloc[0] if pd.notna(offer_data['GEO'].iloc[0]) else ''
+            app_id = offer_data['App ID'].iloc[0] if pd.notna(offer_data['App ID'].iloc[0]) else ''
+            triggered_45_geo_app_aff.add((geo, app_id, aff))
+    
+    #按(geo, app id, affiliate)组合筛选最高流水的Offer ID
+    print("\n=== 规则6优化：按组合筛选高流水Offer ===")
+    
+    # 收集所有可能的规则6触发项（不立即添加到todo_list）
+    rule6_candidates = []
+    
+    rule6_count = 0
+    for _, offer_row in rule6_offers.iterrows():
+        offer_id = offer_row['Offer ID']
+        advertiser = offer_row['Advertiser']
+        geo = offer_row['GEO'] if pd.notna(offer_row['GEO']) else ''
+        app_id = offer_row['App ID'] if pd.notna(offer_row['App ID']) else ''
+        
+        # 获取该offer的30天总流水
+        offer_revenue_data = offer_30d_revenue[offer_30d_revenue['Offer ID'] == offer_id]
+        total_revenue_30d = offer_revenue_data['total_revenue_30d'].iloc[0] if not offer_revenue_data.empty else 0
+        
+        # 获取广告主类型
+        advertiser_type = ''
+        for adv_key, adv_type in ADVERTISER_TYPE_MAP.items():
+            if adv_key in advertiser:
+                advertiser_type = adv_type
+                break
+        if not advertiser_type:
+            continue  # 广告主无类型，跳过
+
+        
+        # 遍历AFFILIATE_TYPE_MAP中的所有Affiliate（无视流水）
+        for aff in all_affs_from_map:
+            # 过滤黑名单
+            if is_in_blacklist(advertiser, aff):
+                continue
+            # 过滤已触发4/5的Affiliate（原有逻辑保留）
+            if (offer_id, aff) in triggered_45_affiliate:
+                continue
+            
+            # 新增：过滤已触发4/5的(geo, app id, affiliate)组合
+            if (geo, app_id, aff) in triggered_45_geo_app_aff:
+                continue
+            
+            # 获取Affiliate类型
+            aff_type = AFFILIATE_TYPE_MAP[aff]
+            
+            # 类型匹配判断
+            match_flag = False
+            if advertiser_type == 'xdj流量' and aff_type in('xdj流量','inapp流量/xdj流量'):
+                match_flag = True
+            elif advertiser_type == 'xdj流量/inapp流量' and aff_type in('inapp流量','inapp流量/xdj流量'):
+                match_flag = True
+            
+            # 触发规则6候选
+            if match_flag:
+                rule6_candidates.append({
+                    'Offer ID': offer_id,
+                    'Advertiser': advertiser,
+                    'Affiliate': aff,
+                    'GEO': geo,
+                    'App ID': app_id,
+                    'total_revenue_30d': total_revenue_30d,
+                    '组合键': f"{geo}_{app_id}_{aff}",  # 用于分组
+                    '原始数据': offer_row  # 保留原始数据用于后续构造
+                })
+                
+    
+    # 按组合筛选最高流水Offer
+    if rule6_candidates:
+        # 转换为DataFrame便于处理
+        candidates_df = pd.DataFrame(rule6_candidates)
+        
+        # 按组合键分组，选择每个组合中流水最高的Offer
+        best_offers_by_combo = candidates_df.loc[candidates_df.groupby('组合键')['total_revenue_30d'].idxmax()]
+        best_offers_by_combo = best_offers_by_combo[best_offers_by_combo['total_revenue_30d'] >= 5]
+        print("\n📊 规则6组合筛选结果：")
+        print(f"   - 原始候选数：{len(candidates_df)}")
+        print(f"   - 去重后数量：{len(best_offers_by_combo)}")
+        print(f"   - 唯一组合数：{best_offers_by_combo['组合键'].nunique()}")
+        
+        # 将筛选后的结果添加到todo_list
+        for _, best_offer in best_offers_by_combo.iterrows():
+            original_data = best_offer['原始数据']
+            todo_list.append({
+                'Offer ID': best_offer['Offer ID'],
+                'Advertiser': best_offer['Advertiser'],
+                'Affiliate': best_offer['Affiliate'],
+                'GEO': best_offer['GEO'],
+                'App ID': best_offer['App ID'],
+                '待办事项': '历史可能未推下游，尝试push（按组合筛选最高流水）',
+                'influence_affiliate': original_data['influence_affiliate'],
+                'total_revenue_30d': best_offer['total_revenue_30d'],
+                f'{latest_date_str}_total_revenue': original_data[f'{latest_date_str}_total_revenue'],
+                f'{second_latest_date_str}_total_revenue': original_data[f'{second_latest_date_str}_total_revenue'],
+                'affilate_revenue_rate_all': original_data['affilate_revenue_rate_all'],
+                'latest_affilate_revenue_rate_all': original_data['latest_affilate_revenue_rate_all']
+            })
+            rule6_count += 1
+            
+    
+    print(f"  规则6触发数量：{rule6_count}")     
+    
+    # 转换为DataFrame并去重
+    todo_df = pd.DataFrame(todo_list).drop_duplicates(subset=['Offer ID', 'Affiliate', '待办事项'])
+    print(f"\n✅ 待办事项总计：{len(todo_df)}条")
+
+    
+
+            
+
+    # 9. 生成最终Excel
+
+    print("\n=== 9. 生成Excel文件 ===")
+    final_offer_analysis = offer_summary.merge(affiliate_summary, on='Offer ID', how='left').fillna({'affilate_revenue_rate_all': ''})
+    final_offer_analysis = final_offer_analysis.merge(latest_summary, on='Offer ID', how='left').fillna(0)
+    final_offer_analysis = final_offer_analysis.merge(second_summary, on='Offer ID', how='left').fillna(0)
+    final_offer_analysis = final_offer_analysis.merge(latest_affiliate_summary, on='Offer ID', how='left').fillna({'latest_affilate_revenue_rate_all': ''})
+    final_offer_analysis = final_offer_analysis.merge(influence_affiliate_summary, on='Offer ID', how='left').fillna({'influence_affiliate': ''})
+    
+    # 定义final_offer_analysis的列顺序
+    final_offer_analysis_columns = [
+        'Offer ID', 'Advertiser', 'App ID', 'GEO', 
+        'total_clicks', 'total_conversions', 'total_revenue', 'total_profit',
+        'Total caps', 'Status', 'affilate_revenue_rate_all',
+        f'{latest_date_str}_total_clicks', f'{latest_date_str}_total_conversions', 
+        f'{latest_date_str}_total_revenue', f'{latest_date_str}_total_profit',
+        f'{second_latest_date_str}_total_clicks', f'{second_latest_date_str}_total_conversions', 
+        f'{second_latest_date_str}_total_revenue', f'{second_latest_date_str}_total_profit',
+        'latest_affilate_revenue_rate_all', 'influence_affiliate'
+    ]
+    
+    # 重新排列final_offer_analysis的列顺序
+    existing_columns = [col for col in final_offer_analysis_columns if col in final_offer_analysis.columns]
+    extra_columns = [col for col in final_offer_analysis.columns if col not in final_offer_analysis_columns]
+    final_offer_analysis = final_offer_analysis[existing_columns + extra_columns]
+    
+    # 创建增强的待办事项列表，包含所有列
+    enhanced_todo_list = []
+    
+    for todo_item in todo_list:
+        # 获取该Offer ID在final_offer_analysis中的所有数据
+        offer_id = todo_item['Offer ID']
+        offer_data = final_offer_analysis[final_offer_analysis['Offer ID'] == offer_id]
+        
+        if len(offer_data) > 0:
+            # 获取第一行数据（每个Offer ID应该只有一行）
+            offer_row = offer_data.iloc[0]
+            
+            # 创建增强的待办事项项，包含所有列
+            enhanced_todo = {}
+            
+            # 首先添加final_offer_analysis的所有列
+            for column in final_offer_analysis.columns:
+                enhanced_todo[column] = offer_row[column]
+            
+            # 然后添加待办事项特有的列（覆盖可能存在的同名列）
+            enhanced_todo.update({
+                'Affiliate': todo_item.get('Affiliate', ''),
+                '待办事项': todo_item.get('待办事项', ''),
+                # 确保预算空间列使用待办事项中的值（因为可能重新计算过）
+                '预算空间': todo_item.get('预算空间', offer_row.get('预算空间', 0))
+            })
+            
+            enhanced_todo_list.append(enhanced_todo)
+        else:
+            # 如果找不到对应的Offer数据，使用原始待办事项
+            print(f"⚠️ 警告：Offer ID {offer_id} 在final_offer_analysis中未找到，使用原始待办事项数据")
+            enhanced_todo_list.append(todo_item)
+    
+    # 转换为DataFrame
+    if enhanced_todo_list:
+        # 定义enhanced_todo_df的列顺序
+        enhanced_todo_columns = existing_columns + ['Affiliate', '待办事项', '预算空间'] + extra_columns
+        
+        enhanced_todo_df = pd.DataFrame(enhanced_todo_list)
+        
+        # 确保列顺序
+        existing_enhanced_columns = [col for col in enhanced_todo_columns if col in enhanced_todo_df.columns]
+        enhanced_todo_df = enhanced_todo_df[existing_enhanced_columns]
+    else:
+        enhanced_todo_df = pd.DataFrame(todo_list)
+    
+    # 去重
+    enhanced_todo_df = enhanced_todo_df.drop_duplicates(subset=['Offer ID', 'Affiliate', '待办事项'])
+
+    revenue_ranking_df = calculate_revenue_ranking(qualified_df)
+
+    
+    final_offer_analysis = final_offer_analysis.merge(
+        revenue_ranking_df[['Offer ID','Advertiser','Advertiser_Rank']],
+        on=['Offer ID','Advertiser'],
+        how='left'
+    )
+
+    enhanced_todo_df = enhanced_todo_df.merge(
+        revenue_ranking_df[['Offer ID','Advertiser','Advertiser_Rank']],
+        on=['Offer ID','Advertiser'],
+        how='left'
+    )
+    sort_columns = ['Advertiser', 'Advertiser_Rank']
+    sort_ascending = [True, True]
+    
+    # 排序两个数据集，ignore_index=True 重置行索引，导出Excel更整洁
+    final_offer_analysis = final_offer_analysis.sort_values(
+        by=sort_columns,
+        ascending=sort_ascending,
+        ignore_index=True
+    )
+    
+    enhanced_todo_df = enhanced_todo_df.sort_values(
+        by=sort_columns,
+        ascending=sort_ascending,
+        ignore_index=True
+    )       
+    if progress_bar and status_text:
+        progress_bar.progress(100)
+        status_text.text("🎉 处理完成！")
+    
+    return final_offer_analysis, enhanced_todo_df, latest_date
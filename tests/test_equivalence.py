@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""优化实现与冻结参考实现的等价性：合成数据上各运行方式的输出与参考实现逐单元格一致"""
+
+from io import BytesIO
+
+import pandas as pd
+
+from offer_analysis_bench import generate_workload, isolated_local_state
+from offer_analysis_core import AggregateStore, load_offer_cube, write_excel_sheets
+from offer_analysis_equivalence import OPTIMIZED_ENGINES, check_equivalence, format_report, generated_input
+
+
+def test_generated_input_matches_reference(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    report = check_equivalence(generated_input(3000), tuple(OPTIMIZED_ENGINES))
+    assert report
+    assert all(not diffs for diffs in report.values()), format_report('合成数据3000行', report)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_incremental_store_reaggregates_only_changed_days():
+    data, blacklist = generate_workload(2000)
+    latest = pd.to_datetime(data['Time']) >= pd.to_datetime(data['Time']).max().normalize()
+    changed = data.copy()
+    changed.loc[latest, 'Total Revenue'] += 1.5
+    uploads = []
+    for frame in (data, changed):
+        output = BytesIO()
+        write_excel_sheets({'1-all data': frame, 'blacklist': blacklist}, output)
+        uploads.append(output.getvalue())
+
+    with isolated_local_state():
+        load_offer_cube(BytesIO(uploads[0]), incremental=True, store_source='a')
+        _, cube, offer_attrs = load_offer_cube(BytesIO(uploads[1]), incremental=True, store_source='a')
+        _, expected_cube, expected_attrs = load_offer_cube(BytesIO(uploads[1]))
+        digests = AggregateStore().digests('a')
+
+    pd.testing.assert_frame_equal(cube, expected_cube)
+    pd.testing.assert_frame_equal(offer_attrs, expected_attrs)
+    # 只有最新一天存了两个版本，其余日期复用第一次上传的分区
+    assert [day for day, versions in digests.items() if len(versions) > 1] == [max(digests)]
+    assert all(len(versions) == 1 for day, versions in digests.items() if day != max(digests))